@@ -0,0 +1,96 @@
+# alert_listener.py
+# Nhận thông báo cảnh báo mới qua PostgreSQL LISTEN/NOTIFY để dashboard admin cập nhật gần như tức thì.
+
+import collections
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+import cache_versions
+import tracing
+
+NEW_ALERT_CHANNEL = "new_alert"
+
+
+class AlertListener:
+    """Luồng nền giữ MỘT kết nối riêng (autocommit) và LISTEN kênh `new_alert`.
+
+    Mỗi NOTIFY mang id cảnh báo mới; id được đánh số thứ tự và giữ trong bộ đệm vòng
+    để từng phiên admin hỏi "có gì mới kể từ số thứ tự X". Dữ liệu "alerts" trong
+    cache_versions cũng được tăng phiên bản để danh sách/thống kê tự làm mới.
+
+    Lưu ý: LISTEN không hoạt động qua PgBouncer ở chế độ transaction (vd: endpoint "-pooler"
+    của Neon) - hãy dùng chuỗi kết nối trực tiếp cho listener.
+    """
+
+    def __init__(self, connect_kwargs, channel=NEW_ALERT_CHANNEL, buffer_size=1000, poll_timeout=5.0):
+        self.connect_kwargs = connect_kwargs
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+        self._events = collections.deque(maxlen=buffer_size)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.connected = False
+        self._thread = threading.Thread(target=self._run, name="alert-listener", daemon=True)
+        self._thread.start()
+
+    def latest_sequence(self):
+        """Số thứ tự của thông báo mới nhất (dùng làm mốc ban đầu cho một phiên admin)."""
+        with self._lock:
+            return self._sequence
+
+    def events_since(self, sequence):
+        """Danh sách id cảnh báo nhận được sau mốc `sequence`, kèm mốc mới."""
+        with self._lock:
+            alert_ids = [alert_id for seq, alert_id in self._events if seq > sequence]
+            return alert_ids, self._sequence
+
+    def stop(self):
+        self._stop.set()
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        return conn
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                self.connected = True
+                backoff = 1.0
+                cache_versions.bump("alerts") # Có thể đã lỡ thông báo khi mất kết nối: làm mới danh sách
+                tracing.info(f"Alert listener: LISTEN {self.channel} started.")
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                        continue
+                    conn.poll()
+                    received = []
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            received.append(int(notify.payload))
+                        except ValueError:
+                            tracing.warning(f"Alert listener: ignoring payload '{notify.payload}'.")
+                    if received:
+                        with self._lock:
+                            for alert_id in received:
+                                self._sequence += 1
+                                self._events.append((self._sequence, alert_id))
+                        cache_versions.bump("alerts")
+                        tracing.debug(f"Alert listener: received new alert ids {received}.")
+            except Exception as e:
+                tracing.error(f"Alert listener error: {type(e).__name__}: {e}. Reconnecting in {backoff:.0f}s...")
+            finally:
+                self.connected = False
+                if conn is not None and not conn.closed:
+                    conn.close()
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 60.0)
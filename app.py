@@ -1,15 +1,29 @@
 # app.py
 
 import streamlit as st
-import google.generativeai as genai
 import os
 from dotenv import load_dotenv
 import datetime
+import time
+from collections import deque
 import psycopg2 # Để tương tác với PostgreSQL (Neon)
-import pandas as pd # Vẫn cần cho một số xử lý dữ liệu
+import db # Tầng truy cập dữ liệu dùng chung (pool + câu lệnh PREPARE sẵn)
+import cache_versions # Phiên bản dữ liệu để dashboard làm mới cache có chọn lọc
+from message_writer import MessageWriter # Ghi tin nhắn theo lô ở luồng nền
+from risk_detector import RISK_KEYWORDS, SIGNAL_KEYWORDS, RiskDetector, RiskScorer # Nhận diện từ khóa + điểm rủi ro theo phiên
+import knowledge_index # Tra cứu FAQ (knowledge_base) trước khi gọi Gemini
+from response_cache import ResponseCache # Cache câu trả lời cho câu hỏi lặp lại
+import session_store # Lịch sử chat gọn, có trần bộ nhớ cho cả tiến trình
 import uuid # Thư viện để tạo ID duy nhất
+from gemini_client import GeminiBusy, GeminiClient, GeminiTimeout, is_rate_limited # Gọi Gemini (stream, giới hạn đồng thời, thử lại)
+from context_window import ContextWindow, estimate_tokens # Giới hạn ngữ cảnh gửi cho Gemini
+import chat_view # Hiển thị lịch sử chat theo cửa sổ (dùng chung với trang Admin)
+import tracing # Đo thời gian từng giai đoạn + log có cấp độ (thay cho print)
 
 
+# Số lượt gần nhất giữ lại trong st.session_state.prompt_token_log (token đầu vào mỗi lượt gửi Gemini)
+PROMPT_TOKEN_LOG_SIZE = 200
+
 # --- Cấu hình cơ bản ---
 st.set_page_config(
     page_title="Trợ Lý Học Đường AI",
@@ -18,58 +32,22 @@ st.set_page_config(
 )
 
 def save_message_to_db(session_id, user_id, sender, content, related_alert_id=None):
-    """Lưu một tin nhắn vào bảng 'conversations'."""
-    conn = connect_db()
-    if conn is None:
-        print("CRITICAL: Cannot save message - No DB connection.")
+    """Đưa một tin nhắn vào hàng đợi ghi nền cho bảng 'conversations' (không chờ CSDL)."""
+    writer = get_message_writer()
+    if writer is None:
+        tracing.critical("Cannot save message - No DB connection.")
         # st.warning("Không thể lưu tin nhắn do lỗi kết nối CSDL.") # Bỏ comment nếu muốn hiển thị
         return False
-
-    cursor = None
-    message_saved = False
-    try:
-        cursor = conn.cursor()
-        # Sử dụng timestamp từ Python để đảm bảo tính nhất quán
-        timestamp_to_save = datetime.datetime.now()
-
-        # --- SQL khớp với bảng 'conversations' của bạn ---
-        sql = """
-            INSERT INTO conversations
-            (session_id, user_id, sender, message_content, timestamp, related_alert_id)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        cursor.execute(sql, (session_id, user_id, sender, content, timestamp_to_save, related_alert_id))
-        conn.commit()
-        message_saved = True
-        print(f"Message saved to 'conversations': session={session_id}, sender={sender}, related_alert_id={related_alert_id}")
-    except psycopg2.Error as db_err: # Bắt lỗi cụ thể của psycopg2
-        if conn: conn.rollback()
-        print(f"--- DATABASE ERROR Saving Message to 'conversations' (psycopg2) ---")
-        print(f"Session ID: {session_id}, Sender: {sender}")
-        print(f"PostgreSQL Error Code: {db_err.pgcode}")
-        print(f"Error Message: {db_err.pgerror}")
-        print(f"Data passed: session='{session_id}', user='{user_id}', sender='{sender}', related_alert_id={related_alert_id}")
-        print(f"----------------------------------------------------")
-        # st.warning(f"Lỗi CSDL khi lưu tin nhắn: {db_err.pgcode}") # Cân nhắc hiển thị lỗi này
-    except Exception as e:
-        if conn: conn.rollback()
-        print(f"--- GENERAL ERROR Saving Message to 'conversations' ---")
-        print(f"Session ID: {session_id}, Sender: {sender}")
-        print(f"Error: {e}, Type: {type(e).__name__}")
-        print(f"----------------------------------------------------")
-        # st.warning(f"Lỗi hệ thống khi lưu tin nhắn: {type(e).__name__}") # Cân nhắc hiển thị lỗi này
-    finally:
-        if cursor: cursor.close()
-        # Không đóng conn vì nó được cache
-
-    return message_saved
+    # Timestamp được chốt ngay tại đây để giữ đúng thứ tự tin nhắn trong phiên
+    with tracing.span("db.enqueue_message", sender=sender):
+        return writer.enqueue(session_id, user_id, sender, content, related_alert_id=related_alert_id)
 
 def get_session_id():
     """Tạo hoặc lấy session_id duy nhất cho phiên hiện tại."""
     if "session_id" not in st.session_state:
         # Tạo một UUID mới làm session_id khi phiên bắt đầu
         st.session_state.session_id = str(uuid.uuid4())
-        print(f"Generated new session ID: {st.session_state.session_id}") # Log
+        tracing.debug(f"Generated new session ID: {st.session_state.session_id}")
     return st.session_state.session_id
 
 # --- Quản lý Session Chat Gemini và Lịch sử Hiển thị ---
@@ -77,14 +55,6 @@ def get_session_id():
 current_session_id = get_session_id()
 # st.sidebar.caption(f"Session ID: {current_session_id}") # Có thể hiển thị để debug
 
-if "gemini_history" not in st.session_state:
-    st.session_state.gemini_history = []
-    print("Initialized empty display history.")
-
-if "api_chat_session" not in st.session_state:
-    st.session_state.api_chat_session = None
-    print("API Chat Session placeholder created.")
-
 # --- Trong khối xử lý input mới ---
 user_prompt = st.chat_input("Nhập câu hỏi hoặc điều bạn muốn chia sẻ...")
 
@@ -94,181 +64,245 @@ st.title("🤖 Trợ Lý Học Đường AI")
 st.caption("Hỏi đáp cùng AI về học tập, nghề nghiệp, cảm xúc và các khó khăn trong đời sống học đường.")
 
 # --- Quản lý API Key và Cấu hình ---
+# Streamlit chạy lại toàn bộ script ở mỗi tương tác: cấu hình và mô hình được tạo MỘT lần cho cả
+# tiến trình (st.cache_resource) thay vì load_dotenv/đọc secrets/genai.configure ở mỗi lần rerun.
+
+@st.cache_resource
+def load_app_config():
+    """Đọc .env (khi chạy local) và Streamlit Secrets một lần; trả về API key và mục [database]."""
+    load_dotenv()
+    return {
+        "google_api_key": st.secrets.get("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY")),
+        "db_secrets": st.secrets.get("database"),
+    }
 
-# Load .env file if it exists (for local development)
-load_dotenv()
+app_config = load_app_config()
+
+# Tracing: cấp độ log, tỉ lệ lấy mẫu span và file số liệu (Prometheus text/JSON) cho ops thu thập
+@st.cache_resource
+def setup_tracing():
+    """Cấu hình tracing từ mục [tracing] của Secrets (hoặc biến môi trường LOG_LEVEL / TRACE_SAMPLE_RATE / METRICS_EXPORT_PATH)."""
+    trace_config = st.secrets.get("tracing", {})
+    tracing.configure(
+        level=trace_config.get("log_level", os.getenv("LOG_LEVEL", "INFO")),
+        sample_rate=trace_config.get("sample_rate", os.getenv("TRACE_SAMPLE_RATE", 0.01)),
+    )
+    export_path = trace_config.get("export_path", os.getenv("METRICS_EXPORT_PATH"))
+    if export_path:
+        tracing.start_exporter(export_path, interval=float(trace_config.get("export_interval_seconds", 15)))
+    return True
+
+setup_tracing()
 
 # Lấy Google API Key
-google_api_key = st.secrets.get("GOOGLE_API_KEY", os.getenv("GOOGLE_API_KEY"))
+google_api_key = app_config["google_api_key"]
 if not google_api_key:
     st.error("Lỗi: Không tìm thấy GOOGLE_API_KEY. Vui lòng cấu hình trong Streamlit Secrets hoặc file .env.")
     st.stop()
 
 # Lấy thông tin kết nối DB Neon
-db_secrets = st.secrets.get("database")
+db_secrets = app_config["db_secrets"]
 if not db_secrets:
     st.error("Lỗi: Không tìm thấy cấu hình [database] trong Streamlit Secrets.")
     # Không dừng hoàn toàn, nhưng chức năng cảnh báo sẽ không hoạt động
     # st.stop() # Bỏ comment nếu CSDL là bắt buộc ngay từ đầu
 
 # --- Khởi tạo Mô hình Gemini ---
+@st.cache_resource
+def get_gemini_model(api_key):
+    """Cấu hình SDK và tạo GenerativeModel một lần cho mỗi API key (import SDK khi cần lần đầu)."""
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel('gemini-1.5-flash-latest') # Hoặc phiên bản khác
+
 try:
-    genai.configure(api_key=google_api_key)
-    model = genai.GenerativeModel('gemini-1.5-flash-latest') # Hoặc phiên bản khác
+    model = get_gemini_model(google_api_key)
 except Exception as e:
     st.error(f"Lỗi khởi tạo mô hình Gemini: {e}")
-    print(f"Gemini Initialization Error: {e}")
+    tracing.critical(f"Gemini Initialization Error: {e}")
     st.stop()
 
+# Giới hạn số lượt gọi Gemini đồng thời cho cả tiến trình: khi Gemini chậm, các lượt khác chờ trong
+# hàng đợi có hạn thay vì cùng treo luồng script; lỗi 429/lỗi tạm thời được thử lại có backoff
+@st.cache_resource
+def get_gemini_client():
+    """Khởi tạo GeminiClient; cấu hình trong mục [gemini] của Secrets (nếu có)."""
+    gemini_config = st.secrets.get("gemini", {})
+    return GeminiClient(
+        max_in_flight=int(gemini_config.get("max_in_flight", 8)),
+        queue_timeout=float(gemini_config.get("queue_timeout_seconds", 10)),
+        deadline=float(gemini_config.get("deadline_seconds", 60)),
+        max_retries=int(gemini_config.get("max_retries", 3)),
+    )
+
 # --- Phần Kết nối và Tương tác CSDL ---
 
-# Sử dụng cache_resource cho kết nối DB để tái sử dụng
-@st.cache_resource(ttl=600)
-def connect_db():
-    """Kết nối đến CSDL PostgreSQL."""
-    print("Attempting to connect to the database...")
+def get_db_pool():
+    """Lấy pool kết nối CSDL dùng chung của tiến trình (xem db.get_pool)."""
     if not db_secrets: # Kiểm tra lại nếu db_secrets chưa được load
-        print("DB connection info missing in secrets.")
+        tracing.error("DB connection info missing in secrets.")
         return None
     try:
-        if "uri" in db_secrets:
-            conn = psycopg2.connect(db_secrets["uri"])
-        elif "host" in db_secrets:
-            conn = psycopg2.connect(
-                host=db_secrets["host"],
-                port=db_secrets.get("port", 5432),
-                dbname=db_secrets["dbname"],
-                user=db_secrets["user"],
-                password=db_secrets["password"],
-                sslmode=db_secrets.get("sslmode", "require")
-            )
-        else:
-            print("DB connection info incomplete in secrets.")
-            return None
-        print("Database connection successful!")
-        return conn
+        pool = db.get_pool(db_secrets)
+        if pool is None:
+            tracing.error("DB connection info incomplete in secrets.")
+        return pool
     except psycopg2.OperationalError as e:
          # Không hiển thị lỗi trực tiếp trên UI chính, chỉ log
-         print(f"DB Connection OperationalError: {e}. Check credentials, host, port, network, SSL.")
+         tracing.error(f"DB Connection OperationalError: {e}. Check credentials, host, port, network, SSL.")
          return None
     except Exception as e:
-        print(f"DB Connection Error: {e}")
+        tracing.error(f"DB Connection Error: {e}")
+        return None
+
+# Luồng ghi nền dùng chung cho cả tiến trình: gom tin nhắn thành lô thay vì INSERT + commit từng tin
+@st.cache_resource
+def get_message_writer():
+    """Khởi tạo bộ ghi tin nhắn nền (write-behind) cho bảng 'conversations'."""
+    pool = get_db_pool()
+    if pool is None:
         return None
+    return MessageWriter(pool)
 
 def create_alert_in_db(session_id, reason, snippet, priority, status='Mới', user_id_associated=None):
     """Tạo một bản ghi cảnh báo mới trong bảng 'alerts'."""
-    conn = connect_db() # Lấy kết nối (có thể trả về None)
-    if conn is None:
-        print("CRITICAL: Cannot create alert - No DB connection.")
+    pool = get_db_pool() # Lấy pool (có thể trả về None)
+    if pool is None:
+        tracing.critical("Cannot create alert - No DB connection.")
         st.warning("Không thể ghi nhận cảnh báo do lỗi kết nối CSDL.") # Thông báo nhẹ nhàng trên UI
-        return False
+        return None
+
+    with tracing.span("alert.create", session=session_id, priority=priority) as alert_span:
+        # Ghi nốt các tin nhắn đang chờ trong hàng đợi để tin nhắn gây cảnh báo luôn có trong CSDL trước cảnh báo
+        writer = get_message_writer()
+        if writer is not None:
+            writer.flush()
+
+        conn = None
+        cursor = None
+        new_alert_id = None # Khởi tạo ban đầu
+        try:
+            conn = pool.getconn() # Mượn kết nối riêng cho request này
+            # Câu lệnh INSERT ... RETURNING id được PREPARE sẵn trong db.py
+            with tracing.span("db.insert_alert"):
+                cursor = db.execute(conn, "insert_alert", (session_id, reason, snippet, priority, status))
+                result = cursor.fetchone()
+                if result:
+                    new_alert_id = result[0]
+                    # Báo cho dashboard admin đang LISTEN (được phát khi commit)
+                    db.execute(conn, "notify_new_alert", (str(new_alert_id),)).close()
+                    conn.commit() # Chỉ commit nếu INSERT và fetch thành công
+                else:
+                    conn.rollback() # Rollback nếu không lấy được ID
+            if new_alert_id is not None:
+                cache_versions.bump("alerts") # Dashboard admin (cùng tiến trình) thấy cảnh báo mới ngay
+                tracing.info(f"Created alert {new_alert_id}: session={session_id}, reason='{reason}', priority={priority}")
+            else:
+                alert_span.failed = True
+                tracing.warning(f"Alert INSERT seemed to work, but failed to fetch RETURNING id (session={session_id}).")
+
+        except Exception as e:
+            # Lỗi psycopg2 có thêm mã lỗi PostgreSQL; dữ liệu đầu vào chỉ ghi ở cấp DEBUG (snippet là tin nhắn của học sinh)
+            pg_details = f", pgcode={e.pgcode}, pgerror={e.pgerror}" if isinstance(e, psycopg2.Error) else ""
+            alert_span.failed = True
+            tracing.error(f"Error creating alert (session={session_id}): {type(e).__name__}: {e}{pg_details}")
+            tracing.debug(f"Alert data: reason='{reason}', snippet='{snippet}', priority={priority}, status='{status}'")
+            if conn:
+                try:
+                    conn.rollback()
+                except Exception as rollback_err:
+                    tracing.error(f"Error during rollback after alert failure: {rollback_err}")
+            if isinstance(e, psycopg2.Error):
+                st.warning(f"Gặp sự cố CSDL ({type(e).__name__}) khi tạo cảnh báo. Chi tiết xem log.")
+            else:
+                st.warning(f"Gặp sự cố hệ thống ({type(e).__name__}) khi tạo cảnh báo. Chi tiết xem log.")
+
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                pool.putconn(conn) # Trả kết nối về pool
 
-    cursor = None
-    #alert_created = False
-    new_alert_id = None # Khởi tạo ban đầu
-    try:
-        print("Step 1: Getting cursor...") # DEBUG
-        cursor = conn.cursor()
-        print(f"Step 2: Cursor obtained: {cursor}") # DEBUG
-        print(f"Step 3: Preparing SQL: session={session_id}, reason='{reason}', snippet='{snippet}', priority={priority}, status='{status}'") # DEBUG
-    
-        # --- SQL ĐÚNG (như đã sửa) ---
-        sql = """
-            INSERT INTO alerts (chat_session_id, reason, snippet, priority, status)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-        """
-    
-        print("Step 4: Executing SQL...") # DEBUG
-        cursor.execute(sql, (session_id, reason, snippet, priority, status))
-        print("Step 5: SQL executed.") # DEBUG
-    
-        print("Step 6: Fetching result...") # DEBUG
-        result = cursor.fetchone()
-        print(f"Step 7: Result fetched: {result}") # DEBUG
-    
-        if result:
-            print("Step 8: Assigning new_alert_id...") # DEBUG
-            new_alert_id = result[0]
-            print(f"Step 9: new_alert_id assigned: {new_alert_id}. Committing...") # DEBUG
-            conn.commit() # Chỉ commit nếu INSERT và fetch thành công
-            print(f"Step 10: Commit successful.") # DEBUG
-        else:
-            print("Step 8a: No result returned from fetchone(). Rolling back...") # DEBUG
-            conn.rollback() # Rollback nếu không lấy được ID
-            print(f"--- DATABASE WARNING: Alert INSERT seemed to work, but failed to fetch RETURNING id ---") # Thay đổi thành WARNING
-    
-    # --- Khối except cho psycopg2.Error ---
-    except psycopg2.Error as db_err:
-        print(f"--- CAUGHT IN psycopg2.Error BLOCK ---") # DEBUG
-        print(f"Detailed psycopg2 Error Type: {type(db_err).__name__}")
-        print(f"Error arguments: {db_err.args}")
-        print(f"Error __str__(): {db_err}")
-        if conn:
-            try:
-                print(f"Connection status before rollback (psycopg2 err): {conn.status}")
-                conn.rollback()
-                print(f"Rollback successful (psycopg2 err).")
-            except Exception as rollback_err:
-                print(f"!!! ERROR during rollback (psycopg2 err): {rollback_err}")
-        else:
-             print("No connection object to rollback (psycopg2 err).")
-        print(f"PostgreSQL Error Code: {db_err.pgcode}") # Có thể vẫn None
-        print(f"Error Message: {db_err.pgerror}") # Có thể vẫn None
-        print(f"Data passed: session='{session_id}', reason='{reason}', snippet='{snippet}', priority={priority}, status='{status}'")
-        st.warning(f"Gặp sự cố CSDL ({type(db_err).__name__}) khi tạo cảnh báo. Chi tiết xem log.")
-    
-    # --- Khối except cho các lỗi khác ---
-    except Exception as e:
-        print(f"--- CAUGHT IN GENERAL Exception BLOCK ---") # DEBUG
-        print(f"General Error Type: {type(e).__name__}")
-        print(f"General Error arguments: {e.args}")
-        print(f"General Error __str__(): {e}")
-        # Kiểm tra xem có phải lỗi psycopg2 bị bắt ở đây không
-        if isinstance(e, psycopg2.Error):
-            print(">>> This general exception IS a psycopg2.Error! <<<")
-            print(f"pgcode: {e.pgcode}")
-            print(f"pgerror: {e.pgerror}")
-        if conn:
-            try:
-                print(f"Connection status before rollback (general err): {conn.status}")
-                conn.rollback()
-                print(f"Rollback successful (general err).")
-            except Exception as rollback_err:
-                print(f"!!! ERROR during rollback (general err): {rollback_err}")
-        else:
-            print("No connection object to rollback (general err).")
-        st.warning(f"Gặp sự cố hệ thống ({type(e).__name__}) khi tạo cảnh báo. Chi tiết xem log.")
-    
-    # --- Khối finally ---
-    finally:
-        print("Step FINAL: Entering finally block.") # DEBUG
-        if cursor:
-            print("Step FINAL: Closing cursor.") # DEBUG
-            cursor.close()
-        print(f"Step FINAL: Value of new_alert_id before return: {new_alert_id}") # DEBUG
-    
-    print(f"Step RETURN: Returning new_alert_id: {new_alert_id}") # DEBUG
     return new_alert_id
 
 # --- Phần Logic Nhận diện Rủi ro ---
 
-# !!! DANH SÁCH TỪ KHÓA RẤT CƠ BẢN - CẦN MỞ RỘNG VÀ XÁC THỰC !!!
-RISK_KEYWORDS = {
-    "tự hại": ["muốn chết", "kết thúc", "tự tử", "không muốn sống", "tự làm đau", "dao kéo", "tuyệt vọng"],
-    "bạo lực": ["bị đánh", "bị đập", "bị trấn", "bị đe dọa", "bắt nạt hội đồng"],
-    # Thêm các nhóm khác: lo âu nghiêm trọng, lạm dụng,...
-}
+# Danh sách từ khóa RISK_KEYWORDS / SIGNAL_KEYWORDS nằm trong risk_detector.py; automaton được biên dịch một lần cho cả tiến trình
+@st.cache_resource
+def get_risk_detector():
+    """Biên dịch bộ nhận diện từ khóa rủi ro (Aho-Corasick) từ RISK_KEYWORDS và các dấu hiệu SIGNAL_KEYWORDS."""
+    detector = RiskDetector({**RISK_KEYWORDS, **SIGNAL_KEYWORDS})
+    tracing.info(f"Compiled risk detector with {detector.keyword_count} keywords.")
+    return detector
 
 def detect_risk(text):
-    """Phát hiện từ khóa rủi ro. Trả về loại rủi ro hoặc None."""
-    text_lower = text.lower()
-    for risk_type, keywords in RISK_KEYWORDS.items():
-        for keyword in keywords:
-            if keyword in text_lower:
-                print(f"!!! RISK DETECTED: Type={risk_type}, Keyword='{keyword}'")
-                return risk_type
-    return None
+    """Phát hiện từ khóa rủi ro trong một tin nhắn.
+
+    Trả về (loại rủi ro nghiêm trọng khớp đầu tiên hoặc None, mọi RiskMatch kể cả dấu hiệu mềm).
+    """
+    with tracing.span("risk.detect", chars=len(text)):
+        matches = get_risk_detector().find_all(text)
+    detected = None
+    for match in matches:
+        if match.category in RISK_KEYWORDS:
+            detected = detected or match.category
+            tracing.warning(f"RISK DETECTED: Type={match.category}, Keyword='{match.keyword}', Span=({match.start}, {match.end})")
+        else:
+            tracing.info(f"Risk signal: Type={match.category}, Keyword='{match.keyword}'")
+    return detected, matches
+
+def has_serious_risk(text):
+    """True nếu text chứa từ khóa rủi ro nghiêm trọng (RISK_KEYWORDS); dấu hiệu mềm không tính."""
+    return any(match.category in RISK_KEYWORDS for match in get_risk_detector().find_all(text))
+
+# Điểm rủi ro tích lũy theo phiên: bắt được rủi ro rải rác qua nhiều tin nhắn mà không quét lại lịch sử
+@st.cache_resource
+def get_risk_scorer():
+    """Cấu hình chấm điểm rủi ro theo phiên từ mục [risk_scoring] của Secrets (nếu có)."""
+    scoring_config = st.secrets.get("risk_scoring", {})
+    return RiskScorer(
+        half_life_seconds=float(scoring_config.get("half_life_minutes", 30)) * 60,
+        threshold=float(scoring_config.get("threshold", 0.9)),
+    )
+
+def get_session_risk(history):
+    """Điểm rủi ro của phiên, gắn trên lịch sử trong kho; dựng lại một lần từ tin nhắn user khi phiên vừa được nạp lại."""
+    if history.risk is None:
+        user_messages = [(msg.content, msg.created) for msg in history if msg.role == "user"]
+        history.risk = get_risk_scorer().replay(get_risk_detector(), user_messages)
+        if user_messages:
+            tracing.debug(f"Rebuilt session risk from {len(user_messages)} messages: score={history.risk.score:.2f}")
+    return history.risk
+
+def update_session_risk(risk_state, matches, detected_risk):
+    """Cộng kết quả khớp của tin nhắn mới vào điểm của phiên; True nếu cần tạo cảnh báo tích lũy."""
+    with tracing.span("risk.score", matches=len(matches)):
+        crossed = get_risk_scorer().update(risk_state, matches, time.time())
+    if detected_risk:
+        risk_state.alerted = True # Tin nhắn này đã có cảnh báo riêng
+        return False
+    if crossed:
+        tracing.warning(f"CUMULATIVE RISK: score={risk_state.score:.2f}, recent={list(risk_state.recent)}")
+    return crossed
+
+# Cache câu trả lời dùng chung cho mọi phiên trong tiến trình (tùy chọn lưu bền vào bảng response_cache)
+@st.cache_resource
+def get_response_cache():
+    """Khởi tạo cache câu trả lời Gemini; cấu hình trong mục [response_cache] của Secrets."""
+    cache_config = st.secrets.get("response_cache", {})
+    persist = str(cache_config.get("persist", False)).lower() in ("true", "1", "yes")
+    cache = ResponseCache(
+        max_bytes=int(cache_config.get("max_mb", 32)) * 1024 * 1024,
+        ttl_seconds=int(cache_config.get("ttl_hours", 24)) * 3600,
+        risk_check=has_serious_risk, # Câu hỏi chỉ có dấu hiệu mềm ("mệt mỏi", "mất ngủ") vẫn được cache
+        pool=get_db_pool() if persist else None,
+    )
+    if persist:
+        try:
+            tracing.info(f"Loaded {cache.load_from_db()} response cache entries from DB.")
+        except Exception as e:
+            tracing.error(f"Error loading response cache from DB: {type(e).__name__}: {e}")
+    return cache
 
 def get_emergency_response_message(risk_type):
     """Trả về nội dung tin nhắn khẩn cấp soạn sẵn."""
@@ -285,39 +319,67 @@ def get_emergency_response_message(risk_type):
 
 # --- Quản lý Session Chat Gemini và Lịch sử Hiển thị ---
 
-if "gemini_history" not in st.session_state:
-    st.session_state.gemini_history = []
-    print("Initialized empty display history.")
+# Lịch sử hiển thị của mọi phiên nằm trong một kho dùng chung (không nằm trong st.session_state):
+# tin nhắn lưu gọn, phiên nguội được xả khỏi bộ nhớ và nạp lại từ bảng 'conversations' khi cần
+@st.cache_resource
+def get_history_store():
+    """Khởi tạo kho lịch sử chat; cấu hình trong mục [session_store] của Secrets (nếu có)."""
+    store_config = st.secrets.get("session_store", {})
+    writer = get_message_writer()
+    return session_store.get_store(
+        pool=get_db_pool(),
+        max_bytes=int(store_config.get("max_mb", 64)) * 1024 * 1024,
+        idle_seconds=int(store_config.get("idle_minutes", 30)) * 60,
+        spilled_ttl_seconds=int(store_config.get("spilled_ttl_hours", 12)) * 3600,
+        before_spill=writer.flush if writer is not None else None,
+        time_format=chat_view.TIME_FORMAT,
+    )
 
-if "api_chat_session" not in st.session_state:
-    # Chỉ khởi tạo khi cần gửi tin nhắn đầu tiên hoặc reset
-    st.session_state.api_chat_session = None
-    print("API Chat Session placeholder created.")
+history_store = get_history_store()
+chat_history = history_store.get(current_session_id)
+session_risk = get_session_risk(chat_history)
+
+# Chỉ gửi N lượt gần nhất nguyên văn + tóm tắt các lượt cũ, để prompt không phình theo độ dài phiên
+@st.cache_resource
+def get_context_window():
+    """Cấu hình cửa sổ ngữ cảnh từ mục [context_window] của Secrets (nếu có)."""
+    window_config = st.secrets.get("context_window", {})
+    return ContextWindow(
+        recent_turns=int(window_config.get("recent_turns", 12)),
+        token_budget=int(window_config.get("token_budget", 3000)),
+        summary_budget=int(window_config.get("summary_budget", 600)),
+    )
 
 def get_api_chat_session():
-    """Lấy hoặc khởi tạo session chat với Gemini API."""
-    if st.session_state.api_chat_session is None:
-        print("API chat session is None, attempting to initialize...")
-        try:
-            # Xây dựng history cho API từ history hiển thị (loại lời chào, chuyển role)
-            api_history_for_init = []
-            for msg in st.session_state.gemini_history:
-                if msg["role"] in ["user", "assistant"] and not msg.get("is_greeting", False):
-                    api_role = "user" if msg["role"] == "user" else "model"
-                    api_history_for_init.append({"role": api_role, "parts": [{"text": msg["content"]}]})
-
-            st.session_state.api_chat_session = model.start_chat(history=api_history_for_init)
-            print("Initialized API chat session successfully.")
-        except Exception as e:
-            st.error("Lỗi khởi tạo phiên chat với AI. Vui lòng thử lại.")
-            print(f"Error initializing API chat session: {e}")
-            return None # Trả về None nếu không khởi tạo được
-    return st.session_state.api_chat_session
+    """Khởi tạo session chat với Gemini API từ cửa sổ ngữ cảnh của lịch sử hiển thị.
+
+    Phiên được dựng lại ở mỗi lượt (start_chat không gọi mạng) nên lịch sử gửi đi luôn nằm trong
+    ngân sách token, kể cả khi có lượt được trả lời bằng FAQ/cache mà không qua Gemini.
+    """
+    try:
+        # Lịch sử trước câu hỏi hiện tại (loại lời chào); tin nhắn cuối là câu hỏi đang gửi
+        prior_messages = [
+            msg for msg in chat_history[:-1]
+            if msg["role"] in ["user", "assistant"] and not msg.get("is_greeting", False)
+        ]
+        context_state = st.session_state.setdefault("context_window_state", {})
+        with tracing.span("context.build", messages=len(prior_messages)):
+            api_history, context_stats = get_context_window().build(prior_messages, context_state)
+        chat_session = model.start_chat(history=api_history) # Không giữ lại trong session_state
+        st.session_state.last_context_stats = context_stats
+        tracing.debug(f"Context window: {context_stats['verbatim_messages']} verbatim + "
+                      f"{context_stats['summarized_messages']} summarized messages, "
+                      f"~{context_stats['history_tokens']} history tokens.")
+    except Exception as e:
+        st.error("Lỗi khởi tạo phiên chat với AI. Vui lòng thử lại.")
+        tracing.error(f"Error initializing API chat session: {e}")
+        return None # Trả về None nếu không khởi tạo được
+    return chat_session
 
 # --- Giao diện Chat Chính ---
 
 # 1. Hiển thị lời chào ban đầu
-if not st.session_state.gemini_history:
+if not chat_history:
     timestamp_greet = datetime.datetime.now()
     greeting_content = (
         "Xin chào! Mình là Trợ Lý Học Đường AI, ở đây để lắng nghe và hỗ trợ bạn. "
@@ -325,25 +387,12 @@ if not st.session_state.gemini_history:
         "**Lưu ý:** Mình chỉ là AI hỗ trợ, không thay thế chuyên gia tâm lý. "
         "Nếu bạn đang gặp khủng hoảng, hãy liên hệ ngay với người lớn tin cậy hoặc [Đường dây nóng hỗ trợ](#). <span style='color:red; font-weight:bold;'>(Cần thay link/số thật)</span>"
     )
-    greeting_message = {
-        "role": "assistant", "content": greeting_content,
-        "timestamp": timestamp_greet, "is_greeting": True
-    }
-    st.session_state.gemini_history.append(greeting_message)
-    print("Added initial greeting message to display history.")
-
-# 2. Hiển thị lịch sử chat
-for message in st.session_state.gemini_history:
-    role = message["role"]
-    avatar = "🧑‍🎓" if role == "user" else "🤖"
-    with st.chat_message(name=role, avatar=avatar):
-        # Cho phép HTML cho link trong lời chào, nhưng cẩn thận với input người dùng
-        allow_html = message.get("is_greeting", False) or message.get("is_emergency", False)
-        st.markdown(message["content"], unsafe_allow_html=allow_html)
-        if "timestamp" in message:
-             st.caption(message["timestamp"].strftime('%H:%M:%S %d/%m/%Y'))
-        if message.get("is_emergency", False):
-             st.error("❗ Hãy ưu tiên liên hệ hỗ trợ khẩn cấp theo thông tin trên.")
+    history_store.append(current_session_id, "assistant", greeting_content, timestamp_greet, is_greeting=True)
+    tracing.debug("Added initial greeting message to display history.")
+
+# 2. Hiển thị lịch sử chat (chỉ N tin nhắn gần nhất; tin cũ hơn mở thêm bằng nút)
+with tracing.span("render.history", messages=len(chat_history)):
+    chat_view.render_chat_window(chat_history, key="chat_history")
 
 # 3. Ô nhập liệu và xử lý
 
@@ -359,14 +408,12 @@ if user_prompt:
     # Hoặc tạo một ID ẩn danh riêng lưu trong session state nếu cần phân biệt hơn chút.
     if "anonymous_user_id" not in st.session_state:
          st.session_state.anonymous_user_id = f"anon-{str(uuid.uuid4())[:8]}" # Ví dụ: anon-abcdef12
-         print(f"Generated anonymous user ID: {st.session_state.anonymous_user_id}")
+         tracing.debug(f"Generated anonymous user ID: {st.session_state.anonymous_user_id}")
     user_id_to_save = st.session_state.anonymous_user_id
     # ------------------------------------------
 
     # a. Lưu và Hiển thị tin nhắn người dùng
-    timestamp_user = datetime.datetime.now()
-    user_message = {"role": "user", "content": user_prompt, "timestamp": timestamp_user}
-    st.session_state.gemini_history.append(user_message)
+    user_message = history_store.append(session_id_to_save, "user", user_prompt)
     # *** GỌI HÀM LƯU TIN NHẮN USER (với ID tự động) ***
     save_message_to_db(
         session_id=session_id_to_save,
@@ -374,51 +421,123 @@ if user_prompt:
         sender="user",
         content=user_prompt
     )
-    # Hiển thị tin nhắn user (như cũ)
-    with st.chat_message(name="user", avatar="🧑‍🎓"):
-        st.markdown(user_prompt)
-        st.caption(timestamp_user.strftime('%H:%M:%S %d/%m/%Y'))
+    # Hiển thị tin nhắn user
+    chat_view.render_message(user_message)
 
     # b. Xử lý prompt: Kiểm tra rủi ro trước
     ai_response_content = None
     is_emergency_response = False
-    detected_risk = detect_risk(user_prompt)
+    is_faq_response = False # Trả lời bằng FAQ trong knowledge_base (không gọi Gemini)
+    detected_risk, risk_matches = detect_risk(user_prompt)
+    cumulative_risk = update_session_risk(session_risk, risk_matches, detected_risk)
     created_alert_id = None # <<< THÊM HOẶC ĐẢM BẢO DÒNG NÀY CÓ Ở ĐÂY
-    with st.spinner("Trợ lý AI đang xử lý..."):
-        if detected_risk:
+    ai_stream_box = None # Container chat_message đã hiển thị câu trả lời dạng stream (nếu có)
+    if detected_risk:
+        with st.spinner("Trợ lý AI đang xử lý..."):
             # ... (logic xử lý rủi ro) ...
             is_emergency_response = True
             ai_response_content = get_emergency_response_message(detected_risk)
-            # Tạo cảnh báo trong DB (với ID tự động)
-            create_alert_in_db(
+            # Tạo cảnh báo trong DB (đồng bộ, với ID tự động) - ID dùng để liên kết tin nhắn trả lời
+            created_alert_id = create_alert_in_db(
                 session_id=session_id_to_save,
                 reason=f"Phát hiện rủi ro: {detected_risk}",
                 snippet=user_prompt[:500],
                 priority=1,
                 user_id_associated=user_id_to_save # Dùng ID ẩn danh
             )
+    else:
+        if cumulative_risk:
+            # Không gắn related_alert_id vào câu trả lời: đây không phải phản hồi khẩn cấp, cảnh báo đã có chat_session_id
+            create_alert_in_db(
+                session_id=session_id_to_save,
+                reason="Rủi ro tích lũy trong phiên",
+                snippet=f"[điểm {session_risk.score:.2f}: {', '.join(session_risk.recent)}] {user_prompt}"[:500],
+                priority=2,
+                user_id_associated=user_id_to_save
+            )
+        # Tra thư viện FAQ (knowledge_base) trước khi gọi Gemini - trừ lượt vừa vượt ngưỡng rủi ro tích lũy:
+        # câu trả lời soạn sẵn / dùng lại không tính đến ngữ cảnh đáng lo của phiên, nên để Gemini trả lời
+        knowledge = knowledge_index.get_index(get_db_pool())
+        kb_mode, kb_doc, kb_confidence = None, None, 0.0
+        if not cumulative_risk:
+            with tracing.span("knowledge.lookup"):
+                kb_mode, kb_doc, kb_confidence = knowledge.lookup(user_prompt)
+        response_cache = get_response_cache()
+        history_before_prompt = chat_history[:-1] # Lịch sử trước câu hỏi hiện tại
+        cached_response = None
+        if kb_mode != "answer" and not cumulative_risk:
+            with tracing.span("response_cache.lookup"):
+                cached_response = response_cache.get(user_prompt, history_before_prompt)
+        if kb_mode == "answer":
+            # Câu hỏi đã có đáp án của tư vấn viên: trả lời ngay, không gọi Gemini
+            ai_response_content = kb_doc["answer"]
+            is_faq_response = True
+            # Ước tính bằng độ trễ mô hình trung bình của cả tiến trình (không phụ thuộc phiên này đã gọi Gemini chưa)
+            avg_model_ms = get_gemini_client().stats()["avg_model_ms"]
+            if avg_model_ms:
+                knowledge.record_saved_latency(avg_model_ms)
+            tracing.info(f"Answered from knowledge base: faq_id={kb_doc['id']}, confidence={kb_confidence:.2f}")
+        elif cached_response is not None:
+            # Câu hỏi giống (hoặc gần giống) câu đã được trả lời gần đây: dùng lại câu trả lời
+            ai_response_content = cached_response
+            tracing.info("Answered from response cache.")
         else:
-            # ... (logic gọi Gemini) ...
-             chat_session = get_api_chat_session()
-             if chat_session:
-                 try:
-                     response = chat_session.send_message(user_prompt)
-                     ai_response_content = response.text
-                     print("Received response from Gemini.")
-                 except Exception as e:
-                     st.error(f"Đã xảy ra lỗi khi giao tiếp với AI Gemini: {e}")
-                     print(f"Error calling Gemini API: {e}")
-             else:
-                 ai_response_content = "Xin lỗi, đã có lỗi xảy ra với phiên chat AI."
+            # ... (logic gọi Gemini, hiển thị dần từng phần câu trả lời) ...
+            prompt_to_send = user_prompt
+            if kb_mode == "ground":
+                prompt_to_send = knowledge_index.grounded_prompt(user_prompt, kb_doc)
+                tracing.info(f"Grounding Gemini with knowledge base: faq_id={kb_doc['id']}, confidence={kb_confidence:.2f}")
+            chat_session = get_api_chat_session()
+            if chat_session:
+                ai_stream_box = st.chat_message(name="assistant", avatar="🤖")
+                with ai_stream_box:
+                    stream_placeholder = st.empty()
+                    stream_placeholder.caption("Trợ lý AI đang xử lý...")
+                    try:
+                        with tracing.span("gemini.call", session=session_id_to_save):
+                            ai_response_content, stream_timings = get_gemini_client().stream_reply(
+                                chat_session, prompt_to_send,
+                                on_text=lambda text_so_far: stream_placeholder.markdown(text_so_far + "▌")
+                            )
+                        tracing.observe("gemini.queue_wait", stream_timings["queue_wait"] * 1000)
+                        tracing.observe("gemini.ttft", stream_timings["ttft"] * 1000)
+                        st.session_state.last_gemini_timings = stream_timings
+                        # Lưu vào cache dùng chung - trừ lượt có rủi ro tích lũy (câu trả lời gắn với ngữ cảnh phiên)
+                        response_cache.put(user_prompt, history_before_prompt, ai_response_content,
+                                           risk_flagged=bool(detected_risk or cumulative_risk))
+                        # Token đầu vào của lượt này: số Gemini báo về, hoặc ước lượng nếu API không trả về
+                        prompt_tokens = stream_timings.get("prompt_tokens")
+                        if prompt_tokens is None:
+                            prompt_tokens = st.session_state.last_context_stats["history_tokens"] + estimate_tokens(prompt_to_send)
+                        # Theo dõi theo từng lượt (chỉ giữ các lượt gần nhất)
+                        st.session_state.setdefault("prompt_token_log", deque(maxlen=PROMPT_TOKEN_LOG_SIZE)).append(prompt_tokens)
+                        tracing.observe_value("gemini.prompt_tokens", prompt_tokens) # Histogram dùng chung: xuất metrics + trang Admin
+                        tracing.debug(f"Received response from Gemini (stream): queue={stream_timings['queue_wait']*1000:.0f}ms, "
+                                      f"TTFT={stream_timings['ttft']*1000:.0f}ms, total={stream_timings['total']*1000:.0f}ms, "
+                                      f"attempts={stream_timings['attempts']}, chunks={stream_timings['chunks']}, "
+                                      f"prompt_tokens={prompt_tokens}")
+                    except (GeminiBusy, GeminiTimeout) as e:
+                        stream_placeholder.empty()
+                        st.warning("Trợ lý AI đang có nhiều người hỏi cùng lúc nên phản hồi chậm. Bạn thử gửi lại sau ít phút nhé.")
+                        tracing.warning(f"Gemini call not completed: {type(e).__name__}: {e}")
+                        ai_response_content = None
+                    except Exception as e:
+                        stream_placeholder.empty()
+                        if is_rate_limited(e):
+                            st.warning("Trợ lý AI đang tạm quá tải. Bạn thử gửi lại sau ít phút nhé.")
+                        else:
+                            st.error("Đã xảy ra lỗi khi giao tiếp với Trợ lý AI. Bạn thử lại sau nhé.")
+                        tracing.error(f"Error calling Gemini API: {type(e).__name__}: {e}")
+                        ai_response_content = None
+            else:
+                ai_response_content = "Xin lỗi, đã có lỗi xảy ra với phiên chat AI."
 
     # c. Hiển thị và Lưu tin nhắn AI (nếu có phản hồi)
     if ai_response_content:
-        timestamp_ai = datetime.datetime.now()
-        ai_message = {
-            "role": "assistant", "content": ai_response_content,
-            "timestamp": timestamp_ai, "is_emergency": is_emergency_response
-        }
-        st.session_state.gemini_history.append(ai_message)
+        ai_message = history_store.append(
+            session_id_to_save, "assistant", ai_response_content,
+            is_emergency=is_emergency_response, is_faq=is_faq_response
+        )
         # *** GỌI HÀM LƯU TIN NHẮN AI (với ID tự động) ***
         save_message_to_db( # <<< SỬA DÒNG NÀY VÀ CÁC DÒNG SAU
             session_id=session_id_to_save,
@@ -429,15 +548,16 @@ if user_prompt:
             # XÓA DÒNG: is_emergency=is_emergency_response
         )
 
-        # Hiển thị tin nhắn AI
-        with st.chat_message(name="assistant", avatar="🤖"):
-             # Dùng created_alert_id để quyết định unsafe_allow_html và hiển thị lỗi
-            allow_html_for_ai = (created_alert_id is not None)
-            st.markdown(ai_response_content, unsafe_allow_html=allow_html_for_ai)
-            st.caption(timestamp_ai.strftime('%H:%M:%S %d/%m/%Y'))
-            if created_alert_id is not None: # Kiểm tra bằng alert ID thay vì biến is_emergency cũ
-                st.error("❗ Hãy ưu tiên liên hệ hỗ trợ khẩn cấp theo thông tin trên.")
+        # Hiển thị tin nhắn AI (nếu đã stream thì chỉ chốt nội dung cuối trong cùng bong bóng chat)
+        if ai_stream_box is not None:
+            stream_placeholder.markdown(ai_response_content)
+            with ai_stream_box:
+                st.caption(ai_message["time_str"])
+        else:
+            chat_view.render_message(ai_message)
     else:
+        if ai_stream_box is not None:
+            stream_placeholder.empty() # Xóa dòng "đang xử lý" nếu stream không trả về nội dung
          # Chỉ hiển thị cảnh báo nếu không phải lỗi kết nối DB đã báo trước đó
         if db_secrets: # Nếu cấu hình DB có vẻ ổn nhưng AI vẫn không phản hồi
              st.warning("Trợ Lý AI hiện không thể phản hồi. Vui lòng thử lại sau.")
@@ -0,0 +1,73 @@
+# benchmarks/bench_db_pool.py
+# Kiểm tra pool kết nối dưới tải đồng thời với một PostgreSQL cục bộ.
+# Chạy: DATABASE_URL=postgresql://postgres@localhost/postgres python benchmarks/bench_db_pool.py
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2  # noqa: E402
+
+from db_pool import ConnectionPool  # noqa: E402
+
+
+def worker(pool, iterations, errors):
+    for i in range(iterations):
+        try:
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    if i % 10 == 0:
+                        # Cố tình làm hỏng giao dịch: pool phải rollback khi trả kết nối
+                        try:
+                            cursor.execute("SELECT 1/0")
+                        except psycopg2.Error:
+                            continue
+                    cursor.execute("INSERT INTO pool_bench (worker) VALUES (%s)", (threading.get_ident(),))
+                conn.commit()
+        except Exception as e:
+            errors.append(e)
+
+
+def main(threads=32, iterations=200, maxconn=8):
+    dsn = os.environ.get("DATABASE_URL", "postgresql://postgres@localhost/postgres")
+    pool = ConnectionPool(minconn=2, maxconn=maxconn, dsn=dsn)
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS pool_bench")
+            cursor.execute("CREATE TABLE pool_bench (id SERIAL PRIMARY KEY, worker BIGINT)")
+        conn.commit()
+
+    # Giết một kết nối đang rảnh để kiểm tra reconnect trong suốt
+    conn = pool.getconn()
+    conn.close()
+    pool.putconn(conn)
+
+    errors = []
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(pool, iterations, errors)) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM pool_bench")
+            inserted = cursor.fetchone()[0]
+            cursor.execute("DROP TABLE pool_bench")
+        conn.commit()
+    pool.closeall()
+
+    expected = threads * (iterations - len(range(0, iterations, 10)))
+    print(f"Threads={threads}, maxconn={maxconn}, elapsed={elapsed:.2f}s, inserts/s={inserted / elapsed:.0f}")
+    print(f"Inserted {inserted}/{expected} rows, errors={len(errors)}, pool stats={pool.stats}")
+    if errors or inserted != expected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
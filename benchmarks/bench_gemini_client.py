@@ -0,0 +1,78 @@
+# benchmarks/bench_gemini_client.py
+# Tải đồng thời lên GeminiClient với mô hình giả lập có độ trễ dao động và lỗi 429,
+# để xem thời gian chờ hàng đợi (tách riêng khỏi độ trễ mô hình), số lần thử lại và lượt thất bại.
+# Chạy: python benchmarks/bench_gemini_client.py [--users 40] [--max-in-flight 8] [--rate-limit 0.2]
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gemini import FakeGenerativeModel  # noqa: E402
+from gemini_client import GeminiBusy, GeminiClient, GeminiTimeout  # noqa: E402
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tải đồng thời lên GeminiClient với mô hình Gemini giả lập.")
+    parser.add_argument("--users", type=int, default=40, help="Số học sinh gửi tin cùng lúc")
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--rate-limit", type=float, default=0.2, help="Xác suất một lượt gọi bị 429")
+    parser.add_argument("--deadline", type=float, default=20.0)
+    args = parser.parse_args(argv)
+
+    model = FakeGenerativeModel(first_token_delay=0.3, chunk_delay=0.01, chunk_count=20,
+                                latency_jitter=0.3, rate_limit_rate=args.rate_limit)
+    client = GeminiClient(max_in_flight=args.max_in_flight, queue_timeout=args.deadline,
+                          deadline=args.deadline, backoff_base=0.2)
+    results = []
+    outcomes = {"ok": 0, "busy": 0, "timeout": 0, "error": 0}
+    lock = threading.Lock()
+
+    def student():
+        try:
+            _, timings = client.stream_reply(model.start_chat(), "Em bị áp lực thi cử quá")
+            with lock:
+                outcomes["ok"] += 1
+                results.append(timings)
+        except GeminiBusy:
+            outcome = "busy"
+        except GeminiTimeout:
+            outcome = "timeout"
+        except Exception:
+            outcome = "error"
+        else:
+            return
+        with lock:
+            outcomes[outcome] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=student) for _ in range(args.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.users} lượt, max_in_flight={args.max_in_flight}, tỉ lệ 429={args.rate_limit:.0%}: {elapsed:.2f}s")
+    print(f"Kết quả: {outcomes}")
+    for label, key in (("Chờ hàng đợi", "queue_wait"), ("Thử lại + backoff", "retry_wait"),
+                       ("Mô hình - TTFT", "ttft"), ("Mô hình - tổng", "total")):
+        values = [t[key] * 1000 for t in results]
+        print(f"{label:18}: p50={_percentile(values, 50):7.1f} ms  p95={_percentile(values, 95):7.1f} ms  "
+              f"trung bình={statistics.mean(values) if values else 0:7.1f} ms")
+    print(f"Số lần thử: tối đa {max((t['attempts'] for t in results), default=0)}; thống kê client: {client.stats()}")
+
+
+if __name__ == "__main__":
+    main()
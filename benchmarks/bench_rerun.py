@@ -0,0 +1,90 @@
+# benchmarks/bench_rerun.py
+# Đo chi phí chạy lại script (Streamlit chạy lại toàn bộ script ở mỗi tương tác):
+# lần chạy đầu (cold start, gồm import) và các lần rerun "ấm" sau đó, bằng streamlit AppTest.
+# Không gọi Gemini/CSDL: chỉ dùng API key giả và không cấu hình [database].
+# Với --admin: đo trang Admin ở trạng thái đã đăng nhập; không có CSDL nên trang dừng ngay sau
+# phần xác thực/khởi tạo, tức là số đo chính là chi phí trước khi vào nội dung dashboard.
+# Chạy: python benchmarks/bench_rerun.py [--admin] [--reruns 20] [--budget-ms 20]
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from streamlit.runtime.scriptrunner import script_cache, script_runner  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+# Đo riêng thời gian thực thi script (AppTest.run() còn gồm thời gian chờ/poll của chính AppTest)
+_script_ms = []
+_exec = script_runner.exec_func_with_error_handling
+
+
+def _timed_exec(func, ctx):
+    started = time.perf_counter()
+    try:
+        return _exec(func, ctx)
+    finally:
+        _script_ms.append((time.perf_counter() - started) * 1000)
+
+
+script_runner.exec_func_with_error_handling = _timed_exec
+
+# AppTest tạo ScriptCache mới ở mỗi lần run nên biên dịch lại script mỗi lần; server thật thì giữ
+# bytecode giữa các lần rerun - giữ lại ở đây để số đo rerun ấm sát với server
+_bytecode = {}
+_get_bytecode = script_cache.ScriptCache.get_bytecode
+
+
+def _cached_get_bytecode(self, script_path):
+    if script_path not in _bytecode:
+        _bytecode[script_path] = _get_bytecode(self, script_path)
+    return _bytecode[script_path]
+
+
+script_cache.ScriptCache.get_bytecode = _cached_get_bytecode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đo thời gian cold start và rerun của app.py.")
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, default=20.0, help="Ngân sách cho một lần rerun ấm (p95)")
+    parser.add_argument("--admin", action="store_true", help="Đo trang Admin (đã đăng nhập) thay vì app.py")
+    parser.add_argument("--app", help="Đường dẫn script cần đo (mặc định: app.py hoặc trang Admin)")
+    args = parser.parse_args(argv)
+
+    default_app = os.path.join("pages", "_Admin_Dashboard.py") if args.admin else "app.py"
+    args.app = os.path.abspath(args.app or os.path.join(ROOT, default_app))
+    os.chdir(ROOT) # config.yaml, .streamlit/ được đọc theo thư mục chạy
+    app_test = AppTest.from_file(args.app, default_timeout=120)
+    app_test.secrets["GOOGLE_API_KEY"] = "bench-key"
+    if args.admin:
+        app_test.secrets["cookie"] = {"key": "bench-cookie-key-" + "x" * 32}
+        app_test.session_state["authentication_status"] = True
+        app_test.session_state["name"] = "Bench Admin"
+        app_test.session_state["username"] = "adminuser"
+        app_test.session_state["logout"] = None
+
+    app_test.run()
+    if app_test.exception:
+        print(f"App raised: {app_test.exception}")
+        return 1
+    cold_ms = _script_ms[-1]
+
+    for _ in range(args.reruns):
+        app_test.run()
+    warm = sorted(_script_ms[-args.reruns:])
+    p95 = warm[min(len(warm) - 1, int(round(0.95 * (len(warm) - 1))))]
+
+    print(f"Cold start (lần chạy đầu, gồm import): {cold_ms:8.1f} ms")
+    print(f"Rerun ấm: p50={statistics.median(warm):.1f} ms  p95={p95:.1f} ms  max={warm[-1]:.1f} ms ({args.reruns} lần)")
+    within = p95 <= args.budget_ms
+    print(f"Ngân sách rerun {args.budget_ms:.0f} ms (p95): {'ĐẠT' if within else 'VƯỢT'}")
+    return 0 if within else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# benchmarks/bench_risk.py
+# So sánh detect_risk cũ (vòng lặp `keyword in text`) với RiskDetector khi số từ khóa tăng dần.
+# Chạy: python benchmarks/bench_risk.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from risk_detector import RISK_KEYWORDS, RiskDetector  # noqa: E402
+
+MESSAGES = [
+    "Dạo này em áp lực thi cử quá, không biết chọn ngành gì cho phù hợp nữa.",
+    "Mình bị bạn cùng lớp bắt nạt mấy hôm nay, mệt mỏi lắm.",
+    "Em muon chet qua, khong ai hieu em ca.",
+    "Cho em hỏi cách ôn tập môn Toán hiệu quả trong 2 tuần với ạ? " * 4,
+    "Em muốn chet cho xong, tự tu là hết.", # Gõ thiếu dấu một phần
+]
+
+# Câu thăm dò: (văn bản, các từ khóa phải tìm thấy) - gồm không dấu, thiếu dấu một phần và dấu sai
+PROBES = [
+    ("Em muon chet qua", ["muốn chết"]),
+    ("Em muốn chet qua", ["muốn chết"]),
+    ("em muôn chết", ["muốn chết"]),
+    ("Mình nghĩ tới chuyện tự tu", ["tự tử"]),
+    ("tu  tu", ["tự tử"]),
+    ("Hôm qua em bi đanh", ["bị đánh"]),
+    ("Cứ làm từ từ thôi", []),
+    ("TỪ TỪ đã", []),
+    # Chỉ khớp trọn từ: các cụm thường gặp chứa "tu tu" khi bỏ dấu
+    ("Em muốn rèn tư tưởng tích cực", []),
+    ("tu tuong chinh tri", []),
+    ("Em học cách tự túc", []),
+    ("song tu tuc", []),
+    ("Em nghĩ đến chuyện tự tử.", ["tự tử"]),
+]
+
+
+def legacy_detect_risk(text, keywords_by_category):
+    """Bản sao hàm detect_risk ban đầu trong app.py (trả về loại đầu tiên khớp)."""
+    text_lower = text.lower()
+    for risk_type, keywords in keywords_by_category.items():
+        for keyword in keywords:
+            if keyword in text_lower:
+                return risk_type
+    return None
+
+
+def synthetic_keywords(total):
+    """Mở rộng RISK_KEYWORDS bằng các cụm từ giả để mô phỏng danh sách hàng nghìn mục."""
+    keywords = {category: list(words) for category, words in RISK_KEYWORDS.items()}
+    filler = keywords.setdefault("mở rộng", [])
+    i = 0
+    while sum(len(words) for words in keywords.values()) < total:
+        filler.append(f"cụm từ nguy cơ số {i} zq")
+        i += 1
+    return keywords
+
+
+def check_probes(detector):
+    """In các câu thăm dò cho kết quả khác mong đợi; trả về số câu sai."""
+    failures = 0
+    for text, expected in PROBES:
+        found = [match.keyword for match in detector.find_all(text)]
+        if found != expected:
+            failures += 1
+            print(f"PROBE FAILED: {text!r} -> {found}, expected {expected}")
+    return failures
+
+
+def main(repeat=200):
+    failures = check_probes(RiskDetector(RISK_KEYWORDS))
+    print(f"Probes: {len(PROBES) - failures}/{len(PROBES)} ok")
+    print(f"{'keywords':>9} | {'legacy µs/msg':>14} | {'compiled µs/msg':>16} | {'build ms':>9}")
+    for total in (12, 100, 1000, 5000):
+        keywords = synthetic_keywords(total)
+        build = timeit.timeit(lambda: RiskDetector(keywords), number=1)
+        detector = RiskDetector(keywords)
+        legacy = timeit.timeit(lambda: [legacy_detect_risk(m, keywords) for m in MESSAGES], number=repeat)
+        compiled = timeit.timeit(lambda: [detector.find_all(m) for m in MESSAGES], number=repeat)
+        per_msg = repeat * len(MESSAGES) / 1e6
+        print(f"{total:>9} | {legacy / per_msg:>14.1f} | {compiled / per_msg:>16.1f} | {build * 1000:>9.1f}")
+    print("Lưu ý: bản cũ dừng ở kết quả đầu tiên và bỏ sót biến thể không dấu; bản biên dịch trả về mọi kết quả.")
+
+
+if __name__ == "__main__":
+    main()
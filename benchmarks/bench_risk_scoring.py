@@ -0,0 +1,70 @@
+# benchmarks/bench_risk_scoring.py
+# Chi phí chấm điểm rủi ro cho MỘT tin nhắn mới khi phiên dài dần: cập nhật dần (RiskScorer.update)
+# so với cách quét lại toàn bộ lịch sử ở mỗi lượt. Bản cập nhật dần phải giữ gần như không đổi.
+# Chạy: python benchmarks/bench_risk_scoring.py [--repeat 200]
+
+import argparse
+import math
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from risk_detector import RISK_KEYWORDS, SIGNAL_KEYWORDS, RiskDetector, RiskScorer  # noqa: E402
+
+MESSAGES = [
+    "Dạo này em mệt lắm, bài tập nhiều quá.",
+    "Cho em hỏi cách ôn tập môn Toán hiệu quả trong 2 tuần với ạ?",
+    "Ở lớp chẳng ai nói chuyện với em, cảm giác không ai cần mình.",
+    "Em nên chọn khối A hay khối D để thi đại học ạ?",
+    "Tối nào em cũng mất ngủ, sáng dậy không muốn đi học.",
+]
+
+
+def full_rescan_score(detector, scorer, history, now):
+    """Cách làm thẳng: quét lại mọi tin nhắn của phiên và cộng điểm đã giảm theo thời gian."""
+    rate = math.log(2) / scorer.half_life_seconds
+    score = 0.0
+    for text, created in history:
+        keywords = {}
+        for match in detector.find_all(text):
+            keywords[match.keyword] = scorer.weights.get(match.category, scorer.default_weight)
+        score += sum(keywords.values()) * math.exp(-rate * (now - created))
+    return score
+
+
+def percentile(samples, q):
+    return statistics.quantiles(samples, n=100)[q - 1] if len(samples) > 1 else samples[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chi phí chấm điểm rủi ro mỗi tin nhắn theo độ dài phiên.")
+    parser.add_argument("--repeat", type=int, default=200, help="Số tin nhắn mới đo ở mỗi độ dài phiên")
+    args = parser.parse_args(argv)
+
+    detector = RiskDetector({**RISK_KEYWORDS, **SIGNAL_KEYWORDS})
+    scorer = RiskScorer()
+    print(f"{'messages':>9} | {'incremental p50 µs':>19} | {'p95 µs':>8} | {'full rescan p50 µs':>19}")
+    for length in (10, 100, 1000, 5000):
+        history = [(MESSAGES[i % len(MESSAGES)], i * 60.0) for i in range(length)]
+        state = scorer.replay(detector, history)
+        incremental, rescan = [], []
+        for i in range(args.repeat):
+            text, now = MESSAGES[i % len(MESSAGES)], (length + i) * 60.0
+            started = time.perf_counter()
+            scorer.update(state, detector.find_all(text), now)
+            incremental.append((time.perf_counter() - started) * 1e6)
+        # Quét lại tốn O(độ dài phiên) mỗi lượt: đo ít lần hơn cho phiên dài
+        for i in range(max(3, args.repeat * 10 // length)):
+            started = time.perf_counter()
+            full_rescan_score(detector, scorer, history, (length + i) * 60.0)
+            rescan.append((time.perf_counter() - started) * 1e6)
+        print(f"{length:>9} | {percentile(incremental, 50):>19.1f} | {percentile(incremental, 95):>8.1f} | "
+              f"{percentile(rescan, 50):>19.1f}")
+    print("Lưu ý: replay (dựng lại điểm sau khi nạp lại phiên) là O(độ dài phiên) nhưng chỉ chạy một lần mỗi lần nạp.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# benchmarks/bench_stream.py
+# So sánh độ trễ người dùng cảm nhận giữa gọi Gemini chặn (blocking) và stream.
+# Chạy: python benchmarks/bench_stream.py
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gemini import FakeGenerativeModel  # noqa: E402
+from gemini_client import stream_reply  # noqa: E402
+
+
+def main(runs=5):
+    model = FakeGenerativeModel()
+    blocking, ttfts, totals = [], [], []
+    for _ in range(runs):
+        session = model.start_chat()
+        started = time.perf_counter()
+        session.send_message("Em bị áp lực thi cử quá")
+        blocking.append(time.perf_counter() - started)
+
+        session = model.start_chat()
+        _, timings = stream_reply(session, "Em bị áp lực thi cử quá")
+        ttfts.append(timings["ttft"])
+        totals.append(timings["total"])
+
+    avg = lambda xs: sum(xs) / len(xs)  # noqa: E731
+    print(f"Blocking send_message : {avg(blocking) * 1000:8.1f} ms tới khi hiển thị")
+    print(f"Stream - TTFT         : {avg(ttfts) * 1000:8.1f} ms tới khi hiển thị")
+    print(f"Stream - tổng thời gian: {avg(totals) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
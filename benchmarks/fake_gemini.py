@@ -0,0 +1,90 @@
+# benchmarks/fake_gemini.py
+# Mô hình Gemini giả lập chạy cục bộ, dùng để đo đạc mà không cần gọi API thật.
+
+import random
+import time
+
+
+class FakeRateLimitError(Exception):
+    """Giả lập google.api_core.exceptions.ResourceExhausted (HTTP 429)."""
+    code = 429
+
+
+class FakeDeadlineExceeded(Exception):
+    """Giả lập google.api_core.exceptions.DeadlineExceeded (HTTP 504) khi vượt request_options timeout."""
+    code = 504
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResponse:
+    """Giả lập response của google-generativeai (cả chế độ stream và không stream)."""
+
+    def __init__(self, chunks, first_token_delay, chunk_delay, stream):
+        self._chunks = chunks
+        self._first_token_delay = first_token_delay
+        self._chunk_delay = chunk_delay
+        self._stream = stream
+        self.text = "".join(chunks)
+
+    def __iter__(self):
+        for i, chunk in enumerate(self._chunks):
+            time.sleep(self._first_token_delay if i == 0 else self._chunk_delay)
+            yield FakeChunk(chunk)
+
+    def resolve(self):
+        pass
+
+
+class FakeChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream=False, request_options=None):
+        timeout = (request_options or {}).get("timeout")
+        first_token_delay = self.model.first_token_delay + random.uniform(0, self.model.latency_jitter)
+        if self.model.should_rate_limit():
+            time.sleep(self.model.error_delay)
+            raise FakeRateLimitError("429 Resource has been exhausted (e.g. check quota).")
+        if timeout is not None and first_token_delay > timeout:
+            time.sleep(timeout)
+            raise FakeDeadlineExceeded("504 Deadline Exceeded")
+        chunks = self.model.reply_chunks(content)
+        self.history.append({"role": "user", "parts": [{"text": content}]})
+        self.history.append({"role": "model", "parts": [{"text": "".join(chunks)}]})
+        if stream:
+            return FakeResponse(chunks, first_token_delay, self.model.chunk_delay, stream=True)
+        # Không stream: chờ đủ thời gian sinh toàn bộ câu trả lời rồi mới trả về
+        time.sleep(first_token_delay + self.model.chunk_delay * (len(chunks) - 1))
+        return FakeResponse(chunks, 0, 0, stream=False)
+
+
+class FakeGenerativeModel:
+    """Thay thế cho genai.GenerativeModel với độ trễ cấu hình được.
+
+    `latency_jitter` cộng thêm ngẫu nhiên vào độ trễ token đầu; `rate_limit_rate` là xác suất
+    một lượt gọi bị từ chối với lỗi 429 (sau `error_delay` giây).
+    """
+
+    def __init__(self, first_token_delay=0.4, chunk_delay=0.05, chunk_count=40, chunk_text="lorem ipsum ",
+                 latency_jitter=0.0, rate_limit_rate=0.0, error_delay=0.05):
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+        self.chunk_count = chunk_count
+        self.chunk_text = chunk_text
+        self.latency_jitter = latency_jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.error_delay = error_delay
+
+    def should_rate_limit(self):
+        return self.rate_limit_rate > 0 and random.random() < self.rate_limit_rate
+
+    def reply_chunks(self, prompt):
+        return [self.chunk_text] * self.chunk_count
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
@@ -0,0 +1,327 @@
+# benchmarks/load_test.py
+# Mô phỏng N học sinh chat đồng thời (và vài tư vấn viên mở dashboard) trên MỘT tiến trình,
+# chạy headless bằng streamlit AppTest với mô hình Gemini giả lập và PostgreSQL cục bộ.
+# Báo cáo thông lượng và p50/p95/p99 theo từng giai đoạn, lưu kết quả JSON để so sánh giữa các commit.
+#
+# Chạy:
+#   DATABASE_URL=postgresql://postgres@localhost/postgres python benchmarks/load_test.py \
+#       --sessions 40 --turns 5 --concurrency 20 --counsellors 2
+#   python benchmarks/load_test.py --compare benchmarks/results/<file trước>.json
+# Kết quả lưu vào benchmarks/results/ (không đưa vào git) hoặc thư mục chỉ định bằng --output-dir.
+# Không có DATABASE_URL thì chạy không CSDL (chỉ đo giao diện + Gemini giả lập).
+
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2  # noqa: E402
+import streamlit as st  # noqa: E402
+from streamlit.runtime import Runtime  # noqa: E402
+from streamlit.runtime.scriptrunner import script_cache  # noqa: E402
+from streamlit.runtime.secrets import Secrets  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+import db  # noqa: E402
+import message_writer  # noqa: E402
+import migrations  # noqa: E402
+import session_store  # noqa: E402
+from benchmarks.fake_gemini import FakeGenerativeModel  # noqa: E402
+
+APP_PATH = os.path.join(ROOT, "app.py")
+ADMIN_PATH = os.path.join(ROOT, "pages", "_Admin_Dashboard.py")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+PROMPTS = [
+    "Làm sao để em tập trung học bài buổi tối?",
+    "Em nên chọn khối A hay khối D để thi đại học?",
+    "Em hay bị mất ngủ trước kỳ thi, phải làm sao?",
+    "Bạn thân giận em mà em không biết vì sao",
+    "Em muốn học lập trình thì bắt đầu từ đâu?",
+    "Bố mẹ em hay so sánh em với anh trai",
+    "Cách ôn thi môn Văn hiệu quả là gì?",
+    "Em thấy áp lực vì điểm số",
+]
+RISK_PROMPTS = [
+    "Dạo này em thấy tuyệt vọng lắm",
+    "Em bị đe dọa ở trường mấy hôm nay",
+]
+
+
+class StageRecorder:
+    """Gom độ trễ (ms) theo giai đoạn từ nhiều luồng."""
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, ms):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(ms)
+
+    def summary(self):
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        return {
+            stage: {
+                "count": len(values),
+                "p50": _percentile(values, 50),
+                "p95": _percentile(values, 95),
+                "p99": _percentile(values, 99),
+                "mean": statistics.mean(values),
+                "max": values[-1],
+            }
+            for stage, values in samples.items()
+        }
+
+
+def _percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _install_shims(secrets, model_kwargs):
+    """Cho phép nhiều AppTest chạy song song trong một tiến trình (như nhiều phiên trên một server).
+
+    AppTest vốn chạy tuần tự: mỗi lần run() gán rồi xóa Runtime._instance và tạm thay st.secrets.
+    Ở đây secrets được đặt một lần cho cả tiến trình (AppTest không cần thay), Runtime.instance()
+    dùng lại mock runtime gần nhất khi một AppTest khác vừa xóa nó, và bytecode của script được
+    biên dịch một lần (như server thật; biên dịch AST song song trên CPython 3.11 không an toàn).
+    Gemini được thay bằng FakeGenerativeModel.
+    """
+    global_secrets = Secrets()
+    global_secrets._secrets = secrets
+    st.secrets = global_secrets
+
+    last_runtime = []
+    original_instance = Runtime.instance.__func__
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_runtime[:] = [cls._instance]
+            return cls._instance
+        if last_runtime:
+            return last_runtime[0]
+        return original_instance(cls)
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(last_runtime))
+
+    bytecode, bytecode_lock = {}, threading.Lock()
+    original_get_bytecode = script_cache.ScriptCache.get_bytecode
+
+    def get_bytecode(self, script_path):
+        with bytecode_lock:
+            if script_path not in bytecode:
+                bytecode[script_path] = original_get_bytecode(self, script_path)
+            return bytecode[script_path]
+
+    script_cache.ScriptCache.get_bytecode = get_bytecode
+
+    import google.generativeai as genai
+    genai.GenerativeModel = lambda *args, **kwargs: FakeGenerativeModel(**model_kwargs)
+
+
+def _ensure_schema(database_url):
+    conn = psycopg2.connect(database_url)
+    try:
+        migrations.migrate(conn) # Cùng lược đồ + index như bản chạy thật
+    finally:
+        conn.close()
+
+
+def _count_persisted(database_url, session_ids):
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM conversations WHERE session_id = ANY(%s)", (list(session_ids),))
+            return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_student(index, args, recorder, outcome):
+    """Một học sinh: mở trang chat rồi gửi `turns` tin nhắn, nghỉ `think_time` giữa các tin."""
+    rng = random.Random(args.seed + index)
+    app_test = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+    started = time.perf_counter()
+    app_test.run()
+    recorder.record("page_load", (time.perf_counter() - started) * 1000)
+    outcome["session_ids"].append(app_test.session_state["session_id"])
+    for turn in range(args.turns):
+        risky = rng.random() < args.risk_rate
+        prompt = rng.choice(RISK_PROMPTS if risky else PROMPTS)
+        if not risky:
+            # Ít trùng lặp giữa các học sinh; câu mở đầu vẫn có thể trúng cache gần đúng (như thực tế)
+            prompt = f"{prompt} ({index}-{turn})"
+        app_test.session_state["last_gemini_timings"] = None
+        started = time.perf_counter()
+        app_test.chat_input[0].set_value(prompt).run()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if app_test.exception:
+            outcome["errors"].append(app_test.exception[0].message)
+            continue
+        recorder.record("risk_turn" if risky else "chat_turn", elapsed_ms)
+        timings = app_test.session_state["last_gemini_timings"]
+        if timings:
+            recorder.record("gemini_queue_wait", timings["queue_wait"] * 1000)
+            recorder.record("gemini_ttft", timings["ttft"] * 1000)
+            recorder.record("gemini_total", timings["total"] * 1000)
+            recorder.record("render_and_db", elapsed_ms - (timings["queue_wait"] + timings["retry_wait"] + timings["total"]) * 1000)
+        if args.think_time:
+            time.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+def run_counsellor(args, recorder, stop, outcome):
+    """Một tư vấn viên đã đăng nhập, tải lại dashboard mỗi `admin_interval` giây tới khi học sinh xong."""
+    app_test = AppTest.from_file(ADMIN_PATH, default_timeout=args.timeout)
+    app_test.session_state["authentication_status"] = True
+    app_test.session_state["name"] = "Load Test"
+    app_test.session_state["username"] = "adminuser"
+    app_test.session_state["logout"] = None
+    while not stop.is_set():
+        started = time.perf_counter()
+        app_test.run()
+        recorder.record("admin_rerun", (time.perf_counter() - started) * 1000)
+        if app_test.exception:
+            outcome["errors"].append(app_test.exception[0].message)
+        stop.wait(args.admin_interval)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(result):
+    print(f"Commit {result['commit']}: {result['sessions']} phiên x {result['config']['turns']} lượt, "
+          f"đồng thời {result['config']['concurrency']}, {result['wall_seconds']:.1f}s")
+    print(f"Thông lượng: {result['throughput_turns_per_s']:.2f} lượt/s; lỗi: {len(result['errors'])}")
+    if result.get("messages_persisted") is not None:
+        print(f"Tin nhắn đã ghi vào CSDL: {result['messages_persisted']}")
+    print(f"{'Giai đoạn':20} {'n':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for stage, stats in sorted(result["stages"].items()):
+        print(f"{stage:20} {stats['count']:6d} {stats['p50']:9.1f} {stats['p95']:9.1f} {stats['p99']:9.1f} {stats['max']:9.1f}")
+
+
+def compare(previous_path, result):
+    """In thay đổi p50/p95 so với một lần chạy đã lưu."""
+    with open(previous_path, encoding="utf-8") as file:
+        previous = json.load(file)
+    print(f"\nSo với {previous['commit']} ({os.path.basename(previous_path)}):")
+    print(f"Thông lượng: {previous['throughput_turns_per_s']:.2f} -> {result['throughput_turns_per_s']:.2f} lượt/s")
+    for stage, stats in sorted(result["stages"].items()):
+        before = previous["stages"].get(stage)
+        if before is None:
+            continue
+        print(f"{stage:20} p50 {before['p50']:8.1f} -> {stats['p50']:8.1f}   p95 {before['p95']:8.1f} -> {stats['p95']:8.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kiểm thử tải app.py + dashboard Admin với Gemini giả lập.")
+    parser.add_argument("--sessions", type=int, default=20, help="Số học sinh mô phỏng")
+    parser.add_argument("--turns", type=int, default=5, help="Số tin nhắn mỗi học sinh")
+    parser.add_argument("--concurrency", type=int, default=10, help="Số học sinh hoạt động cùng lúc")
+    parser.add_argument("--counsellors", type=int, default=1, help="Số tư vấn viên mở dashboard")
+    parser.add_argument("--admin-interval", type=float, default=2.0)
+    parser.add_argument("--think-time", type=float, default=0.5, help="Thời gian nghỉ trung bình giữa hai tin (giây)")
+    parser.add_argument("--risk-rate", type=float, default=0.1, help="Tỉ lệ tin nhắn chứa từ khóa rủi ro")
+    parser.add_argument("--first-token-delay", type=float, default=0.4)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Tỉ lệ lượt gọi Gemini giả lập bị 429")
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"))
+    parser.add_argument("--compare", help="File kết quả trước đó để so sánh")
+    parser.add_argument("--output-dir", default=RESULTS_DIR, help="Thư mục lưu file kết quả JSON")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(argv)
+
+    secrets = {
+        "GOOGLE_API_KEY": "load-test",
+        "cookie": {"key": "load-test-cookie-key-" + "x" * 32},
+        "gemini": {"max_in_flight": args.max_in_flight},
+    }
+    if args.database_url:
+        secrets["database"] = {"uri": args.database_url}
+        _ensure_schema(args.database_url)
+    else:
+        print("Không có DATABASE_URL: chạy không CSDL (tin nhắn/cảnh báo không được ghi).")
+    _install_shims(secrets, {
+        "first_token_delay": args.first_token_delay, "chunk_delay": args.chunk_delay,
+        "latency_jitter": args.first_token_delay / 2, "rate_limit_rate": args.rate_limit,
+    })
+    os.chdir(ROOT) # config.yaml được đọc theo thư mục chạy
+
+    recorder = StageRecorder()
+    outcome = {"errors": [], "session_ids": []}
+    stop = threading.Event()
+    counsellors = [
+        threading.Thread(target=run_counsellor, args=(args, recorder, stop, outcome), daemon=True)
+        for _ in range(args.counsellors)
+    ]
+    started = time.perf_counter()
+    for thread in counsellors:
+        thread.start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_student, i, args, recorder, outcome) for i in range(args.sessions)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                outcome["errors"].append(f"{type(e).__name__}: {e}")
+    wall_seconds = time.perf_counter() - started
+    stop.set()
+    for thread in counsellors:
+        thread.join(args.timeout)
+
+    stages = recorder.summary()
+    turns = sum(stages.get(stage, {}).get("count", 0) for stage in ("chat_turn", "risk_turn"))
+    messages_persisted = None
+    if args.database_url:
+        # Ghi hết lô cuối của bộ ghi nền trước khi đếm (thay vì đoán thời gian chờ)
+        writer = message_writer.shared_writer()
+        if writer is not None and not writer.flush(timeout=args.timeout):
+            outcome["errors"].append("Message writer did not flush every message before counting")
+        messages_persisted = _count_persisted(args.database_url, outcome["session_ids"])
+
+    result = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args) | {"database_url": bool(args.database_url)},
+        "sessions": args.sessions,
+        "wall_seconds": wall_seconds,
+        "throughput_turns_per_s": turns / wall_seconds if wall_seconds else 0.0,
+        "stages": stages,
+        "errors": outcome["errors"][:50],
+        "messages_persisted": messages_persisted,
+        "db_statements": db.statement_stats(),
+        "session_store": session_store.shared_stats(),
+    }
+    print_report(result)
+    if args.compare:
+        compare(args.compare, result)
+    if not args.no_save:
+        os.makedirs(args.output_dir, exist_ok=True)
+        path = os.path.join(args.output_dir, f"load_test-{datetime.datetime.now():%Y%m%d-%H%M%S}-{result['commit']}.json")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2, default=str)
+        print(f"Đã lưu kết quả: {path}")
+    return 0 if not outcome["errors"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
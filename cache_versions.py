@@ -0,0 +1,52 @@
+# cache_versions.py
+# Số phiên bản dữ liệu theo tiến trình, dùng làm khóa cache để chỉ làm mới đúng phần dữ liệu đã đổi
+# (thay cho st.cache_data.clear() xóa toàn bộ cache của mọi người dùng).
+
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_versions = defaultdict(int)
+_lookups = defaultdict(int)
+_misses = defaultdict(int)
+
+
+def version(key):
+    """Phiên bản hiện tại của một tập dữ liệu (vd: "alerts", "alert:42")."""
+    with _lock:
+        return _versions[key]
+
+
+def bump(*keys):
+    """Tăng phiên bản các tập dữ liệu vừa bị ghi; lần đọc sau sẽ dùng khóa cache mới."""
+    with _lock:
+        for key in keys:
+            _versions[key] += 1
+
+
+def lookup(cache_name, key):
+    """Ghi nhận một lần tra cache `cache_name` và trả về phiên bản hiện tại của `key`."""
+    with _lock:
+        _lookups[cache_name] += 1
+        return _versions[key]
+
+
+def record_miss(cache_name):
+    """Gọi bên trong hàm được cache: thân hàm chỉ chạy khi cache trượt (miss)."""
+    with _lock:
+        _misses[cache_name] += 1
+
+
+def cache_stats():
+    """Số lần tra, trúng (hit), trượt (miss) và tỉ lệ trúng của từng cache."""
+    with _lock:
+        stats = {}
+        for name, lookups in _lookups.items():
+            misses = min(_misses[name], lookups)
+            stats[name] = {
+                "lookups": lookups,
+                "hits": lookups - misses,
+                "misses": misses,
+                "hit_rate": (lookups - misses) / lookups if lookups else 0.0,
+            }
+        return stats
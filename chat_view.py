@@ -0,0 +1,76 @@
+# chat_view.py
+# Hiển thị lịch sử chat theo cửa sổ (N tin nhắn gần nhất + nút "tải thêm"), dùng chung cho
+# trang chat của học sinh và trình xem lịch sử trên dashboard admin.
+
+import streamlit as st
+
+DEFAULT_WINDOW = 30 # Số tin nhắn hiển thị ban đầu / số tin nhắn tải thêm mỗi lần
+TIME_FORMAT = '%H:%M:%S %d/%m/%Y' # time_str được tính MỘT lần khi tạo tin nhắn, không strftime lại mỗi lần rerun
+AVATARS = {"user": "🧑‍🎓", "assistant": "🤖"}
+FAQ_CAPTION = "📚 Trả lời từ thư viện câu hỏi thường gặp của tư vấn viên."
+EMERGENCY_NOTE = "❗ Hãy ưu tiên liên hệ hỗ trợ khẩn cấp theo thông tin trên."
+
+
+def render_message(message):
+    """Vẽ một tin nhắn dạng dict: role, content, time_str và các cờ is_greeting / is_emergency / is_faq."""
+    role = message["role"]
+    with st.chat_message(name=role, avatar=AVATARS.get(role, "🤖")):
+        # Cho phép HTML cho link trong lời chào/tin khẩn cấp, nhưng không bao giờ cho input người dùng
+        allow_html = bool(message.get("is_greeting") or message.get("is_emergency"))
+        st.markdown(message["content"], unsafe_allow_html=allow_html)
+        if message.get("time_str"):
+            st.caption(message["time_str"])
+        if message.get("is_faq"):
+            st.caption(FAQ_CAPTION)
+        if message.get("is_emergency"):
+            st.error(EMERGENCY_NOTE)
+
+
+def _show_more(state_key, window):
+    st.session_state[state_key] = st.session_state.get(state_key, window) + window
+
+
+def visible_start(key, total, window=DEFAULT_WINDOW):
+    """Vị trí tin nhắn đầu tiên cần vẽ để chỉ hiển thị `window` tin cuối (hoặc nhiều hơn nếu đã bấm
+    tải thêm) trong `total` tin; vẽ nút tải thêm tin nhắn cũ hơn nếu còn.
+
+    `key` phân biệt các cửa sổ (vd: mỗi session_id một key) để số tin đã mở không lẫn nhau.
+    """
+    state_key = f"{key}_visible"
+    visible = st.session_state.get(state_key, window)
+    start = max(0, total - visible)
+    if start > 0:
+        st.button(
+            f"⬆️ Xem tin nhắn cũ hơn ({start} tin nhắn)", key=f"{key}_show_more",
+            on_click=_show_more, args=(state_key, window)
+        )
+    return start
+
+
+def render_chat_window(messages, key, window=DEFAULT_WINDOW):
+    """Chỉ vẽ `window` tin nhắn cuối của `messages`, kèm nút tải thêm tin nhắn cũ hơn.
+
+    `messages` là list các dict (xem render_message) hoặc DataFrame có các cột tương ứng;
+    với DataFrame, chỉ phần đang hiển thị mới được chuyển thành dict.
+    """
+    start = visible_start(key, len(messages), window)
+    if hasattr(messages, "iloc"):
+        shown = messages.iloc[start:].to_dict("records")
+    else:
+        shown = messages[start:]
+    for message in shown:
+        render_message(message)
+
+
+def render_chat_stream(chunks, key, total, window=DEFAULT_WINDOW):
+    """Như render_chat_window nhưng cho lịch sử đọc dần theo khối (vd: cursor phía server).
+
+    `chunks(skip)` trả về iterator các khối tin nhắn (list dict hoặc DataFrame) bắt đầu từ tin thứ `skip`;
+    mỗi khối được vẽ ngay khi tới rồi bỏ đi, nên bộ nhớ không phụ thuộc độ dài phiên.
+    """
+    start = visible_start(key, total, window)
+    for chunk in chunks(start):
+        if hasattr(chunk, "iloc"):
+            chunk = chunk.to_dict("records")
+        for message in chunk:
+            render_message(message)
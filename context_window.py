@@ -0,0 +1,96 @@
+# context_window.py
+# Giới hạn ngữ cảnh gửi cho Gemini: giữ nguyên văn N lượt gần nhất trong một ngân sách token,
+# các lượt cũ hơn được gộp dần vào một bản tóm tắt ngắn.
+
+import re
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+
+def estimate_tokens(text):
+    """Ước lượng số token (tiếng Việt có dấu ~3 ký tự/token); đủ để theo dõi xu hướng, không cần gọi API."""
+    return max(1, len(text or "") // 3)
+
+
+def _first_sentence(text, limit):
+    sentence = _SENTENCE_RE.split((text or "").strip(), maxsplit=1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit].rstrip() + "…"
+
+
+def extractive_summary_line(message):
+    """Một dòng tóm tắt cho một tin nhắn cũ (không gọi mô hình)."""
+    if message["role"] == "user":
+        return f"- Học sinh: {_first_sentence(message['content'], 200)}"
+    return f"- Trợ lý: {_first_sentence(message['content'], 120)}"
+
+
+class ContextWindow:
+    """Dựng history cho model.start_chat từ lịch sử hiển thị, trong giới hạn token.
+
+    - `recent_turns`: số tin nhắn gần nhất luôn giữ nguyên văn (nếu vừa ngân sách).
+    - `token_budget`: trần ước lượng cho phần history (tóm tắt + nguyên văn).
+    - `summary_budget`: trần cho bản tóm tắt; dòng tóm tắt cũ nhất bị bỏ khi vượt.
+
+    Trạng thái (bản tóm tắt và vị trí đã gộp tới) nằm trong dict `state` do người gọi giữ
+    (vd: st.session_state), nên mỗi tin nhắn chỉ được tóm tắt đúng một lần.
+    """
+
+    def __init__(self, recent_turns=12, token_budget=3000, summary_budget=600, summarize=extractive_summary_line):
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.summarize = summarize
+
+    def _fold(self, state, messages):
+        lines = state.setdefault("summary_lines", [])
+        for message in messages:
+            line = self.summarize(message)
+            if line:
+                lines.append(line)
+        while lines and sum(estimate_tokens(line) for line in lines) > self.summary_budget:
+            lines.pop(0)
+
+    def build(self, messages, state):
+        """Trả về (api_history, stats) cho các tin nhắn `messages` (không gồm câu hỏi hiện tại).
+
+        `messages` là danh sách {"role": "user"|"assistant", "content": ...} đã lọc lời chào.
+        stats gồm history_tokens, summary_tokens, verbatim_messages, summarized_messages.
+        """
+        folded_upto = state.get("folded_upto", 0)
+        if folded_upto > len(messages): # Lịch sử bị reset
+            folded_upto = 0
+            state["summary_lines"] = []
+
+        # Chọn phần nguyên văn: tối đa recent_turns tin nhắn cuối, bớt dần nếu vượt ngân sách
+        summary_tokens = sum(estimate_tokens(line) for line in state.get("summary_lines", []))
+        start = max(folded_upto, len(messages) - self.recent_turns)
+        while start < len(messages) and (
+            summary_tokens + sum(estimate_tokens(m["content"]) for m in messages[start:]) > self.token_budget
+        ):
+            start += 1
+        # Gemini yêu cầu history bắt đầu bằng lượt của người dùng
+        while start < len(messages) and messages[start]["role"] != "user":
+            start += 1
+
+        if start > folded_upto:
+            self._fold(state, messages[folded_upto:start])
+            state["folded_upto"] = start
+
+        api_history = []
+        summary_lines = state.get("summary_lines", [])
+        if summary_lines:
+            summary_text = "Tóm tắt phần trước của cuộc trò chuyện (để bạn nắm ngữ cảnh):\n" + "\n".join(summary_lines)
+            api_history.append({"role": "user", "parts": [{"text": summary_text}]})
+            api_history.append({"role": "model", "parts": [{"text": "Mình đã nắm được phần trò chuyện trước đó."}]})
+        for message in messages[start:]:
+            api_role = "user" if message["role"] == "user" else "model"
+            api_history.append({"role": api_role, "parts": [{"text": message["content"]}]})
+
+        summary_tokens = sum(estimate_tokens(line) for line in summary_lines)
+        stats = {
+            "history_tokens": sum(estimate_tokens(part["text"]) for turn in api_history for part in turn["parts"]),
+            "summary_tokens": summary_tokens,
+            "verbatim_messages": len(messages) - start,
+            "summarized_messages": start,
+        }
+        return api_history, stats
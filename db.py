@@ -0,0 +1,389 @@
+# db.py
+# Tầng truy cập dữ liệu dùng chung cho app.py và trang Admin:
+# pool kết nối theo tiến trình + các câu SQL "nóng" được PREPARE sẵn trên từng kết nối.
+
+import os
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import execute_batch
+
+from db_pool import ConnectionPool, connect_kwargs_from_secrets
+import tracing
+
+ALERT_COLUMNS = "id, timestamp, reason, snippet, status, assignee, priority, chat_session_id"
+
+# --- Các câu SQL dùng thường xuyên (placeholder %s; tự chuyển sang $1, $2... khi PREPARE) ---
+STATEMENTS = {
+    "insert_conversation": """
+        INSERT INTO conversations
+        (session_id, user_id, sender, message_content, timestamp, related_alert_id)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """,
+    "insert_alert": """
+        INSERT INTO alerts (chat_session_id, reason, snippet, priority, status)
+        VALUES (%s, %s, %s, %s, %s)
+        RETURNING id
+    """,
+    # Quét lại lịch sử (risk_rescan.py): chỉ thêm khi phiên chưa có cảnh báo cùng lý do (index alerts_session_idx)
+    "insert_alert_if_new": """
+        INSERT INTO alerts (chat_session_id, reason, snippet, priority, status)
+        SELECT %s, %s, %s, %s, %s
+        WHERE NOT EXISTS (SELECT 1 FROM alerts WHERE chat_session_id = %s AND reason = %s)
+        RETURNING id
+    """,
+    # Thống kê dashboard từ bảng rollup (xem rollups.py) - chỉ là tra cứu vài dòng
+    "rollup_new_alerts": "SELECT COALESCE(SUM(count), 0)::bigint FROM alert_counts WHERE kind = 'status' AND value = 'Mới'",
+    "rollup_popular_reason": """
+        SELECT value FROM alert_counts WHERE kind = 'reason' AND count > 0
+        ORDER BY count DESC LIMIT 1
+    """,
+    "rollup_weekly_sessions": """
+        SELECT COALESCE(SUM(count), 0)::bigint FROM activity_rollups
+        WHERE metric = 'sessions' AND bucket >= date_trunc('hour', now()::timestamp - interval '7 days')
+    """,
+    # Dự phòng khi chưa cài rollup: quét trực tiếp bảng alerts
+    "count_new_alerts": "SELECT COUNT(*) FROM alerts WHERE status = 'Mới'",
+    "popular_alert_reason": """
+        SELECT reason, COUNT(*) as count FROM alerts
+        GROUP BY reason ORDER BY count DESC LIMIT 1
+    """,
+    "alert_by_id": f"SELECT {ALERT_COLUMNS} FROM alerts WHERE id = %s",
+    "alerts_by_ids": f"SELECT {ALERT_COLUMNS} FROM alerts WHERE id = ANY(%s) ORDER BY timestamp DESC, id DESC",
+    # Gửi trong cùng giao dịch với INSERT: PostgreSQL chỉ phát thông báo khi giao dịch commit
+    "notify_new_alert": "SELECT pg_notify('new_alert', %s)",
+    # Một câu UPDATE cho cả nhóm cảnh báo (xử lý hàng loạt); RETURNING cho biết đúng các dòng đã đổi
+    "update_alerts_status": "UPDATE alerts SET status = %s, assignee = %s WHERE id = ANY(%s) RETURNING id",
+    "insert_faq": "INSERT INTO knowledge_base (question, answer, category) VALUES (%s, %s, %s)",
+    "knowledge_base_since": "SELECT id, question, answer, category FROM knowledge_base WHERE id > %s ORDER BY id",
+    "upsert_response_cache": """
+        INSERT INTO response_cache (cache_key, prompt_norm, first_turn, response)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (cache_key) DO UPDATE SET response = EXCLUDED.response, created_at = now()
+    """,
+    "load_response_cache": """
+        SELECT * FROM (
+            SELECT cache_key, prompt_norm, first_turn, response, EXTRACT(EPOCH FROM created_at) AS created_epoch
+            FROM response_cache
+            WHERE created_at > now() - make_interval(secs => %s)
+            ORDER BY created_at DESC LIMIT %s
+        ) recent ORDER BY created_epoch ASC
+    """,
+    "chat_history": """
+        SELECT message_id, timestamp, sender, message_content, user_id
+        FROM conversations
+        WHERE session_id = %s
+        ORDER BY timestamp ASC, message_id ASC
+    """,
+    "chat_history_count": "SELECT COUNT(*) FROM conversations WHERE session_id = %s",
+    # Nạp lại lịch sử một phiên đã bị xả khỏi bộ nhớ (xem session_store.py)
+    "session_messages": """
+        SELECT sender, message_content, timestamp, related_alert_id
+        FROM conversations
+        WHERE session_id = %s
+        ORDER BY timestamp ASC, message_id ASC
+    """,
+    # Tin nhắn của học sinh theo thứ tự khóa chính, tiếp tục sau mốc message_id (xem risk_rescan.py)
+    "rescan_user_messages": """
+        SELECT message_id, session_id, timestamp, message_content
+        FROM conversations
+        WHERE sender = 'user' AND message_id > %s
+        ORDER BY message_id
+    """,
+}
+
+
+# Danh sách cảnh báo phân trang theo khóa (timestamp, id), mới nhất trước:
+#   alerts_page[_status]        trang đầu
+#   alerts_page[_status]_older  các dòng cũ hơn một mốc (trang sau)
+#   alerts_page[_status]_newer  các dòng mới hơn một mốc (trang trước, lấy theo thứ tự tăng rồi đảo lại)
+for _status_key, _status_where in (("", ""), ("_status", "status = %s")):
+    for _direction, _keyset_where, _order in (
+        ("", "", "DESC"),
+        ("_older", "(timestamp, id) < (%s, %s)", "DESC"),
+        ("_newer", "(timestamp, id) > (%s, %s)", "ASC"),
+    ):
+        _conditions = " AND ".join(c for c in (_status_where, _keyset_where) if c)
+        STATEMENTS[f"alerts_page{_status_key}{_direction}"] = (
+            f"SELECT {ALERT_COLUMNS} FROM alerts"
+            + (f" WHERE {_conditions}" if _conditions else "")
+            + f" ORDER BY timestamp {_order}, id {_order} LIMIT %s"
+        )
+del _status_key, _status_where, _direction, _keyset_where, _order, _conditions
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Kết nối psycopg2 nhớ các câu lệnh đã PREPARE trong phiên làm việc của nó."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _to_positional(sql):
+    """Đổi placeholder %s thành $1, $2... cho câu lệnh PREPARE."""
+    counter = iter(range(1, 1000))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", sql)
+
+
+def _param_count(name):
+    return STATEMENTS[name].count("%s")
+
+
+def _execute_sql(name):
+    """Câu EXECUTE tương ứng với một câu lệnh đã PREPARE."""
+    count = _param_count(name)
+    if not count:
+        return f"EXECUTE {name}"
+    return f"EXECUTE {name} ({', '.join(['%s'] * count)})"
+
+
+# --- Thống kê theo câu lệnh (số lần gọi, thời gian) ---
+_stats_lock = threading.Lock()
+_statement_stats = {}
+
+
+def _record(name, elapsed, calls=1):
+    with _stats_lock:
+        entry = _statement_stats.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "prepares": 0})
+        entry["calls"] += calls
+        entry["total_ms"] += elapsed * 1000
+        entry["max_ms"] = max(entry["max_ms"], elapsed * 1000)
+
+
+def statement_stats():
+    """Số lần gọi và thời gian (ms) của từng câu lệnh kể từ khi tiến trình khởi động."""
+    with _stats_lock:
+        stats = {name: dict(entry) for name, entry in _statement_stats.items()}
+    for entry in stats.values():
+        entry["avg_ms"] = entry["total_ms"] / entry["calls"] if entry["calls"] else 0.0
+    return stats
+
+
+def _uses_prepared(conn):
+    return isinstance(conn, PreparingConnection)
+
+
+def _ensure_prepared(conn, cursor, name):
+    if name in conn.prepared:
+        return
+    cursor.execute(f"PREPARE {name} AS {_to_positional(STATEMENTS[name])}")
+    conn.prepared.add(name)
+    with _stats_lock:
+        _statement_stats.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "prepares": 0})["prepares"] += 1
+
+
+def execute(conn, name, params=()):
+    """Chạy câu lệnh `name` trong STATEMENTS, trả về cursor (người gọi tự đóng).
+
+    Trên kết nối hỗ trợ, câu lệnh được PREPARE một lần rồi gọi bằng EXECUTE,
+    nên PostgreSQL không phải phân tích/lập kế hoạch lại mỗi lần.
+    """
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        if _uses_prepared(conn):
+            _ensure_prepared(conn, cursor, name)
+            cursor.execute(_execute_sql(name), params)
+        else:
+            cursor.execute(STATEMENTS[name], params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # Câu lệnh đã PREPARE bị mất (vd: kết nối đi qua PgBouncer) - lần sau sẽ PREPARE lại
+        conn.prepared.clear()
+        cursor.close()
+        raise
+    except Exception:
+        cursor.close()
+        raise
+    _record(name, time.perf_counter() - started)
+    return cursor
+
+
+def execute_many(conn, name, rows, page_size=100):
+    """Chạy câu lệnh `name` cho nhiều bộ tham số, gộp thành ít lượt gửi (execute_batch)."""
+    if not rows:
+        return
+    started = time.perf_counter()
+    with conn.cursor() as cursor:
+        try:
+            if _uses_prepared(conn):
+                _ensure_prepared(conn, cursor, name)
+                execute_batch(cursor, _execute_sql(name), rows, page_size=page_size)
+            else:
+                execute_batch(cursor, STATEMENTS[name], rows, page_size=page_size)
+        except psycopg2.errors.InvalidSqlStatementName:
+            conn.prepared.clear()
+            raise
+    _record(name, time.perf_counter() - started, calls=len(rows))
+
+
+def fetch_dataframe(conn, name, params=()):
+    """Chạy câu lệnh SELECT `name` và trả về pandas DataFrame."""
+    import pandas as pd # Chỉ trang Admin cần pandas; tránh import nặng cho app.py
+
+    cursor = execute(conn, name, params)
+    try:
+        columns = [column.name for column in cursor.description]
+        return pd.DataFrame(cursor.fetchall(), columns=columns)
+    finally:
+        cursor.close()
+
+
+def stream_rows(conn, name, params=(), chunk_rows=500, skip=0):
+    """Đọc kết quả câu lệnh `name` qua cursor phía server, mỗi lần `chunk_rows` dòng.
+
+    Yield (columns, rows) cho từng khối; chỉ một khối nằm trong bộ nhớ tại một thời điểm.
+    `skip` dòng đầu được bỏ qua ngay trên server (MOVE), không truyền về client.
+    Cursor có tên (DECLARE) không dùng được với EXECUTE nên câu lệnh không đi qua PREPARE.
+    """
+    started = time.perf_counter()
+    cursor = conn.cursor(name=f"stream_{name}_{threading.get_ident()}_{time.monotonic_ns()}")
+    try:
+        cursor.itersize = chunk_rows
+        cursor.execute(STATEMENTS[name], params)
+        if skip:
+            cursor.scroll(skip)
+        first = True
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if first:
+                _record(name, time.perf_counter() - started) # Thời gian tới khối đầu tiên
+                first = False
+            if not rows:
+                break
+            yield [column.name for column in cursor.description], rows
+    finally:
+        cursor.close()
+
+
+def fetch_alerts_page(conn, status=None, older_than=None, newer_than=None, limit=50):
+    """Một trang cảnh báo (mới nhất trước), lọc theo trạng thái ngay trong SQL.
+
+    `older_than` / `newer_than` là mốc (timestamp, id) của dòng cuối / đầu trang đang xem.
+    Trả về (DataFrame, has_more) - has_more cho biết còn dòng tiếp theo theo hướng đang đi.
+    """
+    name = "alerts_page" + ("_status" if status else "")
+    params = [status] if status else []
+    if older_than is not None:
+        name += "_older"
+        params.extend(older_than)
+    elif newer_than is not None:
+        name += "_newer"
+        params.extend(newer_than)
+    params.append(limit + 1) # Lấy dư một dòng để biết còn trang tiếp theo hay không
+
+    df = fetch_dataframe(conn, name, tuple(params))
+    has_more = len(df) > limit
+    df = df.iloc[:limit]
+    if newer_than is not None:
+        df = df.iloc[::-1]
+    return df.reset_index(drop=True), has_more
+
+
+def fetch_alert_by_id(conn, alert_id):
+    """Một cảnh báo theo id dưới dạng dict (None nếu không tồn tại)."""
+    cursor = execute(conn, "alert_by_id", (alert_id,))
+    try:
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column.name for column in cursor.description], row))
+    finally:
+        cursor.close()
+
+
+def fetch_alerts_by_ids(conn, alert_ids):
+    """Các cảnh báo có id trong `alert_ids` (DataFrame, mới nhất trước)."""
+    return fetch_dataframe(conn, "alerts_by_ids", (list(alert_ids),))
+
+
+def update_alerts(conn, alert_ids, status, assignee):
+    """Đặt status/assignee cho các cảnh báo `alert_ids`; trả về id các dòng đã cập nhật (người gọi commit)."""
+    cursor = execute(conn, "update_alerts_status", (status, assignee, [int(alert_id) for alert_id in alert_ids]))
+    try:
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def fetch_scalar(conn, name, params=()):
+    """Giá trị đầu tiên của dòng đầu tiên (None nếu không có dòng nào)."""
+    cursor = execute(conn, name, params)
+    try:
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
+
+
+def fetch_dashboard_stats(conn):
+    """Số liệu cho các ô thống kê: weekly_chats, new_alerts, popular_topic.
+
+    Đọc từ bảng rollup (O(1)); nếu chưa chạy `python rollups.py install` thì quay về
+    truy vấn trực tiếp bảng alerts và weekly_chats = "N/A".
+    """
+    try:
+        return {
+            "weekly_chats": fetch_scalar(conn, "rollup_weekly_sessions"),
+            "new_alerts": fetch_scalar(conn, "rollup_new_alerts"),
+            "popular_topic": fetch_scalar(conn, "rollup_popular_reason") or "Không có",
+        }
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        tracing.warning("Rollup tables missing - falling back to direct alert queries. Run: python migrations.py migrate && python rollups.py backfill")
+    return {
+        "weekly_chats": "N/A",
+        "new_alerts": fetch_scalar(conn, "count_new_alerts") or 0,
+        "popular_topic": fetch_scalar(conn, "popular_alert_reason") or "Không có",
+    }
+
+
+def cli_connect_kwargs(dsn=None, secrets_path=".streamlit/secrets.toml"):
+    """Tham số kết nối cho các lệnh dòng lệnh: --dsn, rồi DATABASE_URL, rồi [database] trong secrets.toml."""
+    dsn = dsn or os.environ.get("DATABASE_URL")
+    if dsn:
+        return {"dsn": dsn}
+    if not os.path.exists(secrets_path):
+        return None
+    try:
+        import tomllib
+        with open(secrets_path, "rb") as file:
+            secrets = tomllib.load(file)
+    except ImportError: # Python < 3.11: dùng gói toml (Streamlit đã cài sẵn)
+        import toml
+        secrets = toml.load(secrets_path)
+    return connect_kwargs_from_secrets(secrets.get("database"))
+
+
+# --- Pool dùng chung theo tiến trình ---
+_pool_lock = threading.Lock()
+_pools = {}
+
+
+def get_pool(db_secrets):
+    """Trả về pool kết nối dùng chung cho tiến trình (tạo lần đầu nếu chưa có).
+
+    Mọi trang Streamlit trong cùng tiến trình dùng chung một pool cho cùng cấu hình.
+    Đặt `prepared_statements = false` trong [database] nếu kết nối đi qua PgBouncer
+    ở chế độ transaction (không hỗ trợ PREPARE ở mức SQL).
+    """
+    connect_kwargs = connect_kwargs_from_secrets(db_secrets)
+    if connect_kwargs is None:
+        return None
+    key = tuple(sorted((k, str(v)) for k, v in connect_kwargs.items()))
+    with _pool_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            use_prepared = str(db_secrets.get("prepared_statements", True)).lower() not in ("false", "0", "no")
+            pool = ConnectionPool(
+                minconn=int(db_secrets.get("pool_min", 1)),
+                maxconn=int(db_secrets.get("pool_max", 10)),
+                connection_factory=PreparingConnection if use_prepared else None,
+                **connect_kwargs
+            )
+            _pools[key] = pool
+        return pool
@@ -0,0 +1,155 @@
+# db_pool.py
+# Pool kết nối PostgreSQL dùng chung cho app.py và trang Admin.
+
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+import tracing
+
+
+class PoolTimeout(Exception):
+    """Hết thời gian chờ mượn kết nối từ pool."""
+
+
+def connect_kwargs_from_secrets(db_secrets):
+    """Chuyển mục [database] trong Streamlit Secrets thành tham số cho psycopg2.connect.
+
+    Trả về None nếu thiếu thông tin kết nối.
+    """
+    if not db_secrets:
+        return None
+    if "uri" in db_secrets:
+        return {"dsn": db_secrets["uri"]}
+    if "host" in db_secrets:
+        return {
+            "host": db_secrets["host"],
+            "port": db_secrets.get("port", 5432),
+            "dbname": db_secrets["dbname"],
+            "user": db_secrets["user"],
+            "password": db_secrets["password"],
+            "sslmode": db_secrets.get("sslmode", "require"),
+        }
+    return None
+
+
+class ConnectionPool:
+    """Pool kết nối an toàn đa luồng với giới hạn min/max.
+
+    - Mỗi request mượn một kết nối riêng (`with pool.connection() as conn:`) rồi trả lại,
+      nên các session không còn tranh nhau một kết nối duy nhất.
+    - Mỗi lần mượn, kết nối được thăm dò bằng conn.poll() (không tốn lượt gửi); kết nối đã nằm yên
+      lâu hơn `check_idle_after` giây được kiểm tra thêm bằng `SELECT 1` trước khi giao ra. Kết nối
+      chết bị loại bỏ và thay bằng kết nối mới (reconnect trong suốt).
+      Khi gặp một kết nối chết (vd: PostgreSQL vừa khởi động lại), mọi kết nối đang rảnh đều bị coi
+      là đáng ngờ và được kiểm tra ở lần mượn kế tiếp; getconn thử tối đa `reconnect_attempts` lần.
+    - Khi trả lại, giao dịch dở dang/lỗi được rollback để không "đầu độc" request sau.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, checkout_timeout=10.0, check_idle_after=30.0,
+                 reconnect_attempts=None, **connect_kwargs):
+        if maxconn < 1 or minconn < 0 or minconn > maxconn:
+            raise ValueError(f"Cấu hình pool không hợp lệ: minconn={minconn}, maxconn={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.check_idle_after = check_idle_after
+        # Mặc định đủ để loại hết các kết nối rảnh (tối đa maxconn) rồi mở thêm một kết nối mới
+        self.reconnect_attempts = reconnect_attempts if reconnect_attempts is not None else maxconn + 1
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        # ThreadedConnectionPool ném PoolError khi hết kết nối; semaphore giúp request chờ thay vì lỗi ngay
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.stats = {"checkouts": 0, "reconnects": 0, "timeouts": 0, "wait_seconds": 0.0}
+
+    def _is_alive(self, conn):
+        if conn.closed:
+            return False
+        try:
+            # Không tốn lượt gửi: chỉ đọc những gì đã về socket (vd: thông báo đóng kết nối khi PostgreSQL
+            # khởi động lại), nên chạy ở mọi lần mượn, kể cả kết nối vừa được dùng
+            conn.poll()
+        except psycopg2.Error:
+            return False
+        last_used = self._last_used.get(id(conn), 0.0)
+        if time.monotonic() - last_used < self.check_idle_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Mượn một kết nối còn sống; nhớ gọi putconn() để trả lại."""
+        wait_started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise PoolTimeout(f"Không mượn được kết nối CSDL sau {self.checkout_timeout}s (maxconn={self.maxconn}).")
+        try:
+            conn = self._checkout_alive()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_seconds"] += time.perf_counter() - wait_started
+        return conn
+
+    def _checkout_alive(self):
+        """Lấy kết nối từ pool, loại bỏ từng kết nối chết cho tới khi có một kết nối dùng được."""
+        for _ in range(self.reconnect_attempts):
+            conn = self._pool.getconn()
+            if self._is_alive(conn):
+                return conn
+            tracing.warning("DB pool: connection is dead, reconnecting...")
+            self._pool.putconn(conn, close=True)
+            with self._lock:
+                self.stats["reconnects"] += 1
+                # Các kết nối rảnh còn lại nhiều khả năng cũng đã chết: kiểm tra hết ở lần mượn sau
+                self._last_used.clear()
+        raise psycopg2.OperationalError(
+            f"DB pool: no live connection after {self.reconnect_attempts} attempts."
+        )
+
+    def putconn(self, conn):
+        """Trả kết nối về pool, dọn dẹp giao dịch dở dang hoặc loại bỏ nếu kết nối hỏng."""
+        close = bool(conn.closed)
+        if not close:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close:
+            self._forget(conn)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._slots.release()
+
+    def _forget(self, conn):
+        self._last_used.pop(id(conn), None)
+
+    @contextmanager
+    def connection(self):
+        """Context manager mượn/trả kết nối cho một request."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        self._pool.closeall()
+        self._last_used.clear()
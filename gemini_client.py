@@ -0,0 +1,202 @@
+# gemini_client.py
+# Gọi Gemini ở chế độ stream, có giới hạn số yêu cầu đồng thời, hạn chót cho từng lượt
+# và thử lại với backoff lũy thừa (có jitter) khi gặp lỗi tạm thời như 429.
+
+import random
+import threading
+import time
+
+import tracing
+
+# Mã HTTP của các lỗi tạm thời đáng thử lại (google.api_core.exceptions.*.code)
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+
+
+class GeminiBusy(Exception):
+    """Hết chỗ trong giới hạn yêu cầu đồng thời và đã chờ quá lâu trong hàng đợi."""
+
+
+class GeminiTimeout(Exception):
+    """Lượt gọi vượt quá hạn chót (kể cả thời gian chờ hàng đợi và các lần thử lại)."""
+
+
+def _chunk_text(chunk):
+    """Lấy text của một chunk; chunk bị chặn/không có text thì trả về chuỗi rỗng."""
+    try:
+        return chunk.text or ""
+    except (ValueError, AttributeError):
+        # google-generativeai ném ValueError khi chunk không có phần text (vd: bị safety filter chặn)
+        return ""
+
+
+def _error_code(error):
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None # Một số lỗi gRPC có code() là phương thức
+
+
+def is_rate_limited(error):
+    """Lỗi 429 / hết hạn mức (ResourceExhausted)."""
+    return _error_code(error) == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+
+def is_retryable(error):
+    """Lỗi tạm thời (quá tải/429, lỗi máy chủ, hết thời gian phía API) thì có thể thử lại."""
+    return (is_rate_limited(error) or _error_code(error) in RETRYABLE_CODES
+            or type(error).__name__ in ("ServiceUnavailable", "InternalServerError", "DeadlineExceeded"))
+
+
+def stream_reply(chat_session, prompt, on_text=None, deadline_at=None):
+    """Gửi prompt ở chế độ stream và gom lại toàn bộ câu trả lời.
+
+    `on_text(text_so_far)` được gọi mỗi khi có chunk mới để giao diện cập nhật dần.
+    Trả về (full_text, timings) với timings gồm:
+      - ttft: thời gian tới token đầu tiên (giây) - đây là độ trễ mà người dùng cảm nhận
+      - total: tổng thời gian tới khi nhận xong câu trả lời (giây)
+      - chunks: số chunk đã nhận
+      - prompt_tokens: số token đầu vào Gemini tính cho lượt này (None nếu API không trả về)
+    `deadline_at` (time.monotonic()) giới hạn cả lời gọi API lẫn thời gian nhận stream.
+    """
+    started = time.perf_counter()
+    ttft = None
+    parts = []
+    chunk_count = 0
+
+    if deadline_at is None:
+        response = chat_session.send_message(prompt, stream=True)
+    else:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise GeminiTimeout("Deadline exceeded before sending the request")
+        response = chat_session.send_message(prompt, stream=True, request_options={"timeout": remaining})
+    for chunk in response:
+        if deadline_at is not None and time.monotonic() > deadline_at:
+            raise GeminiTimeout(f"Deadline exceeded while streaming ({chunk_count} chunks received)")
+        text = _chunk_text(chunk)
+        if not text:
+            continue
+        if ttft is None:
+            ttft = time.perf_counter() - started
+        parts.append(text)
+        chunk_count += 1
+        if on_text is not None:
+            on_text("".join(parts))
+
+    # Với stream=True, lịch sử của chat_session chỉ được cập nhật sau khi đã duyệt hết response
+    resolve = getattr(response, "resolve", None)
+    if callable(resolve):
+        resolve()
+
+    total = time.perf_counter() - started
+    usage = getattr(response, "usage_metadata", None)
+    timings = {
+        "ttft": ttft if ttft is not None else total, "total": total, "chunks": chunk_count,
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+    }
+    return "".join(parts), timings
+
+
+class GeminiClient:
+    """Bọc stream_reply cho cả tiến trình: giới hạn yêu cầu đồng thời, hạn chót và thử lại.
+
+    - `max_in_flight`: số lượt gọi Gemini cùng lúc tối đa (semaphore); lượt khác chờ trong hàng đợi
+      tối đa `queue_timeout` giây rồi báo GeminiBusy, thay vì chiếm thêm luồng script của Streamlit.
+    - `deadline`: hạn chót (giây) cho cả một lượt, tính từ lúc vào hàng đợi.
+    - Lỗi tạm thời (xem is_retryable) được thử lại tối đa `max_retries` lần với backoff lũy thừa
+      có jitter đầy đủ, nhưng chỉ khi chưa nhận được chữ nào (tránh lặp nội dung đã hiển thị).
+    timings trả về có thêm queue_wait (chờ hàng đợi), retry_wait (các lần thử hỏng + backoff)
+    và attempts; ttft/total là độ trễ của riêng mô hình ở lần thử thành công.
+    """
+
+    def __init__(self, max_in_flight=8, queue_timeout=10.0, deadline=60.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, sleep=time.sleep):
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sleep = sleep
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {
+            "calls": 0, "succeeded": 0, "busy": 0, "timeouts": 0, "failed": 0, "retries": 0, "rate_limited": 0,
+            "queue_wait_ms": 0.0, "max_queue_wait_ms": 0.0, "model_ms": 0.0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def stream_reply(self, chat_session, prompt, on_text=None):
+        """Như stream_reply(), có giới hạn đồng thời, hạn chót và thử lại. Trả về (full_text, timings)."""
+        self._count("calls")
+        queued_at = time.monotonic()
+        deadline_at = queued_at + self.deadline
+        if not self._slots.acquire(timeout=min(self.queue_timeout, self.deadline)):
+            self._count("busy")
+            raise GeminiBusy(f"{self.max_in_flight} Gemini requests already in flight")
+        queue_wait = time.monotonic() - queued_at
+        with self._lock:
+            self._in_flight += 1
+            self._stats["queue_wait_ms"] += queue_wait * 1000
+            self._stats["max_queue_wait_ms"] = max(self._stats["max_queue_wait_ms"], queue_wait * 1000)
+        try:
+            return self._call_with_retries(chat_session, prompt, on_text, deadline_at, queue_wait)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def _call_with_retries(self, chat_session, prompt, on_text, deadline_at, queue_wait):
+        retry_started = time.perf_counter()
+        attempt = 0
+        while True:
+            received_text = False
+
+            def on_text_tracked(text_so_far):
+                nonlocal received_text
+                received_text = True
+                if on_text is not None:
+                    on_text(text_so_far)
+
+            try:
+                text, timings = stream_reply(chat_session, prompt, on_text_tracked, deadline_at=deadline_at)
+            except GeminiTimeout:
+                self._count("timeouts")
+                raise
+            except Exception as e:
+                if is_rate_limited(e):
+                    self._count("rate_limited")
+                delay = self._backoff(attempt)
+                if received_text or not is_retryable(e) or attempt >= self.max_retries:
+                    self._count("failed")
+                    raise
+                if time.monotonic() + delay >= deadline_at:
+                    self._count("timeouts")
+                    raise GeminiTimeout(f"Deadline exceeded after {attempt + 1} attempts: {e}") from e
+                tracing.warning(f"Gemini call failed ({type(e).__name__}: {e}); retry {attempt + 1}/{self.max_retries} in {delay:.2f}s.")
+                self._count("retries")
+                self._sleep(delay)
+                attempt += 1
+                continue
+            timings["queue_wait"] = queue_wait
+            timings["retry_wait"] = time.perf_counter() - retry_started - timings["total"]
+            timings["attempts"] = attempt + 1
+            with self._lock:
+                self._stats["succeeded"] += 1
+                self._stats["model_ms"] += timings["total"] * 1000
+            return text, timings
+
+    def stats(self):
+        """Số lượt gọi, bị từ chối vì quá tải, hết hạn, thử lại, bị 429 và độ trễ hàng đợi / mô hình (ms)."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = self._in_flight
+        admitted = stats["calls"] - stats["busy"]
+        stats["avg_queue_wait_ms"] = stats["queue_wait_ms"] / admitted if admitted else 0.0
+        stats["avg_model_ms"] = stats["model_ms"] / stats["succeeded"] if stats["succeeded"] else 0.0
+        return stats
@@ -0,0 +1,215 @@
+# knowledge_index.py
+# Chỉ mục tìm kiếm BM25 trong bộ nhớ trên bảng 'knowledge_base' (FAQ do tư vấn viên soạn),
+# để trả lời ngay các câu hỏi đã có đáp án trước khi phải gọi Gemini.
+
+import math
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import cache_versions
+import db
+import tracing
+from risk_detector import fold_text
+
+# Ngưỡng độ tin cậy (0..1): từ ANSWER trở lên trả lời thẳng bằng FAQ,
+# từ GROUNDING trở lên thì gửi FAQ kèm câu hỏi cho Gemini làm ngữ cảnh tham khảo.
+ANSWER_THRESHOLD = 0.75
+GROUNDING_THRESHOLD = 0.45
+
+# Nạp lại định kỳ để thấy FAQ do tiến trình khác thêm (phiên bản trong cache_versions chỉ theo tiến trình);
+# khi nạp lỗi thì thử lại với thời gian chờ tăng dần (giây).
+REFRESH_INTERVAL_SECONDS = 300
+RETRY_BACKOFF_SECONDS = 5
+MAX_RETRY_BACKOFF_SECONDS = 300
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Tách từ tiếng Việt đơn giản: các âm tiết đã bỏ dấu + cặp âm tiết liền kề (xấp xỉ từ ghép)."""
+    syllables = _WORD_RE.findall(fold_text(text or ""))
+    return syllables + [f"{a}_{b}" for a, b in zip(syllables, syllables[1:])]
+
+
+class KnowledgeIndex:
+    """Chỉ mục đảo BM25 (k1, b chuẩn) trên phần câu hỏi của FAQ, chấm điểm bằng NumPy.
+
+    Thêm FAQ mới chỉ cập nhật posting của các từ liên quan (không dựng lại toàn bộ chỉ mục).
+    Độ tin cậy của kết quả là trung bình nhân của hai tỉ lệ phủ (theo trọng số IDF):
+    phần câu hỏi của học sinh được FAQ phủ, và phần câu hỏi FAQ được câu hỏi học sinh phủ.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = []
+        self._doc_terms = []
+        self._doc_lengths = []
+        self._postings = {}  # term -> ([doc_idx...], [tf...])
+        self._arrays = {}    # term -> (np.array doc_idx, np.array tf), dựng lười và xóa khi có FAQ mới
+        self._lengths_array = None
+        self._lock = threading.Lock()
+        self.last_id = 0
+        self.loaded_version = None
+        self.next_refresh_at = 0.0 # Mốc time.monotonic() của lần nạp định kỳ / thử lại kế tiếp
+        self.refresh_failures = 0  # Số lần nạp lỗi liên tiếp
+        self._stats = {"lookups": 0, "answered": 0, "grounded": 0, "missed": 0, "lookup_ms": 0.0, "saved_ms": 0.0}
+
+    def add(self, doc_id, question, answer, category=None):
+        """Thêm một FAQ vào chỉ mục."""
+        terms = Counter(tokenize(question))
+        if not terms:
+            return
+        with self._lock:
+            doc_idx = len(self.docs)
+            self.docs.append({"id": doc_id, "question": question, "answer": answer, "category": category})
+            self._doc_terms.append(terms)
+            self._doc_lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                doc_list, tf_list = self._postings.setdefault(term, ([], []))
+                doc_list.append(doc_idx)
+                tf_list.append(tf)
+                self._arrays.pop(term, None)
+            self._lengths_array = None
+            if isinstance(doc_id, int):
+                self.last_id = max(self.last_id, doc_id)
+
+    def refresh(self, conn):
+        """Nạp các FAQ có id lớn hơn FAQ mới nhất đã nạp (lần đầu: nạp toàn bộ)."""
+        cursor = db.execute(conn, "knowledge_base_since", (self.last_id,))
+        try:
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        for doc_id, question, answer, category in rows:
+            self.add(doc_id, question, answer, category)
+        return len(rows)
+
+    def _idf(self, term):
+        n = len(self.docs)
+        df = len(self._postings[term][0]) if term in self._postings else 0
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def _term_arrays(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            doc_list, tf_list = self._postings[term]
+            arrays = (np.asarray(doc_list, dtype=np.int64), np.asarray(tf_list, dtype=np.float64))
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(self, query, top_k=3):
+        """Trả về tối đa top_k kết quả dạng (doc, bm25_score, confidence), điểm giảm dần."""
+        query_terms = set(tokenize(query))
+        with self._lock:
+            if not self.docs or not query_terms:
+                return []
+            if self._lengths_array is None:
+                self._lengths_array = np.asarray(self._doc_lengths, dtype=np.float64)
+            lengths = self._lengths_array
+            avg_length = lengths.mean()
+            scores = np.zeros(len(self.docs))
+            idf = {term: self._idf(term) for term in query_terms}
+            for term in query_terms:
+                if term not in self._postings:
+                    continue
+                doc_idx, tf = self._term_arrays(term)
+                norm = self.k1 * (1 - self.b + self.b * lengths[doc_idx] / avg_length)
+                scores[doc_idx] += idf[term] * tf * (self.k1 + 1) / (tf + norm)
+
+            top = np.argsort(-scores)[:top_k]
+            results = []
+            query_weight = sum(idf.values())
+            for doc_idx in top:
+                if scores[doc_idx] <= 0:
+                    break
+                doc_terms = self._doc_terms[doc_idx]
+                matched_weight = sum(idf[t] for t in query_terms if t in doc_terms)
+                doc_weight = sum(self._idf(t) for t in doc_terms)
+                confidence = math.sqrt((matched_weight / query_weight) * (matched_weight / doc_weight)) if doc_weight else 0.0
+                results.append((self.docs[doc_idx], float(scores[doc_idx]), confidence))
+            return results
+
+    def lookup(self, query):
+        """Tra FAQ cho câu hỏi trong luồng chat.
+
+        Trả về (mode, doc, confidence) với mode là "answer", "ground" hoặc None.
+        """
+        started = time.perf_counter()
+        results = self.search(query, top_k=1)
+        mode, doc, confidence = None, None, 0.0
+        if results:
+            doc, _, confidence = results[0]
+            if confidence >= ANSWER_THRESHOLD:
+                mode = "answer"
+            elif confidence >= GROUNDING_THRESHOLD:
+                mode = "ground"
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._stats["lookup_ms"] += (time.perf_counter() - started) * 1000
+            self._stats[{"answer": "answered", "ground": "grounded", None: "missed"}[mode]] += 1
+        return mode, (doc if mode else None), confidence
+
+    def record_saved_latency(self, ms):
+        """Cộng dồn thời gian ước tính đã tiết kiệm (độ trễ Gemini tránh được nhờ trả lời bằng FAQ)."""
+        with self._lock:
+            self._stats["saved_ms"] += ms
+
+    def stats(self):
+        """Số lần tra, số câu trả lời thẳng / có ngữ cảnh / không khớp, tỉ lệ trúng và độ trễ tra cứu."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["documents"] = len(self.docs)
+        stats["hit_rate"] = stats["answered"] / stats["lookups"] if stats["lookups"] else 0.0
+        stats["avg_lookup_ms"] = stats["lookup_ms"] / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+
+def grounded_prompt(user_prompt, doc):
+    """Ghép FAQ liên quan vào prompt làm ngữ cảnh tham khảo cho Gemini."""
+    return (
+        "Thông tin tham khảo từ tư vấn viên của trường (chỉ dùng nếu phù hợp):\n"
+        f"Hỏi: {doc['question']}\nĐáp: {doc['answer']}\n\n"
+        f"Câu hỏi của học sinh: {user_prompt}"
+    )
+
+
+# --- Chỉ mục dùng chung cho cả tiến trình (app.py và trang Admin) ---
+_shared_index = KnowledgeIndex()
+_refresh_lock = threading.Lock()
+
+
+def _needs_refresh(current_version, now):
+    if _shared_index.refresh_failures and now < _shared_index.next_refresh_at:
+        return False # Đang chờ thử lại sau lỗi
+    return _shared_index.loaded_version != current_version or now >= _shared_index.next_refresh_at
+
+
+def get_index(pool, now=None):
+    """Chỉ mục FAQ dùng chung; nạp thêm FAQ mới khi phiên bản 'knowledge_base' thay đổi
+    hoặc sau mỗi REFRESH_INTERVAL_SECONDS (FAQ thêm từ tiến trình khác)."""
+    now = time.monotonic() if now is None else now
+    current_version = cache_versions.version("knowledge_base")
+    if pool is not None and _needs_refresh(current_version, now):
+        with _refresh_lock:
+            if _needs_refresh(current_version, now):
+                try:
+                    with pool.connection() as conn:
+                        added = _shared_index.refresh(conn)
+                except Exception as e:
+                    # Không thử lại ở mỗi tin nhắn: chờ 5s, 10s, 20s... (tối đa MAX_RETRY_BACKOFF_SECONDS)
+                    _shared_index.refresh_failures += 1
+                    delay = min(MAX_RETRY_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** (_shared_index.refresh_failures - 1))
+                    _shared_index.next_refresh_at = now + delay
+                    tracing.error(f"Error refreshing knowledge index (retry in {delay}s): {type(e).__name__}: {e}")
+                else:
+                    _shared_index.loaded_version = current_version
+                    _shared_index.refresh_failures = 0
+                    _shared_index.next_refresh_at = now + REFRESH_INTERVAL_SECONDS
+                    if added:
+                        tracing.info(f"Knowledge index refreshed: +{added} FAQ (total {len(_shared_index.docs)}).")
+    return _shared_index
@@ -0,0 +1,205 @@
+# message_writer.py
+# Ghi tin nhắn vào bảng 'conversations' theo lô, chạy nền, để request chat không phải chờ CSDL.
+
+import atexit
+import datetime
+import queue
+import threading
+import time
+
+import psycopg2
+
+import db
+import tracing
+
+_STOP = object()
+_active_writer = None # Bộ ghi tạo gần nhất trong tiến trình (trang Admin đọc số liệu)
+
+
+class _FlushRequest:
+    """Yêu cầu ghi ngay mọi thứ đang chờ; người gọi chờ trên `done`, `ok` cho biết đã ghi thành công."""
+
+    def __init__(self, dropped_before):
+        self.done = threading.Event()
+        self.ok = False
+        self.dropped_before = dropped_before # Số dòng bị bỏ trước khi yêu cầu được gửi
+
+
+class MessageWriter:
+    """Hàng đợi write-behind cho bảng 'conversations'.
+
+    Tin nhắn được đưa vào hàng đợi trên luồng request (gần như tức thì) và một luồng nền
+    gom lại, ghi cả lô trong một lượt gửi (EXECUTE đã PREPARE) + một commit khi đủ `batch_size` dòng
+    hoặc sau `flush_interval` giây. `flush()` chặn tới khi mọi tin nhắn đã gửi trước đó
+    được ghi xong - dùng trước khi tạo cảnh báo để giữ đúng thứ tự tin nhắn/cảnh báo.
+    """
+
+    def __init__(self, pool, batch_size=100, flush_interval=0.5, max_retries=3):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0, "written": 0, "dropped": 0, "flushes": 0, "failed_flushes": 0,
+            "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0,
+        }
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        global _active_writer
+        _active_writer = self
+
+    def enqueue(self, session_id, user_id, sender, content, related_alert_id=None, timestamp=None):
+        """Đưa một tin nhắn vào hàng đợi ghi. Timestamp được chốt ngay lúc gọi."""
+        if self._closed:
+            return False
+        row = (session_id, user_id, sender, content, timestamp or datetime.datetime.now(), related_alert_id)
+        self._queue.put(row)
+        with self._lock:
+            self._stats["enqueued"] += 1
+        return True
+
+    def flush(self, timeout=5.0):
+        """Chặn tới khi các tin nhắn đã enqueue trước đó được commit vào CSDL.
+
+        Trả về True chỉ khi chúng đã được ghi; False nếu lần ghi lỗi (dòng vẫn chờ thử lại hoặc đã bị bỏ)
+        hoặc hết timeout.
+        """
+        if self._closed or not self._thread.is_alive():
+            return False
+        with self._lock:
+            request = _FlushRequest(self._stats["dropped"])
+        self._queue.put(request)
+        return request.done.wait(timeout) and request.ok
+
+    def close(self, timeout=10.0):
+        """Ghi nốt hàng đợi và dừng luồng nền (tự gọi khi tiến trình thoát)."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        """Số liệu hiện tại: độ sâu hàng đợi, số dòng đã ghi, độ trễ flush (ms)."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+        return stats
+
+    def _run(self):
+        pending = []  # Danh sách (row, số lần thử)
+        waiters = []
+        stopping = False
+        while not stopping:
+            deadline = time.monotonic() + self.flush_interval
+            # Gom tin nhắn cho tới khi đủ lô, hết thời gian, có yêu cầu flush hoặc dừng
+            while len(pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                if isinstance(item, _FlushRequest):
+                    waiters.append(item)
+                    break
+                pending.append((item, 0))
+
+            if stopping:
+                # Lấy nốt những gì còn trong hàng đợi trước khi dừng
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(item, _FlushRequest):
+                        waiters.append(item)
+                    elif item is not _STOP:
+                        pending.append((item, 0))
+
+            write_failed = False
+            while pending:
+                batch, pending = pending[:self.batch_size], pending[self.batch_size:]
+                failed = self._write_batch(batch)
+                if failed:
+                    write_failed = True
+                    pending = failed + pending
+                    if not stopping:
+                        time.sleep(self.flush_interval)
+                        break  # Thử lại ở vòng sau; khi đang dừng thì thử tới hết số lần cho phép
+
+            # Người chờ chỉ nhận "thành công" khi mọi dòng trước yêu cầu đã commit; lần ghi lỗi thì trả
+            # False ngay (không chờ hết timeout) - dòng lỗi vẫn nằm trong `pending` để thử lại
+            if waiters and (write_failed or not pending):
+                with self._lock:
+                    dropped = self._stats["dropped"]
+                for waiter in waiters:
+                    waiter.ok = not write_failed and not pending and dropped == waiter.dropped_before
+                    waiter.done.set()
+                waiters = []
+
+        if pending:
+            with self._lock:
+                self._stats["dropped"] += len(pending)
+            tracing.critical(f"Conversation writer stopped with {len(pending)} unsaved messages.")
+
+    def _write_batch(self, batch):
+        """Ghi một lô; trả về danh sách dòng cần thử lại (rỗng nếu thành công)."""
+        started = time.perf_counter()
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            db.execute_many(conn, "insert_conversation", [row for row, _ in batch], page_size=len(batch))
+            conn.commit()
+        except Exception as e:
+            if conn and not conn.closed:
+                conn.rollback()
+            tracing.observe("db.write_batch", (time.perf_counter() - started) * 1000, failed=True)
+            kind = "psycopg2" if isinstance(e, psycopg2.Error) else "general"
+            tracing.error(f"Database error flushing {len(batch)} messages to 'conversations' ({kind}): {type(e).__name__}: {e}")
+            retry, dropped = [], 0
+            for row, attempts in batch:
+                if attempts + 1 < self.max_retries:
+                    retry.append((row, attempts + 1))
+                else:
+                    dropped += 1
+            with self._lock:
+                self._stats["failed_flushes"] += 1
+                self._stats["dropped"] += dropped
+            if dropped:
+                tracing.critical(f"Dropped {dropped} messages after {self.max_retries} failed attempts.")
+            return retry
+        finally:
+            if conn:
+                self.pool.putconn(conn)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._stats["written"] += len(batch)
+            self._stats["flushes"] += 1
+            self._stats["last_flush_ms"] = elapsed_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+            self._stats["total_flush_ms"] += elapsed_ms
+        tracing.observe("db.write_batch", elapsed_ms)
+        tracing.debug(f"Flushed {len(batch)} messages to 'conversations' in {elapsed_ms:.1f}ms (queue depth={self._queue.qsize()}).")
+        return []
+
+
+def shared_stats():
+    """Số liệu của bộ ghi trong tiến trình, hoặc None nếu trang chat chưa tạo bộ ghi."""
+    writer = _active_writer
+    return writer.stats() if writer is not None else None
+
+
+def shared_writer():
+    """Bộ ghi trang chat đã tạo trong tiến trình (None nếu chưa có), vd: để flush trước khi đếm tin nhắn."""
+    return _active_writer
@@ -0,0 +1,306 @@
+# migrations.py
+# Lược đồ CSDL có đánh số phiên bản: bảng conversations / alerts / knowledge_base / response_cache,
+# các index khớp với câu lệnh "nóng" trong db.STATEMENTS, bảng rollup, và tùy chọn chia partition
+# theo tháng cho 'conversations'. Phiên bản đã áp dụng được ghi trong bảng schema_migrations.
+#
+# Cách dùng:
+#   python migrations.py status                       # Các phiên bản đã/chưa áp dụng
+#   python migrations.py migrate                      # Áp dụng các phiên bản còn thiếu
+#   python migrations.py migrate --partition-conversations
+#                                                     # Như trên; 'conversations' (nếu tạo mới) chia partition theo tháng
+#   python migrations.py partitions --months-ahead 3  # Tạo trước partition cho các tháng tới (chạy định kỳ)
+#   python migrations.py check                        # EXPLAIN từng câu lệnh nóng, báo Seq Scan
+# Kết nối lấy từ --dsn, biến môi trường DATABASE_URL hoặc mục [database] trong .streamlit/secrets.toml.
+#
+# Lưu ý: CREATE INDEX (không CONCURRENTLY) khóa ghi trên bảng trong lúc tạo; với bảng lớn đang chạy
+# thật, hãy chạy migrate vào giờ vắng.
+
+import argparse
+import datetime
+import json
+import sys
+import time
+
+import psycopg2
+
+import db
+import rollups
+import tracing
+from response_cache import CACHE_DDL
+
+MIGRATIONS_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+# Khóa advisory để hai tiến trình không cùng chạy migrate
+_LOCK_KEY = 20240601
+
+BASE_TABLES_DDL = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id SERIAL PRIMARY KEY,
+    timestamp TIMESTAMP NOT NULL DEFAULT now(),
+    reason TEXT,
+    snippet TEXT,
+    status TEXT DEFAULT 'Mới',
+    assignee TEXT,
+    priority INTEGER,
+    chat_session_id TEXT
+);
+
+CREATE TABLE IF NOT EXISTS knowledge_base (
+    id SERIAL PRIMARY KEY,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    category TEXT
+);
+"""
+
+CONVERSATIONS_COLUMNS = """
+    message_id BIGSERIAL,
+    session_id TEXT,
+    user_id TEXT,
+    sender TEXT,
+    message_content TEXT,
+    timestamp TIMESTAMP NOT NULL DEFAULT now(),
+    related_alert_id INTEGER
+"""
+
+# Mỗi index phục vụ một nhóm câu lệnh trong db.STATEMENTS
+INDEXES_DDL = """
+-- chat_history(_count), session_messages: WHERE session_id = ? ORDER BY timestamp, message_id
+CREATE INDEX IF NOT EXISTS conversations_session_time_idx ON conversations (session_id, timestamp, message_id);
+-- alerts_page, alerts_page_older/_newer: ORDER BY timestamp, id (keyset)
+CREATE INDEX IF NOT EXISTS alerts_time_idx ON alerts (timestamp DESC, id DESC);
+-- alerts_page_status*, count_new_alerts: WHERE status = ? ORDER BY timestamp, id
+CREATE INDEX IF NOT EXISTS alerts_status_time_idx ON alerts (status, timestamp DESC, id DESC);
+-- popular_alert_reason: GROUP BY reason (index-only scan thay vì đọc cả bảng)
+CREATE INDEX IF NOT EXISTS alerts_reason_idx ON alerts (reason);
+-- Tra cảnh báo theo phiên chat (trang Admin, quét lại lịch sử)
+CREATE INDEX IF NOT EXISTS alerts_session_idx ON alerts (chat_session_id);
+-- load_response_cache: WHERE created_at > ? ORDER BY created_at DESC
+CREATE INDEX IF NOT EXISTS response_cache_created_idx ON response_cache (created_at);
+"""
+
+
+def _table_exists(cursor, table):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cursor.fetchone()[0]
+
+
+def is_partitioned(cursor, table):
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", (table,)
+    )
+    return cursor.fetchone()[0]
+
+
+def _create_base_tables(cursor, options):
+    cursor.execute(BASE_TABLES_DDL)
+    cursor.execute(CACHE_DDL)
+    if _table_exists(cursor, "conversations"):
+        if options.get("partition_conversations") and not is_partitioned(cursor, "conversations"):
+            # Chuyển sang partition cần sao chép dữ liệu sang bảng mới: giữ nguyên, chỉ báo lại
+            tracing.warning("Table 'conversations' already exists without partitions - leaving it as is "
+                            "(partitioning requires copying the data into a new table).")
+        return
+    if options.get("partition_conversations"):
+        # Khóa chính của bảng partition phải chứa cột partition
+        cursor.execute(
+            f"CREATE TABLE conversations ({CONVERSATIONS_COLUMNS}, PRIMARY KEY (message_id, timestamp)) "
+            "PARTITION BY RANGE (timestamp)"
+        )
+        # Dòng ngoài mọi partition tháng (dữ liệu cũ, đồng hồ lệch) vẫn ghi được
+        cursor.execute("CREATE TABLE conversations_default PARTITION OF conversations DEFAULT")
+        ensure_partitions(cursor, options.get("months_ahead", 3))
+    else:
+        cursor.execute(f"CREATE TABLE conversations ({CONVERSATIONS_COLUMNS}, PRIMARY KEY (message_id))")
+
+
+# (phiên bản, tên, SQL hoặc hàm nhận (cursor, options)) - chỉ thêm vào cuối, không sửa phiên bản đã phát hành
+MIGRATIONS = [
+    (1, "base_tables", _create_base_tables),
+    (2, "hot_query_indexes", INDEXES_DDL),
+    (3, "rollups", rollups.ROLLUP_DDL),
+]
+
+
+def _month_start(day):
+    return datetime.date(day.year, day.month, 1)
+
+
+def _next_month(month):
+    return datetime.date(month.year + (month.month == 12), month.month % 12 + 1, 1)
+
+
+def ensure_partitions(cursor, months_ahead=3, today=None):
+    """Tạo partition tháng hiện tại và `months_ahead` tháng tới (nếu 'conversations' có chia partition).
+
+    Trả về tên các partition vừa tạo. Cần chạy trước khi tới tháng mới, nếu không tin nhắn
+    của tháng đó rơi vào partition DEFAULT.
+    """
+    if not is_partitioned(cursor, "conversations"):
+        return []
+    created = []
+    month = _month_start(today or datetime.date.today())
+    for _ in range(months_ahead + 1):
+        name = f"conversations_p{month:%Y_%m}"
+        if not _table_exists(cursor, name):
+            cursor.execute(
+                f"CREATE TABLE {name} PARTITION OF conversations FOR VALUES FROM (%s) TO (%s)",
+                (month, _next_month(month))
+            )
+            created.append(name)
+        month = _next_month(month)
+    return created
+
+
+def applied_versions(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(MIGRATIONS_TABLE_DDL)
+        cursor.execute("SELECT version FROM schema_migrations")
+        versions = {row[0] for row in cursor.fetchall()}
+    conn.commit()
+    return versions
+
+
+def migrate(conn, partition_conversations=False, months_ahead=3):
+    """Áp dụng các phiên bản còn thiếu theo thứ tự, mỗi phiên bản trong một giao dịch.
+
+    Trả về danh sách (phiên bản, tên) vừa áp dụng.
+    """
+    options = {"partition_conversations": partition_conversations, "months_ahead": months_ahead}
+    applied = []
+    with conn.cursor() as cursor:
+        cursor.execute(MIGRATIONS_TABLE_DDL)
+        conn.commit()
+        for version, name, step in MIGRATIONS:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (_LOCK_KEY,))
+            cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if cursor.fetchone():
+                conn.commit()
+                continue
+            try:
+                if callable(step):
+                    step(cursor, options)
+                else:
+                    cursor.execute(step)
+                cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+            applied.append((version, name))
+    return applied
+
+
+# --- Kiểm tra kế hoạch truy vấn ---
+# Câu lệnh nóng cần kiểm tra và tham số mẫu (giá trị không quan trọng, chỉ để lập kế hoạch)
+_SAMPLE_TIME = datetime.datetime(2024, 1, 1)
+HOT_QUERIES = {
+    "chat_history": ("sample-session",),
+    "chat_history_count": ("sample-session",),
+    "session_messages": ("sample-session",),
+    "alerts_page": (50,),
+    "alerts_page_older": (_SAMPLE_TIME, 1, 50),
+    "alerts_page_newer": (_SAMPLE_TIME, 1, 50),
+    "alerts_page_status": ("Mới", 50),
+    "alerts_page_status_older": ("Mới", _SAMPLE_TIME, 1, 50),
+    "alerts_page_status_newer": ("Mới", _SAMPLE_TIME, 1, 50),
+    "alert_by_id": (1,),
+    "alerts_by_ids": ([1, 2, 3],),
+    "count_new_alerts": (),
+    "popular_alert_reason": (),
+    "knowledge_base_since": (0,),
+    "load_response_cache": (86400, 5000),
+    "rollup_new_alerts": (),
+    "rollup_popular_reason": (),
+    "rollup_weekly_sessions": (),
+    "rescan_user_messages": (0,),
+    # EXPLAIN không chạy câu lệnh: INSERT chỉ được lập kế hoạch (kiểm tra NOT EXISTS dùng alerts_session_idx)
+    "insert_alert_if_new": ("sample-session", "Phát hiện rủi ro: tự hại", "", 1, "Mới", "sample-session",
+                            "Phát hiện rủi ro: tự hại"),
+}
+
+
+def _seq_scans(plan):
+    """Tên các bảng bị quét tuần tự trong cây kế hoạch (EXPLAIN FORMAT JSON)."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+def check_plans(conn, queries=None):
+    """EXPLAIN từng câu lệnh nóng; trả về {tên: [bảng bị Seq Scan]} (danh sách rỗng là đạt).
+
+    Bảng nhỏ (vd: CSDL mới) thì Seq Scan vốn rẻ hơn nên planner vẫn chọn; vì vậy kiểm tra chạy với
+    enable_seqscan = off - nếu vẫn ra Seq Scan nghĩa là không có index nào dùng được cho câu lệnh đó.
+    """
+    results = {}
+    with conn.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        for name, params in (queries or HOT_QUERIES).items():
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {db.STATEMENTS[name]}", params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            results[name] = _seq_scans(plan[0]["Plan"])
+    conn.rollback() # Không giữ SET LOCAL / giao dịch mở
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quản lý lược đồ CSDL (migration có đánh số phiên bản).")
+    parser.add_argument("command", choices=["status", "migrate", "partitions", "check"])
+    parser.add_argument("--dsn", help="Chuỗi kết nối PostgreSQL (mặc định: DATABASE_URL hoặc secrets.toml)")
+    parser.add_argument("--partition-conversations", action="store_true",
+                        help="Khi tạo mới bảng 'conversations': chia partition theo tháng")
+    parser.add_argument("--months-ahead", type=int, default=3, help="Số tháng tới cần tạo sẵn partition")
+    args = parser.parse_args(argv)
+
+    connect_kwargs = db.cli_connect_kwargs(args.dsn)
+    if connect_kwargs is None:
+        print("Không tìm thấy thông tin kết nối CSDL (--dsn, DATABASE_URL hoặc .streamlit/secrets.toml).")
+        return 1
+    started = time.perf_counter()
+    conn = psycopg2.connect(**connect_kwargs)
+    exit_code = 0
+    try:
+        if args.command == "status":
+            applied = applied_versions(conn)
+            for version, name, _ in MIGRATIONS:
+                print(f"{version:>4}  {name:<20} {'đã áp dụng' if version in applied else 'CHƯA áp dụng'}")
+        elif args.command == "migrate":
+            applied = migrate(conn, args.partition_conversations, args.months_ahead)
+            for version, name in applied:
+                print(f"Applied migration {version}: {name}")
+            if not applied:
+                print("Schema is up to date.")
+        elif args.command == "partitions":
+            with conn.cursor() as cursor:
+                created = ensure_partitions(cursor, args.months_ahead)
+            conn.commit()
+            print(f"Created partitions: {', '.join(created)}" if created else "No partitions created.")
+        else:
+            results = check_plans(conn)
+            for name, tables in results.items():
+                print(f"{'SEQ SCAN' if tables else 'ok':<8}  {name}" + (f"  ({', '.join(tables)})" if tables else ""))
+            exit_code = 2 if any(results.values()) else 0
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Lỗi CSDL khi chạy '{args.command}': {e}")
+        return 1
+    finally:
+        conn.close()
+    print(f"Migrations {args.command} done in {time.perf_counter() - started:.2f}s.")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
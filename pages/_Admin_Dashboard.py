@@ -6,19 +6,44 @@ import yaml
 from yaml.loader import SafeLoader
 import pandas as pd
 import os
+import copy
+import shutil
+import tempfile
+import zipfile
 import datetime # Thêm để xử lý thời gian nếu cần
 import psycopg2 # <--- THÊM DÒNG NÀY
+import db # Tầng truy cập dữ liệu dùng chung với app.py (pool + câu lệnh PREPARE sẵn)
+import cache_versions # Phiên bản dữ liệu để làm mới cache có chọn lọc
+from alert_listener import AlertListener # Nhận cảnh báo mới qua LISTEN/NOTIFY
+import knowledge_index # Số liệu tra cứu FAQ của trợ lý chat
+from db_pool import connect_kwargs_from_secrets
+import chat_view # Hiển thị lịch sử chat theo cửa sổ (dùng chung với app.py)
+import session_store # Số liệu bộ nhớ của lịch sử chat các phiên đang mở
+import message_writer # Số liệu hàng đợi ghi tin nhắn của trang chat
+import transcript_export # Xuất hàng loạt hội thoại bằng COPY
+import tracing # Histogram thời gian các giai đoạn xử lý + log có cấp độ
 
 # --- Cấu hình trang ---
 st.set_page_config(page_title="Admin Dashboard", layout="wide", initial_sidebar_state="expanded")
 
 # --- Đọc cấu hình xác thực ---
+# config.yaml được phân tích MỘT lần cho cả tiến trình; mtime của file là một phần khóa cache
+# nên khi file thay đổi, lần rerun kế tiếp sẽ đọc lại.
+@st.cache_resource(max_entries=1)
+def load_auth_config(path, mtime):
+    """Đọc và phân tích config.yaml (cache theo đường dẫn + thời điểm sửa file)."""
+    with open(path) as file:
+        loaded_config = yaml.load(file, Loader=SafeLoader)
+    tracing.info(f"Loaded auth config from '{path}' (mtime={mtime}).")
+    return loaded_config
+
 config = None
 config_path = 'config.yaml'
+config_mtime = None
 try:
     if os.path.exists(config_path):
-        with open(config_path) as file:
-            config = yaml.load(file, Loader=SafeLoader)
+        config_mtime = os.path.getmtime(config_path)
+        config = load_auth_config(config_path, config_mtime)
     else:
         st.error(f"Lỗi: Không tìm thấy file cấu hình tại '{config_path}'.")
         st.stop()
@@ -31,27 +56,43 @@ if not config:
     st.stop()
 
 # --- Lấy Cookie Key từ Secrets ---
+@st.cache_resource
+def load_cookie_key():
+    """Đọc và kiểm tra cookie key trong Secrets một lần (lỗi thì không cache, lần sau đọc lại)."""
+    key = st.secrets["cookie"]["key"]
+    if not key or len(key) < 32:
+        raise ValueError("Cookie key không hợp lệ.")
+    return key
+
 cookie_key = None
 try:
-    cookie_key = st.secrets["cookie"]["key"]
-    if not cookie_key or len(cookie_key) < 32:
-        raise ValueError("Cookie key không hợp lệ.")
+    cookie_key = load_cookie_key()
 except Exception as e:
      st.error(f"Lỗi cấu hình Cookie Key: {e}")
      st.stop()
 
 # --- Khởi tạo đối tượng Authenticator ---
+# Authenticator giữ CookieManager (một component gắn với phiên trình duyệt) nên không dùng chung giữa
+# các phiên: mỗi phiên giữ đối tượng của mình trong session_state sau khi đã đăng nhập. Trước khi đăng
+# nhập vẫn tạo mới ở mỗi lần chạy để component đọc cookie được vẽ lại (đăng nhập lại bằng cookie).
 authenticator = None
-try:
-    authenticator = stauth.Authenticate(
-        config['credentials'],
-        config['cookie']['name'],
-        cookie_key,
-        config['cookie']['expiry_days']
-    )
-except Exception as e:
-    st.error(f"Lỗi khởi tạo Authenticator: {e}")
-    st.stop()
+authenticator_key = (config_mtime, cookie_key)
+cached_authenticator = st.session_state.get("admin_authenticator")
+if (cached_authenticator is not None and cached_authenticator[0] == authenticator_key
+        and st.session_state.get("authentication_status")):
+    authenticator = cached_authenticator[1]
+else:
+    try:
+        authenticator = stauth.Authenticate(
+            copy.deepcopy(config['credentials']), # Authenticate sửa trực tiếp dict credentials
+            config['cookie']['name'],
+            cookie_key,
+            config['cookie']['expiry_days']
+        )
+        st.session_state.admin_authenticator = (authenticator_key, authenticator)
+    except Exception as e:
+        st.error(f"Lỗi khởi tạo Authenticator: {e}")
+        st.stop()
 
 if not authenticator:
      st.error("Lỗi: Không khởi tạo được Authenticator.")
@@ -78,199 +119,246 @@ elif authentication_status: # Đăng nhập thành công
     st.markdown("---")
 
     # --- PHẦN TƯƠNG TÁC CSDL ---
-    @st.cache_resource(ttl=600) # Cache kết nối trong 10 phút
-    def connect_db():
-        """Kết nối đến CSDL PostgreSQL."""
-        print("Attempting to connect to the database...") # Log
+    def get_db_pool():
+        """Lấy pool kết nối CSDL dùng chung của tiến trình (chung với app.py, xem db.get_pool)."""
         try:
-            if "uri" in st.secrets.get("database", {}):
-                 conn_uri = st.secrets["database"]["uri"]
-                 conn = psycopg2.connect(conn_uri)
-            elif "host" in st.secrets.get("database", {}):
-                 db_creds = st.secrets["database"]
-                 conn = psycopg2.connect(
-                     host=db_creds["host"],
-                     port=db_creds.get("port", 5432),
-                     dbname=db_creds["dbname"],
-                     user=db_creds["user"],
-                     password=db_creds["password"],
-                     sslmode=db_creds.get("sslmode", "require")
-                 )
-            else:
+            pool = db.get_pool(st.secrets.get("database", {}))
+            if pool is None:
                 st.error("Thiếu thông tin kết nối CSDL trong Streamlit Secrets.")
-                print("DB connection info missing in secrets.") # Log
-                return None
-            print("Database connection successful!") # Log
-            return conn
+                tracing.error("DB connection info missing in secrets.")
+            return pool
         except psycopg2.OperationalError as e:
              st.error(f"Lỗi kết nối CSDL: Không thể kết nối tới server. Kiểm tra host, port, network, SSL và thông tin xác thực.")
-             print(f"DB Connection OperationalError: {e}") # Log
+             tracing.error(f"DB Connection OperationalError: {e}")
              return None
         except Exception as e:
             st.error(f"Lỗi kết nối CSDL: {e}")
-            print(f"DB Connection Error: {e}") # Log
+            tracing.error(f"DB Connection Error: {e}")
+            return None
+
+    db_pool = get_db_pool()
+
+    @st.cache_resource # Một listener (một kết nối LISTEN) cho cả tiến trình
+    def get_alert_listener():
+        """Khởi động luồng LISTEN nhận id cảnh báo mới từ CSDL."""
+        db_secrets = st.secrets.get("database", {})
+        # LISTEN cần kết nối trực tiếp (không qua PgBouncer): cho phép cấu hình riêng `listen_uri`
+        if "listen_uri" in db_secrets:
+            connect_kwargs = {"dsn": db_secrets["listen_uri"]}
+        else:
+            connect_kwargs = connect_kwargs_from_secrets(db_secrets)
+        if connect_kwargs is None:
             return None
+        return AlertListener(connect_kwargs)
+
+    alert_listener = get_alert_listener()
 
-    db_connection = connect_db()
+    # Chỉ phần này tự chạy lại định kỳ (không rerun cả trang); bản Streamlit cũ không có fragment thì bỏ qua
+    _fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    NEW_ALERTS_POLL_SECONDS = 5
 
     # --- Định nghĩa các hàm tương tác CSDL ---
 
-    @st.cache_data(ttl=300) # Cache dữ liệu stats trong 5 phút
-    def fetch_dashboard_stats(_conn): # Đổi tên tham số để tránh xung đột cache nếu dùng conn trực tiếp
+    # Các hàm cache nhận `data_version` (từ cache_versions) làm một phần khóa cache:
+    # khi cảnh báo bị ghi, phiên bản tăng và chỉ các cache liên quan được làm mới.
+    @st.cache_data(ttl=300, max_entries=20) # Cache dữ liệu stats trong 5 phút
+    def fetch_dashboard_stats(_pool, data_version=0): # Tham số bắt đầu bằng '_' để Streamlit không hash pool
         """Lấy các số liệu thống kê từ CSDL."""
-        if _conn is None:
+        if _pool is None:
             return {"weekly_chats": "N/A", "new_alerts": "N/A", "popular_topic": "N/A"}
+        cache_versions.record_miss("stats")
 
-        print("Fetching dashboard stats from DB...") # Log
+        tracing.debug("Fetching dashboard stats from DB...")
         stats = {"weekly_chats": "N/A", "new_alerts": "N/A", "popular_topic": "N/A"}
-        cursor = None
         try:
-            cursor = _conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM alerts WHERE status = 'Mới'")
-            result_alerts = cursor.fetchone()
-            stats["new_alerts"] = result_alerts[0] if result_alerts else 0
-
-            # TODO: Implement weekly chats count (requires 'conversations' table with timestamp)
-            stats["weekly_chats"] = "N/A"
-
-            cursor.execute("""
-                SELECT reason, COUNT(*) as count FROM alerts
-                GROUP BY reason ORDER BY count DESC LIMIT 1
-            """)
-            popular = cursor.fetchone()
-            stats["popular_topic"] = popular[0] if popular else "Không có"
-
-            print(f"Fetched stats: {stats}") # Log
+            # Đọc từ bảng rollup được trigger cập nhật dần (xem rollups.py)
+            with _pool.connection() as conn:
+                stats = db.fetch_dashboard_stats(conn)
+            tracing.debug(f"Fetched stats: {stats}")
             return stats
         except Exception as e:
             st.error(f"Lỗi truy vấn thống kê: {e}")
-            print(f"Error in fetch_dashboard_stats: {e}")
+            tracing.error(f"Error in fetch_dashboard_stats: {e}")
             return stats
-        finally:
-             if cursor: cursor.close()
 
-    @st.cache_data(ttl=60) # Cache danh sách alerts trong 1 phút
-    def fetch_alerts(_conn, status_filter=None):
-        """Lấy danh sách cảnh báo từ CSDL."""
-        if _conn is None:
+    ALERTS_PAGE_SIZE = 50 # Số cảnh báo mỗi trang
+
+    @st.cache_data(ttl=60, max_entries=200) # Cache từng trang alerts trong 1 phút
+    def fetch_alerts(_pool, status_filter=None, older_than=None, newer_than=None, page_size=ALERTS_PAGE_SIZE, data_version=0):
+        """Lấy một trang cảnh báo từ CSDL (lọc trạng thái và phân trang theo khóa (timestamp, id) trong SQL).
+
+        Trả về (DataFrame, has_more).
+        """
+        if _pool is None:
              st.warning("Không có kết nối CSDL, không thể tải cảnh báo.")
-             return pd.DataFrame() # Trả về rỗng nếu không có kết nối
+             return pd.DataFrame(), False # Trả về rỗng nếu không có kết nối
+        cache_versions.record_miss("alerts_page")
 
-        print(f"Fetching alerts from DB with filter: {status_filter}") # Log
+        tracing.debug(f"Fetching alerts page from DB: filter={status_filter}, older_than={older_than}, newer_than={newer_than}")
         df = pd.DataFrame() # Khởi tạo df rỗng
         try:
-            # KIỂM TRA LẠI TÊN CỘT CHO KHỚP CSDL CỦA BẠN
-            query = "SELECT id, timestamp, reason, snippet, status, assignee, priority, chat_session_id FROM alerts"
-            params = []
-            if status_filter and status_filter != "Tất cả":
-                query += " WHERE status = %s"
-                params.append(status_filter)
-            query += " ORDER BY timestamp DESC"
-
-            df = pd.read_sql(query, _conn, params=params)
-            print(f"Fetched {len(df)} alerts from DB.") # Log
+            status = status_filter if status_filter and status_filter != "Tất cả" else None
+            # Câu lệnh SELECT nằm trong db.STATEMENTS (KIỂM TRA LẠI TÊN CỘT CHO KHỚP CSDL CỦA BẠN)
+            with _pool.connection() as conn:
+                df, has_more = db.fetch_alerts_page(conn, status, older_than, newer_than, page_size)
+            tracing.debug(f"Fetched {len(df)} alerts from DB.")
 
             if not df.empty:
                 if 'timestamp' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['timestamp']):
                      df['timestamp'] = pd.to_datetime(df['timestamp'])
                 # Xử lý timezone nếu cần
-            return df
+            return df, has_more
         except Exception as e:
             st.error(f"LỖI fetch_alerts: Không thể tải danh sách cảnh báo. Chi tiết: {e}")
-            print(f"Error fetching alerts: {e}")
-            return df # Trả về df rỗng
+            tracing.error(f"Error fetching alerts: {e}")
+            return df, False # Trả về df rỗng
 
-    def update_alert_status_in_db(conn, alert_id, new_status, assignee):
-        """Cập nhật trạng thái và người phụ trách của cảnh báo trong CSDL."""
-        if conn is None: return False # Lỗi đã báo ở nơi khác
-        cursor = None
+    @st.cache_data(ttl=60, max_entries=500)
+    def fetch_alert_details(_pool, alert_id, data_version=0):
+        """Lấy chi tiết một cảnh báo theo ID (dict hoặc None)."""
+        if _pool is None:
+            return None
+        cache_versions.record_miss("alert_detail")
         try:
-            cursor = conn.cursor()
-            print(f"Updating alert ID: {alert_id} to Status: {new_status}, Assignee: {assignee}") # Log
-            # KIỂM TRA TÊN BẢNG/CỘT
-            cursor.execute(
-                "UPDATE alerts SET status = %s, assignee = %s WHERE id = %s",
-                (new_status, assignee, alert_id)
-            )
-            conn.commit() # Lưu thay đổi
-            if cursor.rowcount > 0:
-                print(f"DB Update successful for alert ID {alert_id}.") # Log
-                # Xóa cache của fetch_alerts để lấy dữ liệu mới
-                st.cache_data.clear() # Xóa toàn bộ cache @st.cache_data (có thể ảnh hưởng hàm khác)
-                # Hoặc nếu có cách xóa cache cụ thể cho fetch_alerts thì dùng (Streamlit có thể chưa hỗ trợ trực tiếp)
-                # fetch_alerts.clear() # Lệnh này có thể không tồn tại trực tiếp
-                return True
-            else:
-                st.warning(f"Không tìm thấy cảnh báo ID {alert_id} để cập nhật hoặc trạng thái không thay đổi.")
-                conn.rollback()
-                return False
+            with _pool.connection() as conn:
+                return db.fetch_alert_by_id(conn, alert_id)
         except Exception as e:
-            if conn: conn.rollback()
-            st.error(f"Lỗi CSDL khi cập nhật cảnh báo ID {alert_id}: {e}")
-            print(f"Error updating alert {alert_id}: {e}")
-            return False
-        finally:
-            if cursor: cursor.close()
+            st.error(f"LỖI fetch_alert_details cho ID {alert_id}: {e}")
+            tracing.error(f"Error fetching alert {alert_id}: {e}")
+            return None
 
-    def add_faq_to_db(conn, question, answer, category=None):
+    def show_new_alerts():
+        """Hiển thị các cảnh báo mới nhận qua NOTIFY kể từ khi phiên admin này mở trang."""
+        if alert_listener is None:
+            return
+        if "alert_notify_sequence" not in st.session_state:
+            st.session_state.alert_notify_sequence = alert_listener.latest_sequence()
+            st.session_state.new_alert_ids = []
+        alert_ids, latest = alert_listener.events_since(st.session_state.alert_notify_sequence)
+        st.session_state.alert_notify_sequence = latest
+        if alert_ids:
+            st.toast(f"🔔 Có {len(alert_ids)} cảnh báo mới!")
+            st.session_state.new_alert_ids = (alert_ids + st.session_state.new_alert_ids)[:ALERTS_PAGE_SIZE]
+        if not st.session_state.new_alert_ids:
+            if not alert_listener.connected:
+                st.caption("⚠️ Chưa kết nối kênh thông báo cảnh báo mới (LISTEN).")
+            return
+        try:
+            # Chỉ lấy đúng các dòng mới theo id, không truy vấn lại cả bảng
+            with db_pool.connection() as conn:
+                new_alerts_df = db.fetch_alerts_by_ids(conn, st.session_state.new_alert_ids)
+        except Exception as e:
+            st.error(f"Lỗi tải cảnh báo mới: {e}")
+            tracing.error(f"Error fetching new alerts: {e}")
+            return
+        st.subheader(f"🔔 Cảnh báo mới ({len(new_alerts_df)})")
+        st.dataframe(new_alerts_df, use_container_width=True, hide_index=True)
+        if st.button("Đã xem", key="dismiss_new_alerts"):
+            st.session_state.new_alert_ids = []
+            st.rerun()
+
+    if _fragment is not None:
+        show_new_alerts = _fragment(run_every=NEW_ALERTS_POLL_SECONDS)(show_new_alerts)
+
+    def _page_anchor(row):
+        """Mốc phân trang (timestamp, id) của một dòng cảnh báo, dạng kiểu Python thuần để truyền vào SQL."""
+        return (row["timestamp"].to_pydatetime(), int(row["id"]))
+
+    def update_alerts_in_db(pool, alert_ids, new_status, assignee):
+        """Cập nhật trạng thái và người phụ trách cho một hoặc nhiều cảnh báo.
+
+        Một câu UPDATE ... WHERE id = ANY(...) trong một giao dịch; chỉ làm mới cache của danh sách/thống kê
+        cảnh báo và của đúng các cảnh báo vừa sửa. Trả về danh sách id đã cập nhật.
+        """
+        if pool is None or not alert_ids: return [] # Lỗi đã báo ở nơi khác
+        alert_ids = [int(alert_id) for alert_id in alert_ids]
+        tracing.info(f"Updating {len(alert_ids)} alert(s) {alert_ids} to Status: {new_status}, Assignee: {assignee}")
+        try:
+            with pool.connection() as conn, tracing.span("alert.update", count=len(alert_ids)):
+                updated_ids = db.update_alerts(conn, alert_ids, new_status, assignee)
+                conn.commit() # Lỗi giữa chừng: pool rollback khi nhận lại kết nối, không dòng nào bị đổi
+        except Exception as e:
+            st.error(f"Lỗi CSDL khi cập nhật cảnh báo {alert_ids}: {e}")
+            tracing.error(f"Error updating alerts {alert_ids}: {e}")
+            return []
+        if updated_ids:
+            tracing.info(f"DB Update successful for alert IDs {updated_ids}.")
+            cache_versions.bump("alerts", *(f"alert:{alert_id}" for alert_id in updated_ids))
+        missing_ids = sorted(set(alert_ids) - set(updated_ids))
+        if missing_ids:
+            st.warning(f"Không tìm thấy cảnh báo ID {', '.join(map(str, missing_ids))} để cập nhật.")
+        return updated_ids
+
+    # Các callback chạy TRƯỚC lần chạy lại do nút bấm gây ra, nên trang vẽ ngay dữ liệu mới mà không cần st.rerun()
+    def _apply_alert_update(alert_ids, status_key, assignee_key):
+        updated_ids = update_alerts_in_db(db_pool, alert_ids, st.session_state[status_key], st.session_state[assignee_key])
+        if updated_ids:
+            st.session_state.alert_update_result = (updated_ids, st.session_state[status_key])
+
+    def add_faq_to_db(pool, question, answer, category=None):
         """Thêm FAQ mới vào CSDL."""
-        if conn is None: return False
+        if pool is None: return False
+        conn = None
         cursor = None
         try:
-            cursor = conn.cursor()
-            # KIỂM TRA TÊN BẢNG/CỘT
-            print(f"Adding FAQ: Q='{question[:30]}...', Cat='{category}'") # Log
-            cursor.execute(
-                "INSERT INTO knowledge_base (question, answer, category) VALUES (%s, %s, %s)",
-                (question, answer, category)
-            )
+            conn = pool.getconn()
+            tracing.info(f"Adding FAQ: Q='{question[:30]}...', Cat='{category}'")
+            cursor = db.execute(conn, "insert_faq", (question, answer, category))
             conn.commit()
-            print("FAQ added successfully to DB.") # Log
-            # Cần xóa cache nếu có hàm fetch_faqs
-            # fetch_faqs.clear() # Ví dụ
+            tracing.info("FAQ added successfully to DB.")
+            # Chỉ mục FAQ của trợ lý chat sẽ nạp thêm FAQ mới ở lần tra cứu kế tiếp
+            cache_versions.bump("knowledge_base")
             return True
         except Exception as e:
-            if conn: conn.rollback()
+            if conn and not conn.closed: conn.rollback()
             st.error(f"Lỗi CSDL khi thêm FAQ: {e}")
-            print(f"Error adding FAQ: {e}")
+            tracing.error(f"Error adding FAQ: {e}")
             return False
         finally:
             if cursor: cursor.close()
+            if conn: pool.putconn(conn)
 
-    #@st.cache_data(ttl=300) # Cache lịch sử chat nếu cần
-    def fetch_chat_history(_conn, session_id):
-        """Lấy lịch sử chat cho một session_id cụ thể từ CSDL."""
-        if _conn is None or not session_id:
-            # st.warning("Yêu cầu Session ID để truy vấn lịch sử chat.")
-            return pd.DataFrame()
+    TRANSCRIPT_CHUNK_ROWS = 200 # Số tin nhắn đọc từ cursor phía server mỗi lần
 
-        print(f"Fetching chat history for session: {session_id}") # Log
-        df = pd.DataFrame()
+    def count_chat_messages(_pool, session_id):
+        """Số tin nhắn của một phiên (đếm trên index, không đọc nội dung)."""
+        if _pool is None or not session_id:
+            return 0
         try:
-            # KIỂM TRA TÊN BẢNG/CỘT
-            query = """
-                SELECT message_id, timestamp, sender, message_content, user_id -- Lấy các cột cần thiết
-                FROM conversations
-                WHERE session_id = %s
-                ORDER BY timestamp ASC
-            """
-            df = pd.read_sql(query, _conn, params=(session_id,))
-            print(f"Fetched {len(df)} messages for session {session_id}.") # Log
+            with _pool.connection() as conn:
+                return db.fetch_scalar(conn, "chat_history_count", (session_id,)) or 0
+        except Exception as e:
+            st.error(f"LỖI đếm tin nhắn cho session {session_id}: {e}")
+            tracing.error(f"Error counting chat history for {session_id}: {e}")
+            return 0
 
-            if not df.empty:
-                if 'timestamp' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['timestamp']):
-                     df['timestamp'] = pd.to_datetime(df['timestamp'])
-                # Xử lý timezone nếu cần
-            return df
+    def stream_chat_history(_pool, session_id, skip=0):
+        """Đọc lịch sử chat của một phiên qua cursor phía server, mỗi lần TRANSCRIPT_CHUNK_ROWS tin nhắn.
+
+        Yield từng DataFrame đã có sẵn cột role / content / time_str (tính theo cột cho cả khối).
+        """
+        tracing.debug(f"Streaming chat history for session: {session_id} (skip={skip})")
+        streamed = 0
+        try:
+            with _pool.connection() as conn:
+                for columns, rows in db.stream_rows(conn, "chat_history", (session_id,), TRANSCRIPT_CHUNK_ROWS, skip):
+                    df = pd.DataFrame.from_records(rows, columns=columns)
+                    df['timestamp'] = pd.to_datetime(df['timestamp'])
+                    df['role'] = (df['sender'].astype(str).str.lower() == 'user').map({True: "user", False: "assistant"})
+                    df['content'] = df['message_content'].fillna('')
+                    time_text = df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S').fillna('')
+                    df['time_str'] = "User: " + df['user_id'].fillna('Ẩn danh').astype(str) + " | Time: " + time_text # Cân nhắc ẩn user_id
+                    streamed += len(df)
+                    yield df
+            tracing.debug(f"Streamed {streamed} messages for session {session_id}.")
         except Exception as e:
-            st.error(f"LỖI fetch_chat_history cho session {session_id}: {e}")
-            print(f"Error fetching chat history for {session_id}: {e}")
-            return df # Trả về rỗng
+            st.error(f"LỖI đọc lịch sử chat cho session {session_id}: {e}")
+            tracing.error(f"Error streaming chat history for {session_id}: {e}")
 
     # --- KẾT THÚC ĐỊNH NGHĨA HÀM CSDL ---
 
     # --- Kiểm tra kết nối và hiển thị nội dung chính ---
-    if db_connection is None:
+    if db_pool is None:
         st.warning("Không thể kết nối đến Cơ sở dữ liệu. Vui lòng kiểm tra cấu hình hoặc liên hệ quản trị viên.")
         # Có thể dừng ở đây hoặc hiển thị phần không cần DB
         st.stop()
@@ -279,7 +367,7 @@ elif authentication_status: # Đăng nhập thành công
 
         # --- Hiển thị Dashboard Tổng quan ---
         st.header("📈 Tổng quan Hoạt động")
-        stats = fetch_dashboard_stats(db_connection)
+        stats = fetch_dashboard_stats(db_pool, data_version=cache_versions.lookup("stats", "alerts"))
         col1, col2, col3 = st.columns(3)
         col1.metric("Cuộc trò chuyện (7 ngày)", stats.get("weekly_chats", "N/A"))
         col2.metric("Cảnh báo mới", stats.get("new_alerts", "N/A"))
@@ -289,19 +377,29 @@ elif authentication_status: # Đăng nhập thành công
 
         # --- Quản lý Cảnh báo ---
         st.header("🚨 Quản lý Cảnh báo")
-        # Lấy dữ liệu alerts (sử dụng cache nếu fetch_alerts được cache)
-        alerts_df = fetch_alerts(db_connection)
+        show_new_alerts()
+        alert_update_result = st.session_state.pop("alert_update_result", None) # Kết quả cập nhật ở lần bấm trước
+        if alert_update_result:
+            updated_ids, updated_status = alert_update_result
+            st.success(f"Đã cập nhật {len(updated_ids)} cảnh báo sang '{updated_status}': {', '.join(map(str, updated_ids))}")
+        status_options = ["Tất cả", "Mới", "Đang xử lý", "Đã giải quyết"]
+        if "alerts_page_anchor" not in st.session_state:
+            st.session_state.alerts_page_anchor = {} # {} = trang đầu; {"older_than": ...} hoặc {"newer_than": ...}
+
+        def _reset_alert_paging():
+            st.session_state.alerts_page_anchor = {}
+
+        selected_status = st.selectbox("Lọc theo trạng thái:", status_options, key="alert_status_filter",
+                                       on_change=_reset_alert_paging)
+        # Lọc và phân trang thực hiện trong SQL (sử dụng cache nếu fetch_alerts được cache)
+        page_anchor = st.session_state.alerts_page_anchor
+        alerts_df, has_more = fetch_alerts(db_pool, selected_status, **page_anchor,
+                                           data_version=cache_versions.lookup("alerts_page", "alerts"))
 
         if isinstance(alerts_df, pd.DataFrame) and not alerts_df.empty:
-            st.info(f"Tìm thấy {len(alerts_df)} cảnh báo.")
-            status_options = ["Tất cả", "Mới", "Đang xử lý", "Đã giải quyết"]
-            selected_status = st.selectbox("Lọc theo trạng thái:", status_options, key="alert_status_filter")
-
-            display_df = alerts_df.copy()
-            if selected_status != "Tất cả":
-                display_df = display_df[display_df['status'] == selected_status]
+            st.info(f"Đang hiển thị {len(alerts_df)} cảnh báo.")
 
-            st.dataframe(display_df, use_container_width=True, hide_index=True,
+            st.dataframe(alerts_df, use_container_width=True, hide_index=True,
                          column_config={ # Định dạng cột timestamp
                              "timestamp": st.column_config.DatetimeColumn(
                                  "Thời gian",
@@ -309,14 +407,52 @@ elif authentication_status: # Đăng nhập thành công
                              )
                          })
 
+            # Trang trước/sau: đang đi về phía nào thì has_more cho biết còn trang theo hướng đó
+            has_newer = has_more if "newer_than" in page_anchor else bool(page_anchor)
+            has_older = has_more if "newer_than" not in page_anchor else True
+            nav_prev, nav_next = st.columns(2)
+            if nav_prev.button("← Mới hơn", disabled=not has_newer, key="alerts_newer_page"):
+                st.session_state.alerts_page_anchor = {"newer_than": _page_anchor(alerts_df.iloc[0])}
+                st.rerun()
+            if nav_next.button("Cũ hơn →", disabled=not has_older, key="alerts_older_page"):
+                st.session_state.alerts_page_anchor = {"older_than": _page_anchor(alerts_df.iloc[-1])}
+                st.rerun()
+
+            # --- Xử lý hàng loạt: chọn nhiều cảnh báo trên trang, cập nhật bằng một câu UPDATE ---
+            st.subheader("Xử lý hàng loạt")
+            page_alert_ids = [int(alert_id) for alert_id in alerts_df['id']]
+            alert_reasons = dict(zip(page_alert_ids, alerts_df['reason'].fillna('')))
+            if st.checkbox(f"Chọn tất cả {len(page_alert_ids)} cảnh báo trên trang này", key="triage_select_all"):
+                triage_ids = page_alert_ids
+            else:
+                triage_ids = st.multiselect(
+                    "Chọn các cảnh báo cần xử lý:", options=page_alert_ids,
+                    format_func=lambda alert_id: f"#{alert_id} · {alert_reasons.get(alert_id, '')}",
+                    # Khóa theo nội dung trang: sang trang khác/cảnh báo đã xử lý rời trang thì bỏ chọn cũ
+                    key=f"triage_alert_ids_{page_alert_ids[0]}_{page_alert_ids[-1]}_{len(page_alert_ids)}"
+                )
+            triage_status_col, triage_assignee_col = st.columns(2)
+            triage_status_col.selectbox("Trạng thái mới:", ["Mới", "Đang xử lý", "Đã giải quyết"], index=1, key="triage_status")
+            triage_assignee_col.text_input("Người phụ trách:", value=name, key="triage_assignee")
+            st.button(
+                f"Áp dụng cho {len(triage_ids)} cảnh báo", disabled=not triage_ids, key="triage_apply",
+                on_click=_apply_alert_update, args=(triage_ids, "triage_status", "triage_assignee")
+            )
+
             st.subheader("Xem và Cập nhật Cảnh báo")
-            alert_id_options = [""] + list(alerts_df['id'].astype(str).unique())
+            alert_id_options = [""] + [str(alert_id) for alert_id in alerts_df['id']]
             selected_alert_id_str = st.selectbox("Chọn ID cảnh báo để xử lý:", alert_id_options, key="alert_id_select")
 
             if selected_alert_id_str:
                 try:
-                    selected_data_series = alerts_df[alerts_df['id'].astype(str) == selected_alert_id_str].iloc[0]
-                    selected_data = selected_data_series.to_dict()
+                    # Lấy trực tiếp theo ID từ CSDL thay vì dò trong toàn bộ DataFrame
+                    selected_alert_id = int(selected_alert_id_str)
+                    selected_data = fetch_alert_details(
+                        db_pool, selected_alert_id,
+                        data_version=cache_versions.lookup("alert_detail", f"alert:{selected_alert_id}")
+                    )
+                    if selected_data is None:
+                        raise IndexError(selected_alert_id_str)
 
                     st.write(f"**Chi tiết cảnh báo ID:** `{selected_data.get('id', 'N/A')}`")
                     ts = selected_data.get('timestamp')
@@ -337,35 +473,34 @@ elif authentication_status: # Đăng nhập thành công
                         except ValueError:
                             current_status_index = 0 # Mặc định về 'Mới'
 
-                        new_status = st.selectbox("Trạng thái mới:", options=status_update_options, index=current_status_index, key=f"status_update_{selected_alert_id_str}")
+                        st.selectbox("Trạng thái mới:", options=status_update_options, index=current_status_index, key=f"status_update_{selected_alert_id_str}")
                         current_assignee = selected_data.get('assignee')
                         default_assignee = name if pd.isna(current_assignee) else current_assignee
-                        assignee = st.text_input("Người phụ trách:", value=default_assignee, key=f"assignee_{selected_alert_id_str}")
-
-                        submitted = st.form_submit_button("Lưu thay đổi")
-                        if submitted:
-                            original_alert_id = selected_data.get('id')
-                            if original_alert_id is not None:
-                                success = update_alert_status_in_db(db_connection, original_alert_id, new_status, assignee)
-                                if success:
-                                    st.success(f"Đã gửi yêu cầu cập nhật cảnh báo {original_alert_id}!")
-                                    st.rerun()
-                            else:
-                                st.error("Không thể xác định ID cảnh báo để cập nhật.")
+                        st.text_input("Người phụ trách:", value=default_assignee, key=f"assignee_{selected_alert_id_str}")
+
+                        st.form_submit_button(
+                            "Lưu thay đổi", on_click=_apply_alert_update,
+                            args=([selected_alert_id], f"status_update_{selected_alert_id_str}", f"assignee_{selected_alert_id_str}")
+                        )
                 except IndexError:
                      st.warning(f"Không tìm thấy dữ liệu chi tiết cho ID: {selected_alert_id_str}")
                 except Exception as e:
                      st.error(f"Lỗi khi hiển thị chi tiết cảnh báo: {e}")
-                     print(f"Error rendering alert details {selected_alert_id_str}: {e}")
+                     tracing.error(f"Error rendering alert details {selected_alert_id_str}: {e}")
 
-        elif db_connection is not None:
-            st.info("Hiện không có cảnh báo nào trong cơ sở dữ liệu.")
+        elif page_anchor:
+            st.info("Không còn cảnh báo nào ở trang này.")
+            if st.button("Về trang đầu", key="alerts_first_page"):
+                _reset_alert_paging()
+                st.rerun()
+        elif db_pool is not None:
+            st.info("Hiện không có cảnh báo nào phù hợp trong cơ sở dữ liệu.")
 
         st.markdown("---")
 
         # --- Quản lý Cơ sở Kiến thức ---
         st.header("📚 Quản lý Cơ sở Kiến thức")
-        # TODO: Thêm code fetch và hiển thị FAQ (ví dụ: dùng st.dataframe(fetch_faqs(db_connection)))
+        # TODO: Thêm code fetch và hiển thị FAQ (ví dụ: dùng st.dataframe(fetch_faqs(db_pool)))
         st.info("Chức năng xem/sửa/xóa FAQ đang được phát triển.")
 
         with st.expander("Thêm câu hỏi thường gặp (FAQ) mới"):
@@ -375,7 +510,7 @@ elif authentication_status: # Đăng nhập thành công
             new_category = st.text_input("Chủ đề (Category):", key="faq_new_category")
             if st.button("Thêm FAQ", key="faq_add_button"):
                 if new_question and new_answer:
-                    success = add_faq_to_db(db_connection, new_question, new_answer, new_category)
+                    success = add_faq_to_db(db_pool, new_question, new_answer, new_category)
                     if success:
                         st.success("Đã thêm FAQ vào Cơ sở dữ liệu thành công!")
                         # Có thể rerun hoặc xóa cache của hàm fetch_faqs nếu có
@@ -402,22 +537,108 @@ elif authentication_status: # Đăng nhập thành công
 
         if session_id_to_fetch:
             st.write(f"Đang tải lịch sử cho Session ID: `{session_id_to_fetch}`")
-            chat_history_df = fetch_chat_history(db_connection, session_id_to_fetch) # Sử dụng hàm đã định nghĩa
+            message_count = count_chat_messages(db_pool, session_id_to_fetch)
 
-            if isinstance(chat_history_df, pd.DataFrame) and not chat_history_df.empty:
-                st.write(f"**Lịch sử chat ({len(chat_history_df)} tin nhắn):**")
-                # Hiển thị dạng chat message
+            if message_count:
+                st.write(f"**Lịch sử chat ({message_count} tin nhắn):**")
+                # Hiển thị dạng chat message; từng khối được vẽ ngay khi đọc xong (phiên dài không phải chờ đọc hết)
                 chat_container = st.container(height=400) # Đặt chiều cao cố định và thanh cuộn
                 with chat_container:
-                    for index, row in chat_history_df.iterrows():
-                        role = "user" if str(row.get('sender', '')).lower() == 'user' else "assistant"
-                        timestamp_str = row['timestamp'].strftime('%Y-%m-%d %H:%M:%S') if pd.notna(row.get('timestamp')) else ""
-                        with st.chat_message(role, avatar= "🧑‍🎓" if role=='user' else "🤖"): # Thêm avatar đơn giản
-                             st.markdown(row.get('message_content', ''))
-                             st.caption(f"User: {row.get('user_id', 'Ẩn danh')} | Time: {timestamp_str}") # Cân nhắc ẩn user_id
-            elif db_connection:
+                    chat_view.render_chat_stream(
+                        lambda skip: stream_chat_history(db_pool, session_id_to_fetch, skip),
+                        key=f"transcript_{session_id_to_fetch}", total=message_count
+                    )
+            elif db_pool:
                 st.info(f"Không tìm thấy lịch sử chat cho Session ID: {session_id_to_fetch}")
 
+        # Xuất hàng loạt (báo cáo cuối kỳ, rà soát an toàn): COPY thẳng ra file tạm rồi nén zip để tải về.
+        # Khoảng thời gian rất lớn nên chạy `python transcript_export.py` trên máy chủ (chia file, Parquet).
+        with st.expander("📦 Xuất hội thoại hàng loạt (CSV)"):
+            today = datetime.date.today()
+            export_range = st.date_input(
+                "Khoảng thời gian:", value=(today - datetime.timedelta(days=7), today), key="export_range"
+            )
+            export_flagged_only = st.checkbox("Chỉ các phiên có cảnh báo", key="export_flagged_only")
+            if st.button("Tạo file xuất", key="export_button") and db_pool and len(export_range) == 2:
+                export_dir = tempfile.mkdtemp(prefix="transcripts_")
+                try:
+                    with st.spinner("Đang xuất dữ liệu..."):
+                        with db_pool.connection() as conn:
+                            export_results = transcript_export.export_transcripts(
+                                conn, export_dir, chunk_rows=0,
+                                start=datetime.datetime.combine(export_range[0], datetime.time.min),
+                                end=datetime.datetime.combine(export_range[1] + datetime.timedelta(days=1), datetime.time.min),
+                                flagged_only=export_flagged_only,
+                            )
+                        zip_path = os.path.join(export_dir, "transcripts.zip")
+                        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                            for export_stats in export_results.values():
+                                for path in export_stats["paths"]:
+                                    archive.write(path, os.path.basename(path))
+                    for export_name, export_stats in export_results.items():
+                        st.caption(f"{export_name}: {export_stats['rows']} dòng trong {export_stats['seconds']:.2f}s "
+                                   f"({export_stats['rows_per_second']:.0f} dòng/s)")
+                    tracing.info(f"Transcript export {export_range[0]}..{export_range[1]} (flagged_only={export_flagged_only}): "
+                                 + ", ".join(f"{export_name}={export_stats['rows']}" for export_name, export_stats in export_results.items()))
+                    with open(zip_path, "rb") as file:
+                        st.download_button(
+                            "Tải file xuất (.zip)", file, key="export_download",
+                            file_name=f"transcripts_{export_range[0]}_{export_range[1]}.zip", mime="application/zip"
+                        )
+                except Exception as e:
+                    st.error(f"Lỗi khi xuất dữ liệu: {e}")
+                    tracing.error(f"Error exporting transcripts: {type(e).__name__}: {e}")
+                finally:
+                    shutil.rmtree(export_dir, ignore_errors=True)
+
+        st.markdown("---")
+
+        # --- Số liệu hiệu năng CSDL (theo tiến trình) ---
+        with st.expander("🛠️ Số liệu truy vấn CSDL"):
+            statement_stats = db.statement_stats()
+            if statement_stats:
+                st.dataframe(
+                    pd.DataFrame.from_dict(statement_stats, orient="index").sort_values("total_ms", ascending=False),
+                    use_container_width=True
+                )
+            else:
+                st.info("Chưa có câu lệnh nào được ghi nhận.")
+            st.caption(f"Pool kết nối: {db_pool.stats}")
+            st.write("**Thư viện FAQ trong luồng chat (tiến trình hiện tại):**")
+            st.json(knowledge_index.get_index(db_pool).stats())
+            st.write("**Cache dữ liệu (tiến trình hiện tại):**")
+            st.dataframe(pd.DataFrame.from_dict(cache_versions.cache_stats(), orient="index"), use_container_width=True)
+            history_stats = session_store.shared_stats()
+            if history_stats is not None:
+                st.write("**Bộ nhớ lịch sử chat các phiên đang mở (tiến trình hiện tại):**")
+                st.json(history_stats)
+            writer_stats = message_writer.shared_stats()
+            if writer_stats is not None:
+                st.write("**Hàng đợi ghi tin nhắn (tiến trình hiện tại):**")
+                writer_cols = st.columns(4)
+                writer_cols[0].metric("Đang chờ ghi", writer_stats["queue_depth"])
+                writer_cols[1].metric("Flush TB (ms)", f"{writer_stats['avg_flush_ms']:.1f}")
+                writer_cols[2].metric("Flush lâu nhất (ms)", f"{writer_stats['max_flush_ms']:.1f}")
+                writer_cols[3].metric("Lỗi / bỏ", f"{writer_stats['failed_flushes']} / {writer_stats['dropped']}")
+            span_stats = tracing.snapshot()
+            if span_stats:
+                st.write("**Thời gian các giai đoạn xử lý (tracing, tiến trình hiện tại):**")
+                st.dataframe(
+                    pd.DataFrame.from_dict(span_stats, orient="index")[["count", "avg_ms", "max_ms", "errors"]],
+                    use_container_width=True
+                )
+                value_stats = tracing.value_snapshot()
+                if value_stats:
+                    st.write("**Kích thước theo lượt (vd: token prompt gửi Gemini):**")
+                    st.dataframe(
+                        pd.DataFrame.from_dict(value_stats, orient="index")[["count", "avg", "max"]],
+                        use_container_width=True
+                    )
+                st.download_button(
+                    "Tải số liệu (Prometheus text)", tracing.export_prometheus(),
+                    file_name="metrics.prom", mime="text/plain"
+                )
+
         st.markdown("---")
 
         # --- Các phần khác (Placeholder) ---
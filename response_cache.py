@@ -0,0 +1,220 @@
+# response_cache.py
+# Cache câu trả lời của Gemini dùng chung cho mọi phiên trong tiến trình:
+# khớp chính xác theo (câu hỏi đã chuẩn hóa + dấu vân tay lịch sử), và khớp gần đúng
+# (shingle Jaccard) cho câu hỏi MỞ ĐẦU phiên - nơi nhiều học sinh hỏi cùng một điều.
+
+import hashlib
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import db
+import tracing
+from risk_detector import normalize_text
+
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+CACHE_DDL = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    cache_key TEXT PRIMARY KEY,
+    prompt_norm TEXT NOT NULL,
+    first_turn BOOLEAN NOT NULL,
+    response TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+
+def normalize_prompt(prompt):
+    """Chuẩn hóa câu hỏi làm khóa cache: NFC, chữ thường, bỏ dấu câu, gộp khoảng trắng."""
+    return normalize_text(_PUNCT_RE.sub(" ", prompt or ""))
+
+
+def history_fingerprint(history):
+    """Dấu vân tay của lịch sử hội thoại trước câu hỏi (rỗng nếu là lượt đầu).
+
+    `history` là danh sách message dạng {"role", "content", ...} như st.session_state.gemini_history;
+    lời chào mặc định không tính.
+    """
+    digest = hashlib.sha1()
+    turns = 0
+    for message in history:
+        if message.get("is_greeting") or message.get("role") not in ("user", "assistant"):
+            continue
+        digest.update(message["role"].encode())
+        digest.update(b"\0")
+        digest.update(normalize_prompt(message["content"]).encode())
+        digest.update(b"\0")
+        turns += 1
+    return digest.hexdigest() if turns else ""
+
+
+def _shingles(prompt_norm, size=3):
+    """Tập shingle 3 ký tự trên câu hỏi đã chuẩn hóa (bỏ khoảng trắng để chịu được lỗi gõ cách)."""
+    compact = prompt_norm.replace(" ", "")
+    if len(compact) <= size:
+        return {compact} if compact else set()
+    return {compact[i:i + size] for i in range(len(compact) - size + 1)}
+
+
+class _Entry:
+    __slots__ = ("prompt_norm", "response", "created", "size", "shingles")
+
+    def __init__(self, prompt_norm, response, created, shingles):
+        self.prompt_norm = prompt_norm
+        self.response = response
+        self.created = created
+        self.shingles = shingles
+        # Ước lượng bộ nhớ: chuỗi UTF-8 + shingle + phần overhead cố định
+        self.size = len(prompt_norm.encode()) + len(response.encode()) + 3 * len(shingles) + 200
+
+
+class ResponseCache:
+    """Cache LRU có TTL và giới hạn bộ nhớ (byte ước lượng), an toàn đa luồng.
+
+    Không bao giờ lưu câu trả lời cho prompt bị gắn cờ rủi ro: người gọi truyền `risk_flagged`
+    và cache tự kiểm tra thêm bằng `risk_check` (nếu có) trước khi lưu.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl_seconds=24 * 3600, similarity=0.9,
+                 risk_check=None, pool=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.risk_check = risk_check
+        self.pool = pool # Nếu có: lưu bền (write-through) vào bảng response_cache
+        self._entries = OrderedDict()
+        self._shingle_index = {} # shingle -> set(key), chỉ cho câu hỏi mở đầu phiên
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "near_hits": 0, "misses": 0, "stores": 0, "rejected_risk": 0, "evictions": 0}
+
+    @staticmethod
+    def _key(prompt_norm, fingerprint):
+        return hashlib.sha1(f"{fingerprint}\0{prompt_norm}".encode()).hexdigest()
+
+    def get(self, prompt, history):
+        """Câu trả lời đã cache cho prompt trong ngữ cảnh `history`, hoặc None."""
+        prompt_norm = normalize_prompt(prompt)
+        if not prompt_norm:
+            return None
+        fingerprint = history_fingerprint(history)
+        key = self._key(prompt_norm, fingerprint)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.created <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry.response
+            if entry is not None:
+                self._remove(key)
+            if not fingerprint:
+                near_key = self._find_near_duplicate(prompt_norm, now)
+                if near_key is not None:
+                    self._entries.move_to_end(near_key)
+                    self._stats["near_hits"] += 1
+                    return self._entries[near_key].response
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, prompt, history, response, risk_flagged=False, persist=True):
+        """Lưu câu trả lời; bỏ qua nếu prompt bị gắn cờ rủi ro."""
+        if risk_flagged or (self.risk_check is not None and (self.risk_check(prompt) or self.risk_check(response))):
+            with self._lock:
+                self._stats["rejected_risk"] += 1
+            return False
+        prompt_norm = normalize_prompt(prompt)
+        if not prompt_norm or not response:
+            return False
+        fingerprint = history_fingerprint(history)
+        key = self._key(prompt_norm, fingerprint)
+        first_turn = not fingerprint
+        self._store(key, prompt_norm, first_turn, response, time.time())
+        if persist and self.pool is not None:
+            self._persist(key, prompt_norm, first_turn, response)
+        return True
+
+    def _store(self, key, prompt_norm, first_turn, response, created):
+        # Chỉ câu hỏi mở đầu phiên mới được đưa vào chỉ mục khớp gần đúng
+        shingles = _shingles(prompt_norm) if first_turn else set()
+        entry = _Entry(prompt_norm, response, created, shingles)
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            for shingle in shingles:
+                self._shingle_index.setdefault(shingle, set()).add(key)
+            self._stats["stores"] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self._stats["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        for shingle in entry.shingles:
+            keys = self._shingle_index.get(shingle)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._shingle_index[shingle]
+
+    def _find_near_duplicate(self, prompt_norm, now):
+        """Khóa của câu hỏi mở đầu có độ tương đồng Jaccard (shingle) cao nhất >= ngưỡng."""
+        shingles = _shingles(prompt_norm)
+        if not shingles:
+            return None
+        overlaps = Counter()
+        for shingle in shingles:
+            overlaps.update(self._shingle_index.get(shingle, ()))
+        best_key, best_score = None, 0.0
+        for key, overlap in overlaps.items():
+            entry = self._entries[key]
+            if now - entry.created > self.ttl_seconds:
+                continue
+            score = overlap / (len(shingles) + len(entry.shingles) - overlap)
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key if best_score >= self.similarity else None
+
+    def _persist(self, key, prompt_norm, first_turn, response):
+        try:
+            with self.pool.connection() as conn:
+                db.execute(conn, "upsert_response_cache", (key, prompt_norm, first_turn, response)).close()
+                conn.commit()
+        except Exception as e:
+            tracing.error(f"Error persisting response cache entry: {type(e).__name__}: {e}")
+
+    def load_from_db(self, limit=5000):
+        """Nạp các mục còn hạn từ bảng response_cache (tạo bảng nếu chưa có)."""
+        if self.pool is None:
+            return 0
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(CACHE_DDL)
+            conn.commit()
+            cursor = db.execute(conn, "load_response_cache", (self.ttl_seconds, limit))
+            try:
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        # Các dòng được sắp từ cũ đến mới để thứ tự LRU giữ đúng
+        for key, prompt_norm, first_turn, response, created_epoch in rows:
+            self._store(key, prompt_norm, first_turn, response, float(created_epoch))
+        return len(rows)
+
+    def stats(self):
+        """Số lần trúng chính xác / gần đúng, trượt, số mục và bộ nhớ ước lượng."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["near_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["near_hits"]) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,259 @@
+# risk_detector.py
+# Bộ nhận diện từ khóa rủi ro: chuẩn hóa tiếng Việt + automaton Aho-Corasick biên dịch sẵn.
+
+import math
+import unicodedata
+from collections import deque, namedtuple
+from functools import lru_cache
+
+# !!! DANH SÁCH TỪ KHÓA RẤT CƠ BẢN - CẦN MỞ RỘNG VÀ XÁC THỰC !!!
+RISK_KEYWORDS = {
+    "tự hại": ["muốn chết", "kết thúc", "tự tử", "không muốn sống", "tự làm đau", "dao kéo", "tuyệt vọng"],
+    "bạo lực": ["bị đánh", "bị đập", "bị trấn", "bị đe dọa", "bắt nạt hội đồng"],
+    # Thêm các nhóm khác: lo âu nghiêm trọng, lạm dụng,...
+}
+
+# Dấu hiệu "mềm": một tin nhắn riêng lẻ chưa đủ để cảnh báo, nhưng dồn lại trong một phiên thì đáng chú ý.
+# Chỉ được cộng dồn vào điểm rủi ro của phiên (RiskScorer), không kích hoạt phản hồi khẩn cấp.
+SIGNAL_KEYWORDS = {
+    "kiệt sức": ["mệt lắm", "mệt mỏi", "kiệt sức", "chán nản", "mất ngủ"],
+    "cô lập": ["không ai cần mình", "không ai cần em", "không ai hiểu", "cô đơn", "bị bỏ rơi", "chỉ có một mình"],
+    "vô vọng": ["vô dụng", "là gánh nặng", "chẳng còn ý nghĩa", "không còn lối thoát", "biến mất"],
+}
+
+# Trọng số mỗi lần khớp theo loại; với ngưỡng mặc định 0.9 của RiskScorer, "mệt lắm" rồi "không ai cần mình"
+# trong vài phút là đủ cảnh báo, còn một dấu hiệu riêng lẻ thì không
+CATEGORY_WEIGHTS = {
+    "tự hại": 1.0,
+    "bạo lực": 1.0,
+    "kiệt sức": 0.4,
+    "cô lập": 0.6,
+    "vô vọng": 0.6,
+}
+
+# Một kết quả khớp: start/end là vị trí trong văn bản GỐC (text[start:end])
+RiskMatch = namedtuple("RiskMatch", ["category", "keyword", "start", "end"])
+
+
+@lru_cache(maxsize=4096)
+def _fold_char(ch):
+    """Bỏ dấu một ký tự: chữ thường, tách dấu (NFD), bỏ dấu kết hợp, 'đ' -> 'd'."""
+    folded = []
+    for c in unicodedata.normalize("NFD", ch.lower()):
+        if unicodedata.combining(c):
+            continue
+        folded.append("d" if c == "đ" else c)
+    return "".join(folded)
+
+
+def normalize_text(text):
+    """Chuẩn hóa giữ dấu: NFC, chữ thường, gộp khoảng trắng liên tiếp."""
+    return " ".join(unicodedata.normalize("NFC", text).lower().split())
+
+
+def fold_text(text):
+    """Chuẩn hóa bỏ dấu: như normalize_text nhưng bỏ toàn bộ dấu tiếng Việt."""
+    return " ".join("".join(_fold_char(c) for c in text).split())
+
+
+def _fold_with_offsets(text):
+    """Bỏ dấu và gộp khoảng trắng, kèm vị trí ký tự gốc tương ứng với từng ký tự đã chuẩn hóa."""
+    folded = []
+    origins = []
+    previous_space = True  # Bỏ khoảng trắng ở đầu
+    for index, ch in enumerate(text):
+        if ch.isspace():
+            if not previous_space:
+                folded.append(" ")
+                origins.append(index)
+                previous_space = True
+            continue
+        for c in _fold_char(ch):
+            folded.append(c)
+            origins.append(index)
+        previous_space = False
+    return "".join(folded), origins
+
+
+@lru_cache(maxsize=4096)
+def _char_marks(ch):
+    """(chữ cái gốc, tập dấu) của một ký tự đã chữ thường; 'đ' được coi là 'd' mang thêm một dấu."""
+    if ch == "đ":
+        return "d", frozenset("đ")
+    decomposed = unicodedata.normalize("NFD", ch)
+    return decomposed[:1], frozenset(c for c in decomposed[1:] if unicodedata.combining(c))
+
+
+def _accents_compatible(span_norm, keyword_norm):
+    """True nếu không ký tự nào của đoạn gốc mang dấu mà từ khóa không có (cả hai đã qua normalize_text).
+
+    Thiếu dấu luôn được chấp nhận ("muốn chet", "muôn chết", "tự tu"); dấu sai thì không ("từ từ").
+    """
+    if len(span_norm) != len(keyword_norm):
+        # Không dóng được từng ký tự (hiếm): chỉ chấp nhận khi đúng dấu hoặc hoàn toàn không dấu
+        return span_norm == keyword_norm or span_norm == fold_text(span_norm)
+    for span_char, keyword_char in zip(span_norm, keyword_norm):
+        if span_char != keyword_char and not _char_marks(span_char)[1] <= _char_marks(keyword_char)[1]:
+            return False
+    return True
+
+
+class RiskDetector:
+    """Automaton Aho-Corasick trên văn bản đã bỏ dấu, tìm MỌI từ khóa trong một lần duyệt.
+
+    Thời gian quét tỉ lệ với độ dài tin nhắn (cộng số kết quả), không phụ thuộc số từ khóa,
+    nên danh sách có thể mở rộng tới hàng nghìn mục.
+
+    Khớp bỏ dấu được chấp nhận trừ khi đoạn gốc có một ký tự mang dấu mà từ khóa không có ở cùng
+    vị trí; thiếu dấu luôn được chấp nhận. Nhờ vậy bắt được cả kiểu gõ không dấu hoặc thiếu dấu một
+    phần ("muon chet", "muốn chet", "tự tu"), nhưng "từ từ" không bị nhận nhầm thành "tự tử".
+    Từ khóa phải bắt đầu và kết thúc ở ranh giới từ (đầu/cuối văn bản, khoảng trắng, dấu câu), nên
+    "tư tưởng" hay "tự túc" không bị coi là "tự tử".
+    """
+
+    def __init__(self, keywords_by_category=None):
+        keywords_by_category = RISK_KEYWORDS if keywords_by_category is None else keywords_by_category
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        self.keyword_count = 0
+        for category, keywords in keywords_by_category.items():
+            for keyword in keywords:
+                self._add(category, keyword)
+        self._build_failure_links()
+
+    def _add(self, category, keyword):
+        folded = fold_text(keyword)
+        if not folded:
+            return
+        state = 0
+        for ch in folded:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+                self._goto[state][ch] = next_state
+            state = next_state
+        self._outputs[state].append((category, keyword, normalize_text(keyword), len(folded)))
+        self.keyword_count += 1
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(ch, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+
+    def find_all(self, text):
+        """Trả về danh sách RiskMatch cho mọi từ khóa xuất hiện trong text (theo thứ tự vị trí)."""
+        if not text:
+            return []
+        folded, origins = _fold_with_offsets(text)
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        matches = []
+        state = 0
+        for position, ch in enumerate(folded):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if not outputs[state]:
+                continue
+            after = folded[position + 1] if position + 1 < len(folded) else " "
+            for category, keyword, keyword_norm, length in outputs[state]:
+                before = folded[position - length] if position >= length else " "
+                if before.isalnum() or after.isalnum():
+                    continue # Chỉ khớp trọn từ: "tu tu" trong "tu tuong" / "tu tuc" không phải "tự tử"
+                start = origins[position - length + 1]
+                end = origins[position] + 1
+                # Kéo dài qua các dấu kết hợp (văn bản dạng NFD) thuộc ký tự cuối
+                while end < len(text) and unicodedata.combining(text[end]):
+                    end += 1
+                span = text[start:end]
+                if _accents_compatible(normalize_text(span), keyword_norm):
+                    matches.append(RiskMatch(category, keyword, start, end))
+        matches.sort(key=lambda m: (m.start, m.end))
+        return matches
+
+    def categories(self, text):
+        """Danh sách các loại rủi ro (không trùng lặp) xuất hiện trong text."""
+        seen = []
+        for match in self.find_all(text):
+            if match.category not in seen:
+                seen.append(match.category)
+        return seen
+
+
+class SessionRisk:
+    """Điểm rủi ro tích lũy của một phiên (giảm dần theo thời gian), cập nhật O(1) mỗi tin nhắn."""
+
+    __slots__ = ("score", "updated", "alerted", "recent")
+
+    def __init__(self):
+        self.score = 0.0
+        self.updated = None # Epoch của lần cập nhật gần nhất
+        self.alerted = False # Đã cảnh báo cho đợt tích lũy hiện tại
+        self.recent = deque(maxlen=5) # Từ khóa gần nhất, để ghi vào cảnh báo
+
+
+class RiskScorer:
+    """Cộng dồn trọng số các từ khóa khớp qua từng tin nhắn, giảm theo chu kỳ bán rã `half_life_seconds`.
+
+    Mỗi lần cập nhật chỉ dùng kết quả khớp của tin nhắn mới và trạng thái hiện tại (không quét lại
+    lịch sử). Khi điểm vượt `threshold` lần đầu, update() trả về True; cảnh báo chỉ được bật lại sau khi
+    điểm đã giảm xuống dưới `threshold * rearm_ratio`.
+    """
+
+    def __init__(self, weights=None, half_life_seconds=1800, threshold=0.9, rearm_ratio=0.5, default_weight=0.5):
+        self.weights = CATEGORY_WEIGHTS if weights is None else weights
+        self.half_life_seconds = half_life_seconds
+        self.threshold = threshold
+        self.rearm_ratio = rearm_ratio
+        self.default_weight = default_weight
+        self._decay_rate = math.log(2) / half_life_seconds if half_life_seconds > 0 else 0.0
+
+    def decayed(self, state, now):
+        """Điểm của phiên tại thời điểm `now` (epoch) sau khi đã giảm theo thời gian."""
+        if state.updated is None or now <= state.updated:
+            return state.score
+        return state.score * math.exp(-self._decay_rate * (now - state.updated))
+
+    def update(self, state, matches, now):
+        """Cập nhật `state` với các RiskMatch của một tin nhắn lúc `now`; True nếu vừa vượt ngưỡng.
+
+        Một từ khóa lặp lại trong cùng tin nhắn chỉ được tính một lần.
+        """
+        score = self.decayed(state, now)
+        seen = set()
+        for match in matches:
+            if match.keyword in seen:
+                continue
+            seen.add(match.keyword)
+            score += self.weights.get(match.category, self.default_weight)
+            state.recent.append(match.keyword)
+        state.score = score
+        state.updated = now if state.updated is None else max(now, state.updated)
+        if state.alerted and score < self.threshold * self.rearm_ratio:
+            state.alerted = False
+        if not state.alerted and score >= self.threshold:
+            state.alerted = True
+            return True
+        return False
+
+    def replay(self, detector, messages):
+        """Dựng lại trạng thái từ các cặp (văn bản, epoch) của người dùng, vd: sau khi nạp lại phiên.
+
+        Các lần vượt ngưỡng trong lúc dựng lại coi như đã được cảnh báo trước đó.
+        """
+        state = SessionRisk()
+        for text, created in messages:
+            self.update(state, detector.find_all(text), created)
+        return state
@@ -0,0 +1,201 @@
+# risk_rescan.py
+# Quét lại tin nhắn cũ trong 'conversations' bằng danh sách từ khóa hiện tại (vd: sau khi mở rộng
+# RISK_KEYWORDS) và bổ sung cảnh báo cho các phiên bị bỏ sót. Tin nhắn được đọc theo từng khối qua
+# cursor phía server, nhận diện song song trên nhiều tiến trình, mỗi phiên chỉ có một cảnh báo cho
+# mỗi loại rủi ro (kể cả cảnh báo đã có từ trước). Tiến độ được ghi vào file checkpoint sau mỗi khối,
+# nên chạy lại lệnh sẽ tiếp tục từ chỗ đã dừng.
+#
+# Cách dùng:
+#   python risk_rescan.py                           # Quét tiếp từ checkpoint (hoặc từ đầu)
+#   python risk_rescan.py --dry-run                 # Chỉ đếm, không ghi cảnh báo / checkpoint
+#   python risk_rescan.py --restart --workers 8     # Bỏ checkpoint, quét lại toàn bộ với 8 tiến trình
+# Checkpoint gắn với danh sách từ khóa: đổi RISK_KEYWORDS thì lần chạy sau tự quét lại từ đầu.
+# Kết nối lấy từ --dsn, DATABASE_URL hoặc .streamlit/secrets.toml.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+
+import db
+from risk_detector import RISK_KEYWORDS, RiskDetector
+
+DEFAULT_CHECKPOINT = ".risk_rescan_checkpoint.json"
+
+# Bộ nhận diện của tiến trình con (biên dịch một lần trong initializer)
+_detector = None
+
+
+def keywords_fingerprint(keywords_by_category=None):
+    """Dấu vân tay của danh sách từ khóa; checkpoint chỉ dùng lại khi danh sách không đổi."""
+    keywords_by_category = RISK_KEYWORDS if keywords_by_category is None else keywords_by_category
+    payload = json.dumps(keywords_by_category, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _init_worker(keywords_by_category):
+    global _detector
+    _detector = RiskDetector(keywords_by_category)
+
+
+def scan_chunk(rows):
+    """Nhận diện một khối (message_id, session_id, timestamp, nội dung).
+
+    Trả về (số tin nhắn, message_id cuối, [(session_id, loại rủi ro, timestamp, nội dung)]) -
+    mỗi (phiên, loại) chỉ xuất hiện một lần trong khối, lấy tin nhắn đầu tiên.
+    """
+    hits = {}
+    for message_id, session_id, timestamp, content in rows:
+        if not content or session_id is None:
+            continue
+        for category in _detector.categories(content):
+            hits.setdefault((session_id, category), (session_id, category, timestamp, content))
+    return len(rows), rows[-1][0], list(hits.values())
+
+
+def load_checkpoint(path, fingerprint):
+    """Mốc message_id đã quét xong (0 nếu chưa có checkpoint hoặc từ khóa đã đổi) và số liệu tích lũy."""
+    if not os.path.exists(path):
+        return 0, {}
+    with open(path, encoding="utf-8") as file:
+        checkpoint = json.load(file)
+    if checkpoint.get("fingerprint") != fingerprint:
+        print("Danh sách từ khóa đã thay đổi kể từ checkpoint - quét lại từ đầu.")
+        return 0, {}
+    return int(checkpoint["last_message_id"]), checkpoint.get("totals", {})
+
+
+def save_checkpoint(path, fingerprint, last_message_id, totals):
+    """Ghi checkpoint (ghi file tạm rồi đổi tên, để không bao giờ còn lại file dở dang)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"fingerprint": fingerprint, "last_message_id": last_message_id, "totals": totals,
+                   "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, file)
+    os.replace(tmp_path, path)
+
+
+def insert_alerts(conn, hits, priority=1):
+    """Thêm cảnh báo cho các (phiên, loại) chưa có cảnh báo cùng lý do; trả về danh sách id mới."""
+    created = []
+    for session_id, category, timestamp, content in hits:
+        reason = f"Phát hiện rủi ro: {category}" # Cùng lý do với cảnh báo trực tiếp trong app.py
+        sent_at = f" lúc {timestamp:%H:%M %d/%m/%Y}" if timestamp is not None else ""
+        snippet = f"[Quét lại - tin nhắn{sent_at}] {content}"[:500]
+        cursor = db.execute(conn, "insert_alert_if_new",
+                            (session_id, reason, snippet, priority, "Mới", session_id, reason))
+        try:
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        if row is not None:
+            created.append(row[0])
+    conn.commit()
+    return created
+
+
+def rescan(read_conn, write_conn, checkpoint_path=DEFAULT_CHECKPOINT, workers=None, chunk_rows=5000,
+           restart=False, dry_run=False, priority=1, on_chunk=None):
+    """Quét lại toàn bộ tin nhắn của học sinh sau mốc checkpoint; trả về số liệu tổng.
+
+    `read_conn` giữ cursor phía server trong suốt lần quét, nên cảnh báo được ghi qua `write_conn`
+    (commit trên kết nối đọc sẽ đóng cursor). `workers=0` nhận diện ngay trong tiến trình hiện tại.
+    `on_chunk(stats)` (nếu có) được gọi sau mỗi khối đã ghi xong.
+    """
+    fingerprint = keywords_fingerprint()
+    last_message_id, totals = (0, {}) if restart else load_checkpoint(checkpoint_path, fingerprint)
+    stats = {"start_message_id": last_message_id, "last_message_id": last_message_id,
+             "messages": 0, "chunks": 0, "hits": 0, "alerts_created": 0, "alert_ids": []}
+    started = time.perf_counter()
+
+    def finish_chunk(result):
+        scanned, chunk_last_id, hits = result
+        created = [] if dry_run else insert_alerts(write_conn, hits, priority)
+        stats["messages"] += scanned
+        stats["chunks"] += 1
+        stats["hits"] += len(hits)
+        stats["alerts_created"] += len(created)
+        stats["alert_ids"].extend(created)
+        stats["last_message_id"] = chunk_last_id
+        seconds = time.perf_counter() - started
+        stats["seconds"] = seconds
+        stats["messages_per_second"] = stats["messages"] / seconds if seconds > 0 else 0.0
+        if not dry_run:
+            # Checkpoint chỉ tiến sau khi cảnh báo của khối đã commit: dừng giữa chừng không làm mất cảnh báo
+            run_totals = {key: totals.get(key, 0) + stats[key] for key in ("messages", "hits", "alerts_created")}
+            save_checkpoint(checkpoint_path, fingerprint, chunk_last_id, run_totals)
+        if on_chunk is not None:
+            on_chunk(stats)
+
+    chunks = (rows for _, rows in db.stream_rows(read_conn, "rescan_user_messages", (last_message_id,), chunk_rows))
+    if workers == 0:
+        _init_worker(RISK_KEYWORDS)
+        for rows in chunks:
+            finish_chunk(scan_chunk(rows))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(RISK_KEYWORDS,)) as pool:
+            # Giữ thứ tự khối (để checkpoint luôn là một mốc liền mạch) và giới hạn số khối đang chờ trong bộ nhớ
+            pending = deque()
+            max_pending = 2 * (workers or os.cpu_count() or 1)
+            for rows in chunks:
+                pending.append(pool.submit(scan_chunk, rows))
+                if len(pending) >= max_pending:
+                    finish_chunk(pending.popleft().result())
+            while pending:
+                finish_chunk(pending.popleft().result())
+    read_conn.rollback() # Chỉ đọc: kết thúc giao dịch của cursor phía server
+    stats["seconds"] = time.perf_counter() - started
+    stats["messages_per_second"] = stats["messages"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quét lại hội thoại cũ để bổ sung cảnh báo rủi ro bị bỏ sót.")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="File lưu tiến độ")
+    parser.add_argument("--restart", action="store_true", help="Bỏ qua checkpoint, quét từ đầu")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ đếm kết quả, không ghi cảnh báo / checkpoint")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Số tiến trình nhận diện (mặc định: số CPU; 0: chạy trong tiến trình hiện tại)")
+    parser.add_argument("--chunk-rows", type=int, default=5000, help="Số tin nhắn mỗi khối")
+    parser.add_argument("--priority", type=int, default=1, help="Mức ưu tiên của cảnh báo được thêm")
+    parser.add_argument("--dsn", help="Chuỗi kết nối PostgreSQL (mặc định: DATABASE_URL hoặc secrets.toml)")
+    args = parser.parse_args(argv)
+
+    connect_kwargs = db.cli_connect_kwargs(args.dsn)
+    if connect_kwargs is None:
+        print("Không tìm thấy thông tin kết nối CSDL (--dsn, DATABASE_URL hoặc .streamlit/secrets.toml).")
+        return 1
+
+    def report(stats):
+        if stats["chunks"] % 10 == 0:
+            print(f"  ... {stats['messages']} messages (up to id {stats['last_message_id']}), "
+                  f"{stats['alerts_created']} alerts, {stats['messages_per_second']:.0f} msg/s")
+
+    read_conn = psycopg2.connect(**connect_kwargs)
+    write_conn = psycopg2.connect(**connect_kwargs)
+    try:
+        stats = rescan(
+            read_conn, write_conn, checkpoint_path=args.checkpoint, workers=args.workers,
+            chunk_rows=args.chunk_rows, restart=args.restart, dry_run=args.dry_run,
+            priority=args.priority, on_chunk=report,
+        )
+    except psycopg2.Error as e:
+        print(f"Lỗi CSDL khi quét lại: {e} (chạy lại lệnh để tiếp tục từ checkpoint)")
+        return 1
+    finally:
+        read_conn.close()
+        write_conn.close()
+    outcome = "dry run, no alerts written" if args.dry_run else f"created {stats['alerts_created']} new alerts"
+    print(f"Scanned {stats['messages']} user messages (id {stats['start_message_id']} -> {stats['last_message_id']}) "
+          f"in {stats['seconds']:.2f}s - {stats['messages_per_second']:.0f} msg/s; "
+          f"{stats['hits']} session/category hits, {outcome}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
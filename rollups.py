@@ -0,0 +1,173 @@
+# rollups.py
+# Bảng tổng hợp (rollup) được cập nhật dần bằng trigger, để các ô thống kê trên dashboard
+# chỉ là vài phép tra cứu thay vì COUNT(*)/GROUP BY trên toàn bảng.
+#
+# Cách dùng:
+#   python rollups.py install    # Tạo bảng + trigger (an toàn khi chạy lại; cũng nằm trong `python migrations.py migrate`)
+#   python rollups.py backfill   # Tính lại rollup từ dữ liệu hiện có
+# Kết nối lấy từ biến môi trường DATABASE_URL hoặc mục [database] trong .streamlit/secrets.toml.
+
+import argparse
+import sys
+import time
+
+import psycopg2
+
+import db
+
+ROLLUP_DDL = """
+-- Bộ đếm theo giờ: metric = 'messages' (dimension = sender), 'sessions', 'alerts' (dimension = reason)
+CREATE TABLE IF NOT EXISTS activity_rollups (
+    metric TEXT NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    dimension TEXT NOT NULL DEFAULT '',
+    count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (metric, bucket, dimension)
+);
+
+-- Phiên chat đã được đếm (để mỗi session chỉ tính một lần, tại giờ của tin nhắn đầu tiên)
+CREATE TABLE IF NOT EXISTS rollup_seen_sessions (
+    session_id TEXT PRIMARY KEY,
+    first_seen TIMESTAMP NOT NULL
+);
+
+-- Số cảnh báo hiện tại theo kind = 'status' | 'reason'
+CREATE TABLE IF NOT EXISTS alert_counts (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, value)
+);
+
+CREATE OR REPLACE FUNCTION rollup_bump(p_metric TEXT, p_at TIMESTAMP, p_dimension TEXT, p_delta BIGINT)
+RETURNS void AS $$
+    INSERT INTO activity_rollups (metric, bucket, dimension, count)
+    VALUES (p_metric, date_trunc('hour', p_at), COALESCE(p_dimension, ''), p_delta)
+    ON CONFLICT (metric, bucket, dimension) DO UPDATE SET count = activity_rollups.count + EXCLUDED.count;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION alert_counts_bump(p_kind TEXT, p_value TEXT, p_delta BIGINT)
+RETURNS void AS $$
+    INSERT INTO alert_counts (kind, value, count)
+    VALUES (p_kind, COALESCE(p_value, ''), p_delta)
+    ON CONFLICT (kind, value) DO UPDATE SET count = alert_counts.count + EXCLUDED.count;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION rollup_on_conversation_insert() RETURNS trigger AS $$
+DECLARE
+    at_time TIMESTAMP := COALESCE(NEW.timestamp, now())::timestamp;
+BEGIN
+    PERFORM rollup_bump('messages', at_time, NEW.sender, 1);
+    INSERT INTO rollup_seen_sessions (session_id, first_seen)
+    VALUES (NEW.session_id::text, at_time)
+    ON CONFLICT (session_id) DO NOTHING;
+    IF FOUND THEN
+        PERFORM rollup_bump('sessions', at_time, '', 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rollup_on_alert_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM rollup_bump('alerts', COALESCE(NEW.timestamp, now())::timestamp, NEW.reason, 1);
+        PERFORM alert_counts_bump('reason', NEW.reason, 1);
+        PERFORM alert_counts_bump('status', NEW.status, 1);
+    ELSIF TG_OP = 'UPDATE' THEN
+        IF NEW.status IS DISTINCT FROM OLD.status THEN
+            PERFORM alert_counts_bump('status', OLD.status, -1);
+            PERFORM alert_counts_bump('status', NEW.status, 1);
+        END IF;
+        IF NEW.reason IS DISTINCT FROM OLD.reason THEN
+            PERFORM alert_counts_bump('reason', OLD.reason, -1);
+            PERFORM alert_counts_bump('reason', NEW.reason, 1);
+        END IF;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM alert_counts_bump('reason', OLD.reason, -1);
+        PERFORM alert_counts_bump('status', OLD.status, -1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS conversations_rollup ON conversations;
+CREATE TRIGGER conversations_rollup AFTER INSERT ON conversations
+    FOR EACH ROW EXECUTE FUNCTION rollup_on_conversation_insert();
+
+DROP TRIGGER IF EXISTS alerts_rollup ON alerts;
+CREATE TRIGGER alerts_rollup AFTER INSERT OR UPDATE OF status, reason OR DELETE ON alerts
+    FOR EACH ROW EXECUTE FUNCTION rollup_on_alert_change();
+"""
+
+BACKFILL_SQL = """
+LOCK TABLE conversations, alerts IN SHARE MODE; -- Chặn ghi trong lúc tính lại để không lệch số
+TRUNCATE activity_rollups, rollup_seen_sessions, alert_counts;
+
+INSERT INTO activity_rollups (metric, bucket, dimension, count)
+SELECT 'messages', date_trunc('hour', COALESCE(timestamp, now())::timestamp), COALESCE(sender, ''), COUNT(*)
+FROM conversations GROUP BY 2, 3;
+
+INSERT INTO rollup_seen_sessions (session_id, first_seen)
+SELECT session_id::text, MIN(COALESCE(timestamp, now())::timestamp)
+FROM conversations WHERE session_id IS NOT NULL GROUP BY 1;
+
+INSERT INTO activity_rollups (metric, bucket, dimension, count)
+SELECT 'sessions', date_trunc('hour', first_seen), '', COUNT(*)
+FROM rollup_seen_sessions GROUP BY 2;
+
+INSERT INTO activity_rollups (metric, bucket, dimension, count)
+SELECT 'alerts', date_trunc('hour', COALESCE(timestamp, now())::timestamp), COALESCE(reason, ''), COUNT(*)
+FROM alerts GROUP BY 2, 3;
+
+INSERT INTO alert_counts (kind, value, count)
+SELECT 'reason', COALESCE(reason, ''), COUNT(*) FROM alerts GROUP BY 2;
+
+INSERT INTO alert_counts (kind, value, count)
+SELECT 'status', COALESCE(status, ''), COUNT(*) FROM alerts GROUP BY 2;
+"""
+
+
+def install(conn):
+    """Tạo bảng rollup, hàm và trigger (idempotent)."""
+    with conn.cursor() as cursor:
+        cursor.execute(ROLLUP_DDL)
+    conn.commit()
+
+
+def backfill(conn):
+    """Tính lại toàn bộ rollup từ 'conversations' và 'alerts' trong một giao dịch."""
+    with conn.cursor() as cursor:
+        cursor.execute(BACKFILL_SQL)
+    conn.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quản lý bảng rollup cho dashboard admin.")
+    parser.add_argument("command", choices=["install", "backfill"])
+    parser.add_argument("--dsn", help="Chuỗi kết nối PostgreSQL (mặc định: DATABASE_URL hoặc secrets.toml)")
+    args = parser.parse_args(argv)
+
+    connect_kwargs = db.cli_connect_kwargs(args.dsn)
+    if connect_kwargs is None:
+        print("Không tìm thấy thông tin kết nối CSDL (--dsn, DATABASE_URL hoặc .streamlit/secrets.toml).")
+        return 1
+    started = time.perf_counter()
+    conn = psycopg2.connect(**connect_kwargs)
+    try:
+        if args.command == "install":
+            install(conn)
+        else:
+            backfill(conn)
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Lỗi CSDL khi chạy '{args.command}': {e}")
+        return 1
+    finally:
+        conn.close()
+    print(f"Rollups {args.command} done in {time.perf_counter() - started:.2f}s.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
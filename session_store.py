@@ -0,0 +1,276 @@
+# session_store.py
+# Lịch sử chat của các phiên đang mở, lưu gọn trong bộ nhớ với trần dung lượng cho cả tiến trình.
+# Phiên "nguội" (lâu không hoạt động / vượt trần) được xả khỏi bộ nhớ - nội dung vốn đã được ghi vào
+# bảng 'conversations' - và được nạp lại từ CSDL khi tab đó gửi yêu cầu tiếp theo.
+
+import datetime
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import db
+import tracing
+
+# Cờ của tin nhắn (bitmask) thay cho nhiều khóa bool trong dict
+GREETING = 1
+EMERGENCY = 2
+FAQ = 4
+
+_ROLE_CODES = {"user": 0, "assistant": 1}
+_ROLE_NAMES = ("user", "assistant")
+_FLAG_NAMES = {"is_greeting": GREETING, "is_emergency": EMERGENCY, "is_faq": FAQ}
+_RECORD_OVERHEAD = 72 + 4 * 8 # Đối tượng có __slots__ (5 slot) + con trỏ trong list
+
+
+class ChatMessage:
+    """Một tin nhắn dạng gọn (__slots__, thời gian là epoch float, cờ là bitmask).
+
+    Hỗ trợ cách truy cập kiểu dict (message["content"], message.get("is_faq")) mà
+    chat_view, context_window và response_cache đang dùng.
+    """
+
+    __slots__ = ("role_code", "content", "created", "time_str", "flags")
+
+    def __init__(self, role, content, created, time_str="", flags=0):
+        self.role_code = _ROLE_CODES[role]
+        self.content = content
+        self.created = created
+        self.time_str = time_str
+        self.flags = flags
+
+    @property
+    def role(self):
+        return _ROLE_NAMES[self.role_code]
+
+    @property
+    def timestamp(self):
+        return datetime.datetime.fromtimestamp(self.created)
+
+    def get(self, key, default=None):
+        if key in _FLAG_NAMES:
+            return bool(self.flags & _FLAG_NAMES[key])
+        if key in ("role", "content", "timestamp", "time_str"):
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in _FLAG_NAMES or key in ("role", "content", "timestamp", "time_str")
+
+    def size(self):
+        """Dung lượng ước lượng (byte) của tin nhắn trong bộ nhớ."""
+        return _RECORD_OVERHEAD + sys.getsizeof(self.content) + sys.getsizeof(self.time_str)
+
+
+class SessionHistory:
+    """Danh sách tin nhắn của một phiên; hỗ trợ len(), lặp và cắt lát như list.
+
+    `risk` là điểm rủi ro tích lũy của phiên (risk_detector.SessionRisk) do app.py gắn vào; nó bị xả
+    cùng phiên và được dựng lại từ tin nhắn sau khi nạp lại (None = chưa dựng).
+    """
+
+    __slots__ = ("messages", "bytes", "last_access", "risk")
+
+    def __init__(self):
+        self.messages = []
+        self.bytes = 0
+        self.last_access = time.monotonic()
+        self.risk = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __bool__(self):
+        return bool(self.messages)
+
+
+class SessionHistoryStore:
+    """Kho lịch sử chat theo session_id, dùng chung cho cả tiến trình (an toàn đa luồng).
+
+    - `max_bytes`: trần bộ nhớ ước lượng cho toàn bộ lịch sử trong tiến trình.
+    - `idle_seconds`: phiên không hoạt động lâu hơn mức này bị xả dù chưa vượt trần.
+    - `before_spill`: hàm gọi trước khi xả (vd: MessageWriter.flush) để chắc chắn mọi tin nhắn
+      đã nằm trong CSDL; trả về False thì hủy lần xả đó.
+    - `spilled_ttl_seconds` / `max_spilled`: phiên đã xả chỉ được nhớ để nạp lại trong khoảng thời gian
+      và số lượng này (tab bỏ đi lâu hơn sẽ bắt đầu lại với lịch sử trống).
+    Không có pool thì không thể nạp lại, nên phiên không bao giờ bị xả.
+    """
+
+    def __init__(self, pool=None, max_bytes=64 * 1024 * 1024, idle_seconds=1800,
+                 before_spill=None, time_format='%H:%M:%S %d/%m/%Y',
+                 spilled_ttl_seconds=12 * 3600, max_spilled=100_000):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.before_spill = before_spill
+        self.time_format = time_format
+        self.spilled_ttl_seconds = spilled_ttl_seconds
+        self.max_spilled = max_spilled
+        self._sessions = OrderedDict() # session_id -> SessionHistory, thứ tự LRU
+        self._spilled = OrderedDict() # session_id -> thời điểm xả (monotonic), cũ nhất trước
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"spills": 0, "spilled_messages": 0, "rehydrations": 0, "rehydrate_ms": 0.0,
+                       "forgotten_sessions": 0}
+
+    def get(self, session_id):
+        """Lịch sử của phiên (nạp lại từ CSDL nếu phiên đã bị xả)."""
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is not None:
+                self._sessions.move_to_end(session_id)
+                history.last_access = time.monotonic()
+                return history
+            spilled = session_id in self._spilled
+        history = self._rehydrate(session_id) if spilled else SessionHistory()
+        if history is None:
+            # Lỗi CSDL: không giữ bản rỗng trong kho, phiên vẫn được đánh dấu đã xả để lần sau nạp lại
+            return SessionHistory()
+        with self._lock:
+            # Một luồng khác có thể đã tạo/nạp trước trong lúc đọc CSDL
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                return existing
+            self._spilled.pop(session_id, None)
+            self._sessions[session_id] = history
+            self._bytes += history.bytes
+        self._enforce_budget(keep=session_id)
+        return history
+
+    def append(self, session_id, role, content, timestamp=None, **flags):
+        """Thêm tin nhắn vào phiên; `flags` là is_greeting / is_emergency / is_faq. Trả về tin nhắn."""
+        timestamp = timestamp or datetime.datetime.now()
+        flag_bits = 0
+        for name, value in flags.items():
+            if value:
+                flag_bits |= _FLAG_NAMES[name]
+        message = ChatMessage(role, content, timestamp.timestamp(), timestamp.strftime(self.time_format), flag_bits)
+        history = self.get(session_id)
+        size = message.size()
+        with self._lock:
+            history.messages.append(message)
+            history.bytes += size
+            history.last_access = time.monotonic()
+            if self._sessions.get(session_id) is history:
+                self._bytes += size
+        self._enforce_budget(keep=session_id)
+        return message
+
+    def _rehydrate(self, session_id):
+        started = time.perf_counter()
+        history = SessionHistory()
+        try:
+            with self.pool.connection() as conn:
+                cursor = db.execute(conn, "session_messages", (session_id,))
+                try:
+                    rows = cursor.fetchall()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            tracing.error(f"Error rehydrating session {session_id}: {type(e).__name__}: {e}")
+            return None
+        for sender, content, timestamp, related_alert_id in rows:
+            role = "user" if str(sender).lower() == "user" else "assistant"
+            timestamp = timestamp or datetime.datetime.now()
+            message = ChatMessage(
+                role, content or "", timestamp.timestamp(), timestamp.strftime(self.time_format),
+                EMERGENCY if related_alert_id is not None else 0
+            )
+            history.messages.append(message)
+            history.bytes += message.size()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        tracing.observe("session.rehydrate", elapsed_ms)
+        with self._lock:
+            self._stats["rehydrations"] += 1
+            self._stats["rehydrate_ms"] += elapsed_ms
+        tracing.debug(f"Rehydrated session {session_id}: {len(history)} messages.")
+        return history
+
+    def _pick_victims(self, keep):
+        """Các phiên cần xả: phiên quá hạn idle, rồi phiên ít dùng nhất cho tới khi về dưới trần."""
+        now = time.monotonic()
+        victims = []
+        projected = self._bytes
+        for session_id, history in self._sessions.items(): # Từ ít dùng nhất đến mới nhất
+            if session_id == keep:
+                continue
+            if projected > self.max_bytes or now - history.last_access > self.idle_seconds:
+                victims.append(session_id)
+                projected -= history.bytes
+        return victims
+
+    def _enforce_budget(self, keep=None):
+        if self.pool is None:
+            return
+        with self._lock:
+            victims = self._pick_victims(keep)
+        if not victims:
+            return
+        # Tin nhắn có thể còn trong hàng đợi ghi nền: chỉ xả khi chắc chắn đã vào CSDL
+        if self.before_spill is not None and self.before_spill() is False:
+            tracing.warning("Session store: flush before spill failed, keeping sessions in memory.")
+            return
+        with self._lock:
+            for session_id in victims:
+                history = self._sessions.pop(session_id, None)
+                if history is None:
+                    continue
+                self._bytes -= history.bytes
+                self._spilled[session_id] = time.monotonic()
+                self._stats["spills"] += 1
+                self._stats["spilled_messages"] += len(history)
+            self._forget_spilled()
+
+    def _forget_spilled(self):
+        """Bỏ các phiên đã xả quá `spilled_ttl_seconds` hoặc vượt `max_spilled` (gọi khi đang giữ khóa)."""
+        cutoff = time.monotonic() - self.spilled_ttl_seconds
+        while self._spilled:
+            session_id, spilled_at = next(iter(self._spilled.items()))
+            if spilled_at >= cutoff and len(self._spilled) <= self.max_spilled:
+                break
+            del self._spilled[session_id]
+            self._stats["forgotten_sessions"] += 1
+
+    def stats(self):
+        """Số phiên/tin nhắn trong bộ nhớ, dung lượng ước lượng so với trần, số lần xả/nạp lại."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["sessions_in_memory"] = len(self._sessions)
+            stats["messages_in_memory"] = sum(len(history) for history in self._sessions.values())
+            stats["spilled_sessions"] = len(self._spilled)
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+        stats["avg_rehydrate_ms"] = stats["rehydrate_ms"] / stats["rehydrations"] if stats["rehydrations"] else 0.0
+        return stats
+
+
+# --- Kho dùng chung cho cả tiến trình (app.py tạo; trang Admin đọc số liệu) ---
+_shared_store = None
+_store_lock = threading.Lock()
+
+
+def get_store(**kwargs):
+    """Kho lịch sử dùng chung của tiến trình; tạo ở lần gọi đầu với các tham số của SessionHistoryStore."""
+    global _shared_store
+    with _store_lock:
+        if _shared_store is None:
+            _shared_store = SessionHistoryStore(**kwargs)
+        return _shared_store
+
+
+def shared_stats():
+    """Số liệu của kho dùng chung, hoặc None nếu trang chat chưa khởi tạo kho trong tiến trình này."""
+    store = _shared_store
+    return store.stats() if store is not None else None
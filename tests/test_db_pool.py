@@ -0,0 +1,190 @@
+# tests/test_db_pool.py
+# Kiểm tra reconnect của ConnectionPool khi PostgreSQL khởi động lại, không cần CSDL thật:
+# ThreadedConnectionPool của psycopg2 được thay bằng pool giả có "máy chủ" khởi động lại được.
+# Chạy: python -m pytest -q tests
+
+import os
+import sys
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_pool  # noqa: E402
+from db_pool import ConnectionPool  # noqa: E402
+
+
+class FakeServer:
+    """Mỗi lần restart() làm chết mọi kết nối mở trước đó; `down` khiến việc mở kết nối mới thất bại."""
+
+    def __init__(self):
+        self.generation = 0
+        self.down = False
+        self.opened = 0
+
+    def restart(self):
+        self.generation += 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        if self.conn.generation != self.conn.server.generation:
+            self.conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConnection:
+    def __init__(self, server):
+        self.server = server
+        self.generation = server.generation
+        self.closed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def poll(self):
+        # Máy chủ khởi động lại gửi thông báo đóng kết nối; psycopg2 báo lỗi khi đọc nó ra
+        if self.generation != self.server.generation:
+            self.closed = 2
+            raise psycopg2.OperationalError("terminating connection due to administrator command")
+        return psycopg2.extensions.POLL_OK
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeThreadedPool:
+    """Như psycopg2.pool.ThreadedConnectionPool: kết nối rảnh được dùng lại theo LIFO."""
+
+    def __init__(self, minconn, maxconn, server):
+        self.server = server
+        self.maxconn = maxconn
+        self.idle = [self._connect() for _ in range(minconn)]
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.server.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        self.server.opened += 1
+        return FakeConnection(self.server)
+
+    def getconn(self):
+        with self.lock:
+            if len(self.used) >= self.maxconn:
+                raise psycopg2.pool.PoolError("connection pool exhausted")
+            conn = self.idle.pop() if self.idle else self._connect()
+            self.used.add(id(conn))
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self.lock:
+            self.used.discard(id(conn))
+            if close:
+                conn.close()
+            else:
+                self.idle.append(conn)
+
+    def closeall(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle.clear()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(
+        db_pool.psycopg2.pool, "ThreadedConnectionPool",
+        lambda minconn, maxconn, **kwargs: FakeThreadedPool(minconn, maxconn, server),
+    )
+    return server
+
+
+def _warm_up(pool, count):
+    """Mượn rồi trả `count` kết nối cùng lúc để pool có `count` kết nối rảnh."""
+    conns = [pool.getconn() for _ in range(count)]
+    for conn in conns:
+        pool.putconn(conn)
+
+
+def _query(pool):
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+
+def test_reconnects_past_every_stale_idle_connection(server):
+    pool = ConnectionPool(minconn=1, maxconn=5, check_idle_after=30.0)
+    _warm_up(pool, 5)
+    server.restart() # Cả 5 kết nối rảnh đều đã chết
+
+    _query(pool)
+    assert pool.stats["reconnects"] >= 1
+
+
+def test_stale_connections_are_checked_even_when_recently_used(server):
+    pool = ConnectionPool(minconn=1, maxconn=4, check_idle_after=30.0)
+    _warm_up(pool, 4)
+    server.restart()
+
+    # Sau lần mượn đầu tiên phát hiện kết nối chết, các kết nối rảnh còn lại cũng phải được kiểm tra
+    for _ in range(4):
+        _query(pool)
+
+
+def test_concurrent_checkouts_after_restart(server):
+    pool = ConnectionPool(minconn=2, maxconn=6, check_idle_after=30.0)
+    _warm_up(pool, 6)
+    server.restart()
+
+    errors = []
+    start = threading.Barrier(6)
+
+    def worker():
+        start.wait()
+        for _ in range(20):
+            try:
+                _query(pool)
+            except Exception as e: # Ghi lại để assert ở luồng chính
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_gives_up_after_bounded_attempts_and_frees_the_slot(server):
+    pool = ConnectionPool(minconn=1, maxconn=2, checkout_timeout=0.5, check_idle_after=30.0)
+    _warm_up(pool, 2)
+    server.restart()
+    server.down = True # Không mở được kết nối mới
+
+    with pytest.raises(psycopg2.OperationalError):
+        pool.getconn()
+
+    server.down = False
+    _query(pool) # Slot đã được trả lại: mượn được ngay khi máy chủ lên lại
+    _query(pool)
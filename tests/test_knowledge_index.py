@@ -0,0 +1,94 @@
+# tests/test_knowledge_index.py
+# Lịch nạp lại chỉ mục FAQ dùng chung: thử lại sau lỗi với thời gian chờ tăng dần,
+# và nạp định kỳ để thấy FAQ do tiến trình khác thêm. CSDL được thay bằng bảng giả.
+# Chạy: python -m pytest -q tests
+
+import contextlib
+import os
+import sys
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import knowledge_index  # noqa: E402
+from knowledge_index import KnowledgeIndex  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakePool:
+    """Bảng knowledge_base giả; `down` khiến việc lấy kết nối thất bại."""
+
+    def __init__(self):
+        self.down = False
+        self.faqs = []
+        self.queries = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        self.queries += 1
+        if self.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        yield self
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(knowledge_index, "_shared_index", KnowledgeIndex())
+    monkeypatch.setattr(
+        knowledge_index.db, "execute",
+        lambda conn, name, params: FakeCursor([row for row in conn.faqs if row[0] > params[0]]),
+    )
+    return pool
+
+
+def _faq(doc_id):
+    return (doc_id, f"Câu hỏi số {doc_id} về học bổng", f"Đáp án {doc_id}", None)
+
+
+def test_failed_refresh_is_retried_with_backoff(pool):
+    pool.faqs.append(_faq(1))
+    pool.down = True
+    index = knowledge_index.get_index(pool, now=0.0)
+    assert index.docs == [] and index.refresh_failures == 1
+
+    knowledge_index.get_index(pool, now=1.0) # Còn trong thời gian chờ: không truy vấn lại
+    assert pool.queries == 1
+
+    pool.down = False
+    index = knowledge_index.get_index(pool, now=knowledge_index.RETRY_BACKOFF_SECONDS)
+    assert [doc["id"] for doc in index.docs] == [1]
+    assert index.refresh_failures == 0
+
+
+def test_backoff_grows_with_consecutive_failures(pool):
+    pool.down = True
+    knowledge_index.get_index(pool, now=0.0)
+    first_delay = knowledge_index._shared_index.next_refresh_at
+    knowledge_index.get_index(pool, now=first_delay)
+    second_delay = knowledge_index._shared_index.next_refresh_at - first_delay
+    assert second_delay == 2 * first_delay
+
+
+def test_periodic_refresh_picks_up_faqs_from_other_processes(pool):
+    pool.faqs.append(_faq(1))
+    knowledge_index.get_index(pool, now=0.0)
+
+    pool.faqs.append(_faq(2)) # Thêm từ tiến trình khác: phiên bản trong tiến trình này không đổi
+    index = knowledge_index.get_index(pool, now=10.0)
+    assert len(index.docs) == 1
+
+    index = knowledge_index.get_index(pool, now=knowledge_index.REFRESH_INTERVAL_SECONDS)
+    assert [doc["id"] for doc in index.docs] == [1, 2]
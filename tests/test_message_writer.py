@@ -0,0 +1,77 @@
+# tests/test_message_writer.py
+# flush() chỉ được báo thành công khi tin nhắn đã commit; CSDL giả có thể "sập" rồi lên lại.
+# Chạy: python -m pytest -q tests
+
+import os
+import sys
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import message_writer  # noqa: E402
+from message_writer import MessageWriter  # noqa: E402
+
+
+class FakeConnection:
+    closed = 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.down = False
+        self.rows = []
+
+    def getconn(self):
+        if self.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        return FakeConnection()
+
+    def putconn(self, conn):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(message_writer.db, "execute_many",
+                        lambda conn, name, rows, page_size=100: pool.rows.extend(rows))
+    return pool
+
+
+def test_flush_reports_success_after_commit(pool):
+    writer = MessageWriter(pool, flush_interval=0.05)
+    writer.enqueue("s1", "u1", "user", "xin chào")
+    assert writer.flush(timeout=2.0) is True
+    assert len(pool.rows) == 1
+    writer.close()
+
+
+def test_flush_fails_while_database_is_down_and_rows_are_kept(pool):
+    pool.down = True
+    writer = MessageWriter(pool, flush_interval=0.05, max_retries=100)
+    writer.enqueue("s1", "u1", "user", "xin chào")
+    assert writer.flush(timeout=2.0) is False
+    assert writer.stats()["written"] == 0
+
+    pool.down = False
+    assert writer.flush(timeout=2.0) is True # Dòng lỗi được thử lại và commit ở lần sau
+    assert len(pool.rows) == 1
+    writer.close()
+
+
+def test_flush_fails_when_rows_were_dropped(pool):
+    pool.down = True
+    writer = MessageWriter(pool, flush_interval=0.05, max_retries=1)
+    writer.enqueue("s1", "u1", "user", "xin chào")
+    assert writer.flush(timeout=2.0) is False
+    pool.down = False
+    assert writer.stats()["dropped"] == 1
+    writer.close()
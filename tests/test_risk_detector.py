@@ -0,0 +1,29 @@
+# tests/test_risk_detector.py
+# Các câu thăm dò của benchmarks/bench_risk.py: biến thể thiếu dấu phải khớp, từ thường gặp không được khớp.
+# Chạy: python -m pytest -q tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_risk import PROBES  # noqa: E402
+from risk_detector import RISK_KEYWORDS, RiskDetector  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def detector():
+    return RiskDetector(RISK_KEYWORDS)
+
+
+@pytest.mark.parametrize("text, expected", PROBES)
+def test_probe(detector, text, expected):
+    assert [match.keyword for match in detector.find_all(text)] == expected
+
+
+def test_match_offsets_point_at_original_text(detector):
+    text = "Hôm qua, em muốn chet thật."
+    (match,) = detector.find_all(text)
+    assert text[match.start:match.end] == "muốn chet"
@@ -0,0 +1,247 @@
+# tracing.py
+# Đo thời gian theo giai đoạn (span) và ghi log có cấp độ, thay cho print rải rác trên luồng chính.
+# Mọi span đều được cộng dồn vào histogram (rẻ: vài phép cộng dưới một lock); chỉ một phần span
+# (theo sample_rate) được ghi log chi tiết. Histogram xuất ra dạng Prometheus text hoặc JSON,
+# có thể ghi định kỳ ra file (vd: cho textfile collector của node_exporter).
+# Log đi qua module logging chuẩn (logger "tracing"): có thể gắn handler/định dạng riêng khi triển khai.
+
+import json
+import logging
+import os
+import random
+import threading
+import sys
+import time
+
+LEVELS = {"DEBUG": logging.DEBUG, "INFO": logging.INFO, "WARNING": logging.WARNING,
+          "ERROR": logging.ERROR, "CRITICAL": logging.CRITICAL}
+
+# Ngưỡng bucket của histogram (ms)
+DEFAULT_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+# Ngưỡng bucket của histogram giá trị không phải thời gian (vd: số token prompt mỗi lượt)
+DEFAULT_VALUE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+_config = {
+    "sample_rate": float(os.getenv("TRACE_SAMPLE_RATE", "0.01")),
+    "buckets": DEFAULT_BUCKETS_MS,
+    "value_buckets": DEFAULT_VALUE_BUCKETS,
+}
+_histograms = {}
+_value_histograms = {}
+_lock = threading.Lock()
+_exporter = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LEVELS.get(os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO))
+if not logger.handlers:
+    # Mặc định ghi ra stdout như trước; không truyền lên root để không in hai lần nếu root cũng có handler
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+
+def configure(level=None, sample_rate=None, buckets=None):
+    """Đổi cấp độ log ("DEBUG"..."CRITICAL"), tỉ lệ ghi log span (0..1) hoặc bucket (ms)."""
+    if level is not None:
+        logger.setLevel(LEVELS[str(level).upper()])
+    if sample_rate is not None:
+        _config["sample_rate"] = max(0.0, min(1.0, float(sample_rate)))
+    if buckets is not None:
+        with _lock:
+            _config["buckets"] = tuple(sorted(buckets))
+            _histograms.clear() # Bucket mới: không trộn với số liệu cũ
+
+
+def enabled(level):
+    return logger.isEnabledFor(LEVELS[level])
+
+
+def debug(message):
+    logger.debug(message)
+
+
+def info(message):
+    logger.info(message)
+
+
+def warning(message):
+    logger.warning(message)
+
+
+def error(message):
+    logger.error(message)
+
+
+def critical(message):
+    logger.critical(message)
+
+
+class _Histogram:
+    __slots__ = ("counts", "count", "sum", "max", "errors")
+
+    def __init__(self, bucket_count):
+        self.counts = [0] * (bucket_count + 1) # Ô cuối là +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+
+def _record(histograms, buckets, name, value, failed=False):
+    index = len(buckets)
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            index = i
+            break
+    with _lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = _Histogram(len(buckets))
+        histogram.counts[index] += 1
+        histogram.count += 1
+        histogram.sum += value
+        if value > histogram.max:
+            histogram.max = value
+        if failed:
+            histogram.errors += 1
+
+
+def observe(name, ms, failed=False):
+    """Ghi một giá trị (ms) vào histogram `name`."""
+    _record(_histograms, _config["buckets"], name, ms, failed)
+
+
+def observe_value(name, value):
+    """Ghi một giá trị không phải thời gian (vd: số token) vào histogram giá trị `name`."""
+    _record(_value_histograms, _config["value_buckets"], name, value)
+
+
+class span:
+    """Đo một giai đoạn: `with tracing.span("alert.create", session=...):`.
+
+    Thời gian luôn vào histogram; lỗi (ngoại lệ, hoặc `failed = True` khi lỗi đã được xử lý
+    bên trong) được đếm riêng. Với xác suất sample_rate, span được ghi log ở cấp DEBUG kèm các thuộc tính.
+    """
+
+    __slots__ = ("name", "attrs", "started", "elapsed_ms", "failed")
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.elapsed_ms = None
+        self.failed = False
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed_ms = (time.perf_counter() - self.started) * 1000
+        failed = self.failed or exc_type is not None
+        observe(self.name, self.elapsed_ms, failed=failed)
+        sample_rate = _config["sample_rate"]
+        if sample_rate and logger.isEnabledFor(logging.DEBUG) and random.random() < sample_rate:
+            attrs = " ".join(f"{key}={value}" for key, value in self.attrs.items())
+            status = f" error={exc_type.__name__ if exc_type is not None else True}" if failed else ""
+            debug(f"span {self.name} {self.elapsed_ms:.1f}ms{status} {attrs}".rstrip())
+        return False
+
+
+def _snapshot_items(histograms, buckets):
+    with _lock:
+        items = [(name, list(h.counts), h.count, h.sum, h.max, h.errors) for name, h in histograms.items()]
+    for name, counts, count, total, maximum, errors in sorted(items):
+        cumulative, running = {}, 0
+        for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+            running += bucket_count
+            cumulative[str(bound)] = running
+        yield name, count, total, maximum, errors, cumulative
+
+
+def snapshot():
+    """Số liệu hiện tại: {span: {count, sum_ms, avg_ms, max_ms, errors, buckets: {le: số lũy kế}}}."""
+    result = {}
+    for name, count, total, maximum, errors, cumulative in _snapshot_items(_histograms, _config["buckets"]):
+        result[name] = {
+            "count": count, "sum_ms": total, "avg_ms": total / count if count else 0.0,
+            "max_ms": maximum, "errors": errors, "buckets": cumulative,
+        }
+    return result
+
+
+def value_snapshot():
+    """Như snapshot() cho histogram giá trị: {tên: {count, sum, avg, max, buckets}}."""
+    result = {}
+    for name, count, total, maximum, _, cumulative in _snapshot_items(_value_histograms, _config["value_buckets"]):
+        result[name] = {
+            "count": count, "sum": total, "avg": total / count if count else 0.0,
+            "max": maximum, "buckets": cumulative,
+        }
+    return result
+
+
+def export_json():
+    return json.dumps({"generated_at": time.time(), "spans": snapshot(), "values": value_snapshot()}, indent=2)
+
+
+def export_prometheus(prefix="hocduong"):
+    """Histogram theo định dạng Prometheus text (đơn vị giây, theo quy ước của Prometheus)."""
+    metric = f"{prefix}_span_duration_seconds"
+    lines = [
+        f"# HELP {metric} Thời gian thực hiện từng giai đoạn xử lý.",
+        f"# TYPE {metric} histogram",
+    ]
+    data = snapshot()
+    for name, stats in data.items():
+        for bound, count in stats["buckets"].items():
+            le = bound if bound == "+Inf" else repr(float(bound) / 1000)
+            lines.append(f'{metric}_bucket{{span="{name}",le="{le}"}} {count}')
+        lines.append(f'{metric}_sum{{span="{name}"}} {stats["sum_ms"] / 1000:.6f}')
+        lines.append(f'{metric}_count{{span="{name}"}} {stats["count"]}')
+    lines.append(f"# HELP {prefix}_span_errors_total Số lần giai đoạn kết thúc bằng lỗi.")
+    lines.append(f"# TYPE {prefix}_span_errors_total counter")
+    for name, stats in data.items():
+        lines.append(f'{prefix}_span_errors_total{{span="{name}"}} {stats["errors"]}')
+    values = value_snapshot()
+    if values:
+        metric = f"{prefix}_value"
+        lines.append(f"# HELP {metric} Giá trị đo theo từng lượt (vd: số token prompt).")
+        lines.append(f"# TYPE {metric} histogram")
+        for name, stats in values.items():
+            for bound, count in stats["buckets"].items():
+                le = bound if bound == "+Inf" else repr(float(bound))
+                lines.append(f'{metric}_bucket{{name="{name}",le="{le}"}} {count}')
+            lines.append(f'{metric}_sum{{name="{name}"}} {stats["sum"]}')
+            lines.append(f'{metric}_count{{name="{name}"}} {stats["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+def write_export(path, fmt=None):
+    """Ghi số liệu ra file (ghi file tạm rồi đổi tên để bên đọc không thấy file dở dang)."""
+    fmt = fmt or ("json" if path.endswith(".json") else "prometheus")
+    content = export_json() if fmt == "json" else export_prometheus()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(tmp_path, path)
+
+
+def start_exporter(path, interval=15.0, fmt=None):
+    """Luồng nền ghi số liệu ra `path` mỗi `interval` giây (mỗi tiến trình chỉ một luồng)."""
+    global _exporter
+    with _lock:
+        if _exporter is not None:
+            return _exporter
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    write_export(path, fmt)
+                except OSError as e:
+                    error(f"Metrics export to {path} failed: {e}")
+
+        _exporter = threading.Thread(target=run, name="metrics-exporter", daemon=True)
+        _exporter.start()
+        return _exporter
@@ -0,0 +1,263 @@
+# transcript_export.py
+# Xuất hàng loạt hội thoại (kèm thông tin cảnh báo liên kết) bằng COPY ... TO STDOUT: dữ liệu được
+# đẩy thẳng từ PostgreSQL ra file theo từng dòng, không đi qua DataFrame, nên bộ nhớ không phụ thuộc
+# số dòng. File được cắt thành nhiều phần (chunk) CSV hoặc Parquet.
+#
+# Cách dùng:
+#   python transcript_export.py --from 2024-09-01 --to 2025-01-01 --out exports/hk1
+#   python transcript_export.py --flagged-only --format parquet --chunk-rows 500000 --out exports/an_toan
+#   python transcript_export.py --session abc-123 --session def-456 --out exports/phien
+#   python transcript_export.py --alert-id 42 --out exports/canh_bao_42
+# Parquet cần thêm gói pyarrow. Kết nối lấy từ --dsn, DATABASE_URL hoặc .streamlit/secrets.toml.
+
+import argparse
+import datetime
+import io
+import os
+import sys
+import time
+
+import psycopg2
+
+import db
+
+CONVERSATION_COLUMNS = (
+    "c.message_id, c.session_id, c.user_id, c.sender, c.message_content, c.timestamp, c.related_alert_id, "
+    "a.reason AS alert_reason, a.status AS alert_status, a.priority AS alert_priority"
+)
+
+# Kiểu cột cố định cho Parquet: chunk toàn giá trị rỗng vẫn cùng lược đồ với các chunk khác
+_PARQUET_TYPES = {
+    "conversations": {
+        "message_id": "int64", "session_id": "string", "user_id": "string", "sender": "string",
+        "message_content": "string", "timestamp": "timestamp[us]", "related_alert_id": "int64",
+        "alert_reason": "string", "alert_status": "string", "alert_priority": "int32",
+    },
+    "alerts": {
+        "id": "int64", "timestamp": "timestamp[us]", "reason": "string", "snippet": "string",
+        "status": "string", "assignee": "string", "priority": "int32", "chat_session_id": "string",
+    },
+}
+
+
+def _filters(time_column, session_column, start=None, end=None, session_ids=None, alert_ids=None, flagged_only=False):
+    """Điều kiện WHERE và tham số chung cho hội thoại và cảnh báo."""
+    conditions, params = [], []
+    if start is not None:
+        conditions.append(f"{time_column} >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append(f"{time_column} < %s")
+        params.append(end)
+    if session_ids:
+        conditions.append(f"{session_column} = ANY(%s)")
+        params.append(list(session_ids))
+    if alert_ids:
+        # Toàn bộ phiên chat của các cảnh báo này (để người rà soát đọc được ngữ cảnh)
+        conditions.append(f"{session_column} IN (SELECT chat_session_id FROM alerts WHERE id = ANY(%s))")
+        params.append(list(alert_ids))
+    if flagged_only:
+        conditions.append(f"{session_column} IN (SELECT chat_session_id FROM alerts WHERE chat_session_id IS NOT NULL)")
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+def conversations_query(**filters):
+    where, params = _filters("c.timestamp", "c.session_id", **filters)
+    # Thứ tự khớp index (session_id, timestamp, message_id) của migrations.py: không cần sắp xếp trên đĩa
+    sql = (
+        f"SELECT {CONVERSATION_COLUMNS} FROM conversations c "
+        f"LEFT JOIN alerts a ON a.id = c.related_alert_id{where} "
+        "ORDER BY c.session_id, c.timestamp, c.message_id"
+    )
+    return sql, params
+
+
+def alerts_query(**filters):
+    where, params = _filters("timestamp", "chat_session_id", **filters)
+    return f"SELECT {db.ALERT_COLUMNS} FROM alerts{where} ORDER BY timestamp, id", params
+
+
+class _ChunkedCsvWriter:
+    """Đích của copy_expert: ghi ra name_0001.csv, name_0002.csv... mỗi file tối đa `chunk_rows` dòng.
+
+    libpq trả về đúng một dòng dữ liệu cho mỗi lần đọc COPY, nên mỗi lần write() là một dòng
+    hoàn chỉnh (kể cả khi nội dung có xuống dòng); lần write() đầu tiên là dòng tiêu đề.
+    """
+
+    extension = "csv"
+
+    def __init__(self, out_dir, name, chunk_rows, on_chunk=None):
+        self.out_dir = out_dir
+        self.name = name
+        self.chunk_rows = chunk_rows
+        self.on_chunk = on_chunk # Gọi với số liệu hiện tại mỗi khi xong một file
+        self.started = time.perf_counter()
+        self.header = None
+        self.rows = 0
+        self.bytes = 0
+        self.paths = []
+        self._file = None
+        self._chunk_count = 0
+
+    def _path(self):
+        return os.path.join(self.out_dir, f"{self.name}_{len(self.paths) + 1:04d}.{self.extension}")
+
+    def _open(self):
+        path = self._path()
+        self.paths.append(path)
+        self._file = open(path, "wb")
+        self._file.write(self.header)
+        self._chunk_count = 0
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.header is None:
+            self.header = data
+            return
+        if self._file is None:
+            self._open()
+        elif self.chunk_rows and self._chunk_count >= self.chunk_rows:
+            self._close()
+            if self.on_chunk is not None:
+                self.on_chunk(self.stats())
+            self._open()
+        self._file.write(data)
+        self._chunk_count += 1
+        self.rows += 1
+        self.bytes += len(data)
+
+    def finish(self):
+        if self.header is not None and not self.paths:
+            self._open() # Không có dòng nào: vẫn ghi một file chỉ có tiêu đề
+        self._close()
+
+    def stats(self):
+        seconds = time.perf_counter() - self.started
+        return {
+            "rows": self.rows, "files": len(self.paths), "bytes": self.bytes, "seconds": seconds,
+            "rows_per_second": self.rows / seconds if seconds > 0 else 0.0, "paths": list(self.paths),
+        }
+
+
+class _ChunkedParquetWriter(_ChunkedCsvWriter):
+    """Như _ChunkedCsvWriter nhưng gom từng chunk CSV trong bộ nhớ rồi ghi thành một file Parquet."""
+
+    extension = "parquet"
+
+    def __init__(self, out_dir, name, chunk_rows, column_types, on_chunk=None):
+        super().__init__(out_dir, name, chunk_rows or 100_000, on_chunk) # Parquet luôn cần giới hạn một chunk
+        try:
+            import pyarrow as pa
+            import pyarrow.csv as pa_csv
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Xuất Parquet cần gói pyarrow: pip install pyarrow") from e
+        self._pa, self._pa_csv, self._pq = pa, pa_csv, pq
+        self._convert = pa_csv.ConvertOptions(
+            column_types={column: pa.type_for_alias(alias) for column, alias in column_types.items()},
+            strings_can_be_null=True,
+        )
+        self._parse = pa_csv.ParseOptions(newlines_in_values=True)
+
+    def _open(self):
+        self.paths.append(self._path())
+        self._file = io.BytesIO()
+        self._file.write(self.header)
+        self._chunk_count = 0
+
+    def _close(self):
+        if self._file is None:
+            return
+        self._file.seek(0)
+        table = self._pa_csv.read_csv(self._file, parse_options=self._parse, convert_options=self._convert)
+        self._pq.write_table(table, self.paths[-1], compression="zstd")
+        self._file = None
+
+
+def export_table(conn, sql, params, out_dir, name, fmt="csv", chunk_rows=250_000, on_chunk=None):
+    """Chạy COPY (sql) TO STDOUT vào các file chunk trong `out_dir`; trả về số liệu của lần xuất.
+
+    `on_chunk(stats)` (nếu có) được gọi mỗi khi xong một file - dùng để báo tiến độ.
+    Số liệu gồm rows, files, bytes, seconds, rows_per_second và paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if fmt == "parquet":
+        writer = _ChunkedParquetWriter(out_dir, name, chunk_rows, _PARQUET_TYPES[name], on_chunk)
+    else:
+        writer = _ChunkedCsvWriter(out_dir, name, chunk_rows, on_chunk)
+    with conn.cursor() as cursor:
+        # mogrify: COPY không nhận tham số phía server, nên giá trị được psycopg2 escape vào câu lệnh
+        query = cursor.mogrify(sql, params)
+        cursor.copy_expert(b"COPY (" + query + b") TO STDOUT WITH (FORMAT csv, HEADER true)", writer)
+    writer.finish()
+    conn.rollback() # Chỉ đọc: kết thúc giao dịch, không giữ snapshot
+    return writer.stats()
+
+
+def export_transcripts(conn, out_dir, fmt="csv", chunk_rows=250_000, include_alerts=True, on_chunk=None, **filters):
+    """Xuất hội thoại (và cảnh báo) theo bộ lọc start/end/session_ids/alert_ids/flagged_only.
+
+    Trả về {"conversations": số liệu, "alerts": số liệu} (xem export_table).
+    """
+    results = {}
+    sql, params = conversations_query(**filters)
+    results["conversations"] = export_table(conn, sql, params, out_dir, "conversations", fmt, chunk_rows, on_chunk)
+    if include_alerts:
+        sql, params = alerts_query(**filters)
+        results["alerts"] = export_table(conn, sql, params, out_dir, "alerts", fmt, chunk_rows, on_chunk)
+    return results
+
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Xuất hàng loạt hội thoại và cảnh báo (COPY, chia file).")
+    parser.add_argument("--out", required=True, help="Thư mục ghi file xuất")
+    parser.add_argument("--from", dest="start", type=_parse_date, help="Từ ngày (YYYY-MM-DD, tính cả ngày này)")
+    parser.add_argument("--to", dest="end", type=_parse_date, help="Đến ngày (YYYY-MM-DD, không tính ngày này)")
+    parser.add_argument("--session", dest="session_ids", action="append", help="Chỉ xuất phiên này (lặp lại được)")
+    parser.add_argument("--alert-id", dest="alert_ids", type=int, action="append",
+                        help="Xuất các phiên của cảnh báo này (lặp lại được)")
+    parser.add_argument("--flagged-only", action="store_true", help="Chỉ xuất các phiên có cảnh báo")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--chunk-rows", type=int, default=250_000, help="Số dòng tối đa mỗi file (0: không chia)")
+    parser.add_argument("--no-alerts", action="store_true", help="Không xuất bảng alerts")
+    parser.add_argument("--dsn", help="Chuỗi kết nối PostgreSQL (mặc định: DATABASE_URL hoặc secrets.toml)")
+    args = parser.parse_args(argv)
+
+    connect_kwargs = db.cli_connect_kwargs(args.dsn)
+    if connect_kwargs is None:
+        print("Không tìm thấy thông tin kết nối CSDL (--dsn, DATABASE_URL hoặc .streamlit/secrets.toml).")
+        return 1
+
+    def report(stats):
+        print(f"  ... {stats['rows']} rows in {stats['files']} file(s), {stats['rows_per_second']:.0f} rows/s")
+
+    conn = psycopg2.connect(**connect_kwargs)
+    try:
+        results = export_transcripts(
+            conn, args.out, fmt=args.format, chunk_rows=args.chunk_rows, include_alerts=not args.no_alerts,
+            on_chunk=report, start=args.start, end=args.end, session_ids=args.session_ids,
+            alert_ids=args.alert_ids, flagged_only=args.flagged_only,
+        )
+    except (psycopg2.Error, RuntimeError) as e:
+        print(f"Lỗi khi xuất dữ liệu: {e}")
+        return 1
+    finally:
+        conn.close()
+    for name, stats in results.items():
+        print(f"Exported {stats['rows']} {name} rows to {stats['files']} {args.format} file(s) "
+              f"({stats['bytes'] / 1024 / 1024:.1f} MB) in {stats['seconds']:.2f}s - {stats['rows_per_second']:.0f} rows/s.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())